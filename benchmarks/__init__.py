@@ -0,0 +1,7 @@
+"""Benchmarks run against the configured PostgreSQL server, see the README"""
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wingtel.settings")
+django.setup()
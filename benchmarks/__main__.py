@@ -0,0 +1,26 @@
+"""
+Run the ingestion and the query latency benchmarks and emit one JSON document.
+
+    python -m benchmarks --records 10000 --sizes 100000 1000000 10000000 --output results.json
+"""
+import argparse
+
+from benchmarks import ingestion, queries
+from benchmarks.utils import dump, get_environment, test_database, truncate_usage
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+ingestion.add_arguments(parser)
+parser.add_argument("--sizes", type=int, nargs="+", default=[10**5, 10**6, 10**7])
+parser.add_argument("--queries", type=int, default=200, help="Measured calls of every selector per size")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", help="JSON file, stdout by default")
+args = parser.parse_args()
+
+with test_database():
+    results = {
+        "environment": get_environment(),
+        "ingestion": ingestion.run(args.records, args.subscriptions, args.seed, args.strategies),
+    }
+    truncate_usage()
+    results["queries"] = queries.run(args.sizes, args.subscriptions, args.queries, args.seed)
+dump(results, args.output)
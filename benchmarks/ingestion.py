@@ -0,0 +1,116 @@
+"""
+Compare raw usage ingestion throughput of the aggregation strategies:
+per-row signal saves, signal saves inside deferred_usage_aggregation(), BulkCreateUsageRecordService
+and COPY through ImportUsageRecordService. Runs against a throwaway test database.
+
+    python -m benchmarks.ingestion --records 10000 --subscriptions 100 --output ingestion.json
+"""
+import argparse
+import csv
+import io
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, List
+
+import pytz
+from django.db import transaction
+
+from benchmarks.utils import (
+    create_subscriptions,
+    dump,
+    get_environment,
+    test_database,
+    truncate_usage,
+)
+from wingtel.usage.models import DataUsageRecord, UsageRecord
+from wingtel.usage.services import (
+    BulkCreateUsageRecordService,
+    ImportUsageRecordService,
+    deferred_usage_aggregation,
+)
+
+
+def build_records(subscriptions, records_count: int, seed: int) -> List[DataUsageRecord]:
+    rnd = random.Random(seed)
+    start = datetime(2022, 1, 1, tzinfo=pytz.utc)
+    return [
+        DataUsageRecord(
+            subscription_id=rnd.choice(subscriptions),
+            price=Decimal(rnd.randint(0, 999)) / 100,
+            usage_date=start + timedelta(seconds=rnd.randint(0, 30 * 24 * 3600)),
+            kilobytes_used=rnd.randint(0, 1000),
+        )
+        for _ in range(records_count)
+    ]
+
+
+@transaction.atomic
+def ingest_with_signals(records: List[DataUsageRecord]):
+    for record in records:
+        record.save()
+
+
+def ingest_with_deferred_signals(records: List[DataUsageRecord]):
+    with deferred_usage_aggregation():
+        for record in records:
+            record.save()
+
+
+def ingest_with_bulk_create(records: List[DataUsageRecord]):
+    BulkCreateUsageRecordService(records, UsageRecord.USAGE_TYPES.data).create()
+
+
+def ingest_with_copy(records: List[DataUsageRecord]):
+    file = io.StringIO()
+    writer = csv.writer(file)
+    writer.writerow(["subscription_id", "price", "usage_date", DataUsageRecord.USED_FIELD])
+    for record in records:
+        writer.writerow([record.subscription_id_id, record.price, record.usage_date.isoformat(), record.kilobytes_used])
+    file.seek(0)
+    ImportUsageRecordService(file, UsageRecord.USAGE_TYPES.data).import_records()
+
+
+STRATEGIES: Dict[str, Callable] = {
+    "signals": ingest_with_signals,
+    "deferred_signals": ingest_with_deferred_signals,
+    "bulk_create": ingest_with_bulk_create,
+    "copy": ingest_with_copy,
+}
+
+
+def run(records_count: int, subscriptions_count: int, seed: int, strategies: List[str]) -> Dict:
+    subscriptions = create_subscriptions(subscriptions_count)
+    results = {"records": records_count, "subscriptions": subscriptions_count, "records_per_second": {}}
+    for name in strategies:
+        truncate_usage()
+        records = build_records(subscriptions, records_count, seed)
+        started = time.perf_counter()
+        STRATEGIES[name](records)
+        results["records_per_second"][name] = round(records_count / (time.perf_counter() - started), 1)
+    if "signals" in strategies:
+        baseline = results["records_per_second"]["signals"]
+        results["speedup"] = {name: round(value / baseline, 2) for name, value in results["records_per_second"].items()}
+    return results
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--records", type=int, default=10000, help="Raw records ingested by every strategy")
+    parser.add_argument("--subscriptions", type=int, default=100)
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=list(STRATEGIES))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file, stdout by default")
+    args = parser.parse_args()
+
+    with test_database():
+        results = {
+            "environment": get_environment(),
+            "ingestion": run(args.records, args.subscriptions, args.seed, args.strategies),
+        }
+    dump(results, args.output)
@@ -0,0 +1,172 @@
+"""
+Latency (p50/p95/p99) of get_usage_records_with_exceeded_price, get_usage_records_group_by_subscription_id,
+get_top_usage_subscriptions (exact and approximate) and table/index sizes of the aggregates at growing numbers
+of raw records. Raw records are added with the generate_usage command (COPY and set-based aggregation) up to every
+size. Runs against a throwaway test database.
+
+    python -m benchmarks.queries --sizes 100000 1000000 10000000 --queries 200 --output queries.json
+"""
+import argparse
+import io
+import random
+import time
+from datetime import date, timedelta
+from typing import Dict, List
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+
+from benchmarks.utils import (
+    create_subscriptions,
+    dump,
+    get_environment,
+    percentiles,
+    test_database,
+)
+from wingtel.usage.models import MonthlyUsageRecord, UsageRecord, UsageRecordTotal
+from wingtel.usage.selectors import (
+    get_top_usage_subscriptions,
+    get_usage_records_group_by_subscription_id,
+    get_usage_records_with_exceeded_price,
+)
+from wingtel.usage.utils import add_months
+
+MONTHS = 6
+AGGREGATE_MODELS = [UsageRecord, MonthlyUsageRecord, UsageRecordTotal]
+PRICE_QUANTILE_SQL = (
+    f"SELECT percentile_cont(%s) WITHIN GROUP (ORDER BY total_price) FROM {UsageRecordTotal._meta.db_table}"
+)
+
+
+def get_months() -> List[date]:
+    current = timezone.now().date().replace(day=1)
+    return [add_months(current, months) for months in range(-MONTHS + 1, 1)]
+
+
+def generate_raw_records(count: int, seed: int):
+    """Add count raw records and their aggregates over the existing subscriptions and the last MONTHS months"""
+    months = get_months()
+    call_command(
+        "generate_usage",
+        records=count,
+        subscriptions=0,
+        date_from=months[0],
+        date_to=add_months(months[-1], 1) - timedelta(days=1),
+        seed=seed,
+        stdout=io.StringIO(),
+    )
+    models = list(UsageRecord.RAW_MODELS.values()) + AGGREGATE_MODELS
+    with connection.cursor() as cursor:
+        # the visibility map of freshly loaded tables is set, so index-only scans don't fetch the heap
+        cursor.execute(f"VACUUM ANALYZE {', '.join(model._meta.db_table for model in models)}")
+
+
+def get_storage() -> Dict[str, Dict[str, int]]:
+    """Table and index bytes of the aggregates"""
+    storage = {}
+    with connection.cursor() as cursor:
+        for model in AGGREGATE_MODELS:
+            table = model._meta.db_table
+            cursor.execute("SELECT pg_table_size(%s), pg_indexes_size(%s)", [table, table])
+            table_bytes, index_bytes = cursor.fetchone()
+            storage[table] = {"table_bytes": table_bytes, "index_bytes": index_bytes}
+    return storage
+
+
+def measure(function, arguments: List[tuple]) -> Dict[str, float]:
+    samples = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+def measure_selectors(subscription_ids: List[int], queries: int, rnd: random.Random) -> Dict[str, Dict]:
+    with connection.cursor() as cursor:
+        # limits returning about 1% and 10% of the subscription totals
+        limits = []
+        for quantile in (0.99, 0.9):
+            cursor.execute(PRICE_QUANTILE_SQL, [quantile])
+            limits.append(int(cursor.fetchone()[0] or 0))
+    months = get_months()
+    days = (add_months(months[-1], 1) - months[0]).days
+    ranges = []
+    for _ in range(queries):
+        first, last = sorted(rnd.randrange(days) for _ in range(2))
+        ranges.append(
+            (rnd.choice(subscription_ids), months[0] + timedelta(days=first), months[0] + timedelta(days=last))
+        )
+    return {
+        "price_limit": measure(
+            lambda limit: list(get_usage_records_with_exceeded_price(limit)),
+            [(rnd.choice(limits),) for _ in range(queries)],
+        ),
+        "usage_metrics": measure(
+            lambda subscription_id: get_usage_records_group_by_subscription_id(subscription_id),
+            [(subscription_id,) for subscription_id, _, _ in ranges],
+        ),
+        "usage_metrics_date_range": measure(
+            lambda subscription_id, date_from, date_to: get_usage_records_group_by_subscription_id(
+                subscription_id, date_from=date_from, date_to=date_to
+            ),
+            ranges,
+        ),
+        # a week and the whole loaded range, top 100 by data used
+        "top_usage_week": measure(
+            lambda date_to: get_top_usage_subscriptions(
+                "used", 100, UsageRecord.USAGE_TYPES.data, date_to - timedelta(days=6), date_to
+            ),
+            [(date_to,) for _, _, date_to in ranges],
+        ),
+        "top_usage_all": measure(
+            lambda: get_top_usage_subscriptions("used", 100, UsageRecord.USAGE_TYPES.data), [()] * queries
+        ),
+        "top_usage_all_approximate": measure(
+            lambda: get_top_usage_subscriptions("used", 100, UsageRecord.USAGE_TYPES.data, approximate=True),
+            [()] * queries,
+        ),
+        "top_usage_range_approximate": measure(
+            lambda date_from, date_to: get_top_usage_subscriptions(
+                "price", 100, date_from=date_from, date_to=date_to, approximate=True
+            ),
+            [(date_from, date_to) for _, date_from, date_to in ranges],
+        ),
+    }
+
+
+def run(sizes: List[int], subscriptions_count: int, queries: int, seed: int) -> List[Dict]:
+    subscription_ids = [subscription.id for subscription in create_subscriptions(subscriptions_count)]
+    rnd = random.Random(seed)
+    results, loaded = [], 0
+    for size in sorted(sizes):
+        started = time.perf_counter()
+        generate_raw_records(size - loaded, rnd.randrange(2**32))
+        loaded = size
+        result = {"raw_records": size, "load_seconds": round(time.perf_counter() - started, 2)}
+        result.update(measure_selectors(subscription_ids, queries, rnd))
+        result["storage"] = get_storage()
+        results.append(result)
+    return results
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10**5, 10**6, 10**7])
+    parser.add_argument("--subscriptions", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200, help="Measured calls of every selector per size")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file, stdout by default")
+    args = parser.parse_args()
+
+    with test_database():
+        results = {
+            "environment": get_environment(),
+            "queries": run(args.sizes, args.subscriptions, args.queries, args.seed),
+        }
+    dump(results, args.output)
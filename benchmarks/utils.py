@@ -0,0 +1,82 @@
+"""Helpers shared by the benchmarks"""
+import json
+import platform
+import subprocess
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import django
+from django.contrib.auth.models import User
+from django.db import connection
+
+from wingtel.subscriptions.models import Subscription
+from wingtel.usage.models import (
+    MonthlyUsageRecord,
+    UsageRecord,
+    UsageRecordShard,
+    UsageRecordTotal,
+)
+
+
+@contextmanager
+def test_database():
+    """Run the benchmark in a throwaway database created from the configured PostgreSQL connection"""
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def create_subscriptions(count: int) -> List[Subscription]:
+    user, _ = User.objects.get_or_create(username="benchmark")
+    return Subscription.objects.bulk_create([Subscription(user=user, type_of_subscription="att") for _ in range(count)])
+
+
+def truncate_usage():
+    """Remove raw usage records and all their aggregates"""
+    models = list(UsageRecord.RAW_MODELS.values()) + [
+        UsageRecord,
+        MonthlyUsageRecord,
+        UsageRecordTotal,
+        UsageRecordShard,
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(f"TRUNCATE {', '.join(model._meta.db_table for model in models)}")
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 of latencies given in seconds, in milliseconds"""
+    samples = sorted(samples)
+    result = {}
+    for percentile in (50, 95, 99):
+        index = min(len(samples) - 1, round(percentile / 100 * (len(samples) - 1)))
+        result[f"p{percentile}_ms"] = round(samples[index] * 1000, 3)
+    return result
+
+
+def get_environment() -> Dict[str, Optional[str]]:
+    """Commit and versions, so results of different runs can be compared"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW server_version")
+        postgresql = cursor.fetchone()[0]
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "postgresql": postgresql,
+    }
+
+
+def dump(results: Dict, output: Optional[str] = None):
+    """Print results as JSON, or write them to the output file"""
+    content = json.dumps(results, indent=4, default=str)
+    if output:
+        with open(output, "w") as file:
+            file.write(content + "\n")
+    else:
+        print(content)
@@ -1,7 +1,56 @@
 import pytest
+from django.db import connection
 from rest_framework.test import APIClient
 
+from wingtel.replicas.routers import replica_lag, reset_replica_state
+from wingtel.usage.backends import AGGREGATION_BACKENDS, MATERIALIZED_VIEW
+from wingtel.usage.cache import get_usage_cache, stats
+from wingtel.usage.schema import sync_aggregation_backend
+
 
 @pytest.fixture
 def api_client() -> APIClient:
     return APIClient()
+
+
+@pytest.fixture(autouse=True)
+def usage_cache():
+    """Cached results must not leak between tests"""
+    yield
+    cache = get_usage_cache()
+    if cache is not None:
+        cache.clear()
+    stats.reset()
+
+
+@pytest.fixture
+def run_on_commit():
+    """Run the on_commit callbacks of the test transaction, it's never committed"""
+
+    def run():
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
+    return run
+
+
+@pytest.fixture(params=[backend for backend in AGGREGATION_BACKENDS if backend != MATERIALIZED_VIEW])
+def aggregation_backend(request, db, settings) -> str:
+    """
+    Run a test with every aggregation backend, their triggers are rolled back with the test transaction.
+    The materialized view is stale until a refresh, it has tests of its own
+    """
+    settings.USAGE_AGGREGATION_BACKEND = request.param
+    sync_aggregation_backend()
+    return request.param
+
+
+@pytest.fixture(autouse=True)
+def replica_state():
+    """Pinning to the primary and measured lags must not leak between tests"""
+    reset_replica_state()
+    replica_lag.reset()
+    yield
+    reset_replica_state()
+    replica_lag.reset()
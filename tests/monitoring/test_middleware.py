@@ -0,0 +1,55 @@
+import pytest
+from django.urls import reverse
+
+from tests.usage_record.factories import DataUsageRecordFactory, UsageRecordFactory
+from wingtel.monitoring.metrics import REQUEST_QUERIES, Histogram
+
+pytestmark = pytest.mark.django_db
+
+
+def test_server_timing_header(api_client):
+    UsageRecordFactory.create(price=20)
+    response = api_client.get(reverse("usage-price_limit"), {"price_limit": 10})
+
+    timings = dict(timing.split(";", 1) for timing in response["Server-Timing"].split(", "))
+    assert set(timings) == {"db", "render", "total"}
+    assert timings["db"].startswith('desc="1 queries"')
+
+
+def test_streamed_queries_are_observed_when_consumed(api_client):
+    UsageRecordFactory.create(price=20)
+    REQUEST_QUERIES.reset()
+    response = api_client.get(reverse("usage-price_limit"), {"price_limit": 10, "stream": "true"})
+
+    assert "Server-Timing" not in response
+    assert not REQUEST_QUERIES.samples
+    b"".join(response.streaming_content)
+    [(_, queries)] = REQUEST_QUERIES.samples.values()
+    assert queries == 1
+
+
+def test_metrics_endpoint(api_client):
+    DataUsageRecordFactory.create()
+    api_client.get(reverse("api:att-list"))
+    response = api_client.get(reverse("metrics"))
+
+    assert response["Content-Type"].startswith("text/plain")
+    content = response.content.decode()
+    assert 'wingtel_http_request_queries_count{view="ATTSubscriptionViewSet",method="GET"}' in content
+    assert 'wingtel_usage_aggregation_duration_seconds_count{service="CreateUpdateUsageRecordService"}' in content
+
+
+def test_histogram_render():
+    histogram = Histogram("queries", "Queries.", ("view",), (1, 5))
+    for value in (0, 1, 3, 10):
+        histogram.observe(value, view='a"b')
+
+    assert histogram.render() == [
+        "# HELP queries Queries.",
+        "# TYPE queries histogram",
+        'queries_bucket{view="a\\"b",le="1"} 2',
+        'queries_bucket{view="a\\"b",le="5"} 3',
+        'queries_bucket{view="a\\"b",le="+Inf"} 4',
+        'queries_sum{view="a\\"b"} 14.0',
+        'queries_count{view="a\\"b"} 4',
+    ]
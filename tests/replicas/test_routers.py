@@ -0,0 +1,122 @@
+import time
+
+import pytest
+from django.conf import settings
+from django.db import connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from tests.usage_record.factories import UsageRecordFactory
+from wingtel.replicas.middleware import ReplicaPinningMiddleware
+from wingtel.replicas.routers import (
+    ReplicaLag,
+    ReplicaRouter,
+    replica_lag,
+    replica_reads,
+)
+from wingtel.usage.models import UsageRecord
+from wingtel.usage.selectors import get_usage_records_with_exceeded_price
+
+router = ReplicaRouter()
+
+
+@pytest.fixture
+def replica_lags(settings, monkeypatch):
+    """Two replicas with lags in seconds set by the test instead of measured"""
+    settings.DATABASE_READ_REPLICAS = ["replica_1", "replica_2"]
+    settings.DATABASE_REPLICA_MAX_LAG = 5
+    lags = {"replica_1": 0.0, "replica_2": 0.0}
+    monkeypatch.setattr(ReplicaLag, "measure", staticmethod(lambda alias: lags[alias]))
+    return lags
+
+
+def read_database() -> str:
+    with replica_reads():
+        return router.db_for_read(UsageRecord) or "default"
+
+
+def test_reads_go_to_replica_only_inside_replica_reads(replica_lags):
+    assert router.db_for_read(UsageRecord) is None
+    assert read_database() in replica_lags
+
+
+def test_reads_stay_on_the_same_fresh_replica(replica_lags):
+    replica = read_database()
+    assert {read_database() for _ in range(10)} == {replica}
+
+    replica_lags[replica] = 60
+    replica_lag.reset()
+    assert {read_database() for _ in range(10)} == set(replica_lags) - {replica}
+
+
+@pytest.mark.parametrize("lag", [60, None])
+def test_reads_fall_back_to_primary_when_replicas_lag(replica_lags, lag):
+    replica_lags.update(dict.fromkeys(replica_lags, lag))
+    assert read_database() == "default"
+
+
+def test_lag_is_measured_once_per_interval(replica_lags, settings):
+    settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL = 60
+    read_database()
+    replica_lags.update(dict.fromkeys(replica_lags, 60))
+
+    assert read_database() != "default"
+    settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL = 0
+    assert read_database() == "default"
+
+
+def test_write_pins_reads_to_primary_until_end_of_request(replica_lags):
+    def view(request):
+        router.db_for_write(UsageRecord)
+        return read_database()
+
+    assert ReplicaPinningMiddleware(view)(None) == "default"
+    assert read_database() != "default"
+
+
+@pytest.mark.django_db
+def test_reads_inside_transaction_stay_on_primary(replica_lags):
+    with transaction.atomic():
+        assert read_database() == "default"
+
+
+def test_replicas_are_not_migrated(replica_lags):
+    assert router.allow_migrate("replica_1", "usage") is False
+    assert router.allow_migrate("default", "usage") is None
+
+
+requires_replica = pytest.mark.skipif(
+    not settings.DATABASE_READ_REPLICAS, reason="set DATABASE_REPLICAS to a streaming replica of the database"
+)
+
+
+def wait_for_replica(alias: str):
+    for _ in range(100):
+        if ReplicaLag.measure(alias) == 0:
+            return
+        time.sleep(0.05)
+    raise AssertionError(f"{alias} didn't catch up")
+
+
+@requires_replica
+@pytest.mark.django_db(transaction=True, databases="__all__")
+def test_usage_api_reads_from_replica(api_client):
+    alias = settings.DATABASE_READ_REPLICAS[0]
+    record = UsageRecordFactory.create(price=20)
+    wait_for_replica(alias)
+    with CaptureQueriesContext(connections[alias]) as context:
+        response = api_client.get(reverse("usage-price_limit"), {"price_limit": 10, "page_size": 10})
+
+    assert [item["subscription_id"] for item in response.json()["results"]] == [record.subscription_id]
+    assert context.captured_queries
+
+
+@requires_replica
+@pytest.mark.django_db(transaction=True, databases="__all__")
+def test_selector_reads_own_writes_from_primary():
+    record = UsageRecordFactory.create(price=20)
+    with CaptureQueriesContext(connections["default"]) as context:
+        records = list(get_usage_records_with_exceeded_price(10))
+
+    assert [item["subscription_id"] for item in records] == [record.subscription_id]
+    assert context.captured_queries
@@ -6,12 +6,18 @@ from factory.django import DjangoModelFactory
 
 from tests.subscription.factories import SubscriptionFactory
 from wingtel.usage import models
+from wingtel.usage.backends import SIGNALS, get_aggregation_backend
+from wingtel.usage.selectors import get_daily_usage_records
+from wingtel.usage.services import (
+    ApplyUsageRecordDeltasService,
+    new_usage_record_deltas,
+)
 
 
 class DataUsageRecordFactory(DjangoModelFactory):
     subscription_id = SubFactory(SubscriptionFactory)
     usage_date = fuzzy.FuzzyDateTime(datetime.datetime.now(tz=pytz.utc))
-    price = fuzzy.FuzzyInteger(0, 1000)
+    price = fuzzy.FuzzyInteger(0, 999)
     kilobytes_used = fuzzy.FuzzyInteger(0, 1000)
 
     class Meta:
@@ -21,7 +27,7 @@ class DataUsageRecordFactory(DjangoModelFactory):
 class VoiceUsageRecordFactory(DjangoModelFactory):
     subscription_id = SubFactory(SubscriptionFactory)
     usage_date = fuzzy.FuzzyDateTime(datetime.datetime.now(tz=pytz.utc))
-    price = fuzzy.FuzzyInteger(0, 1000)
+    price = fuzzy.FuzzyInteger(0, 999)
     seconds_used = fuzzy.FuzzyInteger(0, 1000)
 
     class Meta:
@@ -32,8 +38,33 @@ class UsageRecordFactory(DjangoModelFactory):
     subscription = SubFactory(SubscriptionFactory)
     type_of_usage = models.UsageRecord.USAGE_TYPES.data
     usage_date = fuzzy.FuzzyDateTime(datetime.datetime.now(tz=pytz.utc))
-    price = fuzzy.FuzzyInteger(0, 1000)
+    price = fuzzy.FuzzyInteger(0, 999)
     used = fuzzy.FuzzyInteger(0, 1000)
 
     class Meta:
         model = models.UsageRecord
+
+    @classmethod
+    def _create(cls, model_class, *args, **kwargs):
+        """
+        Aggregates are written through the upsert service, so the rollups stay in sync.
+        Other backends aggregate raw records themselves, so a raw record of the same values is created
+        """
+        usage_date = kwargs["usage_date"]
+        if isinstance(usage_date, datetime.datetime):
+            usage_date = usage_date.date()
+        subscription = kwargs["subscription"]
+        key = (kwargs["type_of_usage"], subscription.id if subscription else None, usage_date)
+        if get_aggregation_backend() == SIGNALS:
+            deltas = new_usage_record_deltas()
+            deltas[key] = [kwargs["price"], kwargs["used"]]
+            ApplyUsageRecordDeltasService.from_deltas(deltas).apply()
+        else:
+            raw_model = models.UsageRecord.RAW_MODELS[key[0]]
+            raw_model.objects.create(
+                subscription_id=kwargs["subscription"],
+                price=kwargs["price"],
+                usage_date=datetime.datetime.combine(usage_date, datetime.time(12), pytz.utc),
+                **{raw_model.USED_FIELD: kwargs["used"]},
+            )
+        return get_daily_usage_records().get(type_of_usage=key[0], subscription_id=key[1], usage_date=key[2])
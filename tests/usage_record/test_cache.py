@@ -0,0 +1,127 @@
+from datetime import date, datetime
+
+import pytest
+import pytz
+from django.db import transaction
+from django.urls import reverse
+
+from tests.usage_record.factories import DataUsageRecordFactory, VoiceUsageRecordFactory
+from wingtel.replicas.routers import ReplicaLag, get_read_database, replica_reads
+from wingtel.usage.cache import (
+    evict_usage_records,
+    get_or_set,
+    get_usage_cache,
+    get_version_key,
+    stats,
+)
+from wingtel.usage.models import UsageRecord
+
+# versions are bumped after commit
+pytestmark = pytest.mark.django_db(transaction=True)
+usage_price_limit_url = reverse("usage-price_limit")
+usage_cache_stats_url = reverse("usage-cache_stats")
+
+
+@pytest.fixture(autouse=True)
+def primary_only(settings):
+    """Misses read the primary, a replica may not have replayed the writes of a test yet"""
+    settings.DATABASE_READ_REPLICAS = []
+
+
+class TestUsageMetricsCache:
+    def get_metrics(self, api_client, record, **params):
+        url = reverse("usage-metrics", kwargs={"subscription_id": record.subscription_id.id})
+        return api_client.get(url, params).json()
+
+    def test_result_is_cached(self, api_client):
+        record = DataUsageRecordFactory.create()
+        first_response = self.get_metrics(api_client, record)
+        second_response = self.get_metrics(api_client, record)
+
+        assert first_response == second_response
+        assert stats.as_dict() == {"hits": 1, "misses": 1, "evictions": 0}
+
+    def test_change_inside_range_evicts(self, api_client):
+        usage_date = datetime(2022, 1, 10, tzinfo=pytz.utc)
+        record = DataUsageRecordFactory.create(usage_date=usage_date, price=1)
+        self.get_metrics(api_client, record, usage_date__gte="2022-01-01")
+        DataUsageRecordFactory.create(subscription_id=record.subscription_id, usage_date=usage_date, price=2)
+        response = self.get_metrics(api_client, record, usage_date__gte="2022-01-01")
+
+        assert response[0]["total_price"] == 3
+        assert stats.as_dict() == {"hits": 0, "misses": 2, "evictions": 1}
+
+    def test_change_of_other_type_or_subscription_keeps_entry(self, api_client):
+        record = DataUsageRecordFactory.create(usage_date=datetime(2022, 1, 10, tzinfo=pytz.utc))
+        self.get_metrics(api_client, record, usage_date__gte="2022-01-01", type_of_usage="data")
+        VoiceUsageRecordFactory.create(subscription_id=record.subscription_id, usage_date=record.usage_date)
+        DataUsageRecordFactory.create(usage_date=record.usage_date)
+        self.get_metrics(api_client, record, usage_date__gte="2022-01-01", type_of_usage="data")
+
+        assert stats.as_dict() == {"hits": 1, "misses": 1, "evictions": 0}
+
+
+class TestPriceLimitCache:
+    def test_change_of_filtered_subscription_evicts(self, api_client):
+        record = DataUsageRecordFactory.create(price=10)
+        other_record = DataUsageRecordFactory.create(price=10)
+        params = {"price_limit": 15, "subscription": record.subscription_id.id}
+        assert api_client.get(usage_price_limit_url, params).json() == []
+
+        other_record.price = 100
+        other_record.save()
+        assert api_client.get(usage_price_limit_url, params).json() == []
+        record.price = 20
+        record.save()
+        response = api_client.get(usage_price_limit_url, params).json()
+
+        assert response == [
+            {"subscription_id": record.subscription_id.id, "price_exceeded": 5, "type_of_usage": "data"}
+        ]
+        assert stats.as_dict() == {"hits": 1, "misses": 2, "evictions": 1}
+
+    def test_stats_view(self, api_client):
+        api_client.get(usage_price_limit_url, {"price_limit": 1})
+        api_client.get(usage_price_limit_url, {"price_limit": 1})
+        response = api_client.get(usage_cache_stats_url)
+
+        assert response.json() == {"hits": 1, "misses": 1, "evictions": 0}
+
+
+class TestVersions:
+    def test_result_computed_across_a_change_is_not_read(self):
+        def compute():
+            # a writer commits while the result is computed
+            DataUsageRecordFactory.create(subscription_id__id=1)
+            return ["stale"]
+
+        version_key = get_version_key(1, None)
+        assert get_or_set("usage:test", version_key, compute) == ["stale"]
+        assert get_or_set("usage:test", version_key, lambda: ["fresh"]) == ["fresh"]
+        assert get_or_set("usage:test", version_key, lambda: ["computed again"]) == ["fresh"]
+
+    def test_miss_soon_after_a_change_is_computed_on_the_primary(self, settings, monkeypatch):
+        settings.DATABASE_READ_REPLICAS = ["replica_1"]
+        monkeypatch.setattr(ReplicaLag, "measure", staticmethod(lambda alias: 0.0))
+
+        def compute():
+            with replica_reads():
+                return [get_read_database()]
+
+        version_key = get_version_key(1, None)
+        assert get_or_set("usage:test", version_key, compute) == ["replica_1"]
+        evict_usage_records([(UsageRecord.USAGE_TYPES.data, 1, date(2022, 1, 1))])
+        assert get_or_set("usage:test", version_key, compute) == ["default"]
+
+    def test_change_bumps_versions_only_after_commit(self):
+        record = DataUsageRecordFactory.create()
+        version_key = get_version_key(record.subscription_id.id, None)
+        get_or_set("usage:test", version_key, lambda: ["old"])
+        cache = get_usage_cache()
+        version = cache.get(version_key)
+
+        with transaction.atomic():
+            record.price += 1
+            record.save()
+            assert cache.get(version_key) == version
+        assert cache.get(version_key) == version + 1
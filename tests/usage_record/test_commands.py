@@ -0,0 +1,405 @@
+import io
+import json
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import pytest
+import pytz
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Count, F, Sum
+
+from tests.subscription.factories import SubscriptionFactory
+from tests.usage_record.factories import DataUsageRecordFactory, VoiceUsageRecordFactory
+from wingtel.usage import models
+from wingtel.usage.backends import MATERIALIZED_VIEW, SIGNALS, TRIGGERS
+from wingtel.usage.partitions import RawUsagePartitions
+from wingtel.usage.schema import sync_aggregation_backend
+
+pytestmark = pytest.mark.django_db
+
+
+class TestImportUsageCommand:
+    def test_import_csv(self, tmp_path):
+        subscription = SubscriptionFactory.create()
+        path = tmp_path / "data.csv"
+        path.write_text(
+            "usage_date,subscription_id,price,kilobytes_used\n"
+            f"2022-01-01T10:00:00+00:00,{subscription.id},1.50,100\n"
+            f"2022-01-01T23:00:00+00:00,{subscription.id},2.25,200\n"
+            f"2022-01-02T01:00:00+00:00,{subscription.id},3.00,300\n"
+        )
+        call_command("import_usage", str(path), record_type="data")
+
+        assert models.DataUsageRecord.objects.count() == 3
+        first_day, second_day = models.UsageRecord.objects.order_by("usage_date")
+        assert (first_day.price, first_day.used) == (Decimal("3.75"), 300)
+        assert (second_day.price, second_day.used) == (Decimal("3.00"), 300)
+
+    def test_import_ndjson_adds_to_existing_aggregates(self, tmp_path):
+        record = DataUsageRecordFactory.create(price=1, kilobytes_used=10)
+        lines = [
+            {
+                "subscription_id": record.subscription_id.id,
+                "price": "2.00",
+                "usage_date": record.usage_date.isoformat(),
+                "kilobytes_used": 20,
+            }
+        ] * 2
+        path = tmp_path / "data.ndjson"
+        path.write_text("\n".join(json.dumps(line) for line in lines))
+        call_command("import_usage", str(path), record_type="data")
+
+        usage_record = models.UsageRecord.objects.get()
+        assert models.DataUsageRecord.objects.count() == 3
+        assert (usage_record.price, usage_record.used) == (Decimal("5.00"), 50)
+
+    def test_import_voice_csv_with_used_column(self, tmp_path):
+        subscription = SubscriptionFactory.create()
+        path = tmp_path / "voice.csv"
+        path.write_text("subscription_id,price,usage_date,used\n" f"{subscription.id},1.00,2022-01-01,60\n")
+        call_command("import_usage", str(path), record_type="voice")
+
+        assert models.VoiceUsageRecord.objects.get().seconds_used == 60
+        usage_record = models.UsageRecord.objects.get()
+        assert usage_record.type_of_usage == models.UsageRecord.USAGE_TYPES.voice
+        assert usage_record.used == 60
+
+    @pytest.mark.django_db(transaction=True)
+    @pytest.mark.parametrize("row", ["{subscription_id},abc,2022-01-01,60", "0,1.00,2022-01-01,60"])
+    def test_import_invalid_rows(self, tmp_path, row):
+        subscription = SubscriptionFactory.create()
+        path = tmp_path / "data.csv"
+        path.write_text("subscription_id,price,usage_date,used\n" + row.format(subscription_id=subscription.id))
+        with pytest.raises(CommandError, match=str(path)):
+            call_command("import_usage", str(path), record_type="data")
+
+        assert not models.DataUsageRecord.objects.exists()
+        assert not models.UsageRecord.objects.exists()
+
+
+class TestRebuildUsageAggregatesCommand:
+    def corrupt_aggregates(self):
+        """Raw records written around the signals leave UsageRecord stale"""
+        records = DataUsageRecordFactory.create_batch(3, usage_date=datetime(2022, 1, 1, 12, tzinfo=pytz.utc))
+        records += VoiceUsageRecordFactory.create_batch(2, usage_date=datetime(2022, 1, 2, 12, tzinfo=pytz.utc))
+        models.UsageRecord.objects.update(price=0, used=0)
+        models.UsageRecord.objects.filter(usage_date=date(2022, 1, 2)).delete()
+        return records
+
+    def assert_aggregates_match(self, records):
+        assert models.UsageRecord.objects.count() == len(records)
+        for record in records:
+            usage_record = models.UsageRecord.objects.get(
+                subscription=record.subscription_id, usage_date=record.usage_date.date()
+            )
+            assert usage_record.price == record.price
+            assert usage_record.used == getattr(record, record.USED_FIELD)
+
+    def test_rebuild(self):
+        records = self.corrupt_aggregates()
+        call_command("rebuild_usage_aggregates", subscription_chunk_size=2)
+        self.assert_aggregates_match(records)
+
+    def test_rebuild_resumes_from_checkpoint(self):
+        records = self.corrupt_aggregates()
+        call_command("rebuild_usage_aggregates", date_from=date(2022, 1, 1), date_to=date(2022, 1, 1), job="rebuild")
+        models.UsageRecord.objects.filter(usage_date=date(2022, 1, 1)).update(price=0)
+        call_command("rebuild_usage_aggregates", date_from=date(2022, 1, 1), date_to=date(2022, 1, 2), job="rebuild")
+
+        assert models.UsageRecordRebuildCheckpoint.objects.filter(job="rebuild").count() == 2
+        # the first day is checkpointed, so it's not recomputed again
+        assert not models.UsageRecord.objects.filter(usage_date=date(2022, 1, 1)).exclude(price=0).exists()
+        call_command("rebuild_usage_aggregates", job="rebuild", restart=True)
+        self.assert_aggregates_match(records)
+
+    def test_rebuild_counts_pending_shards(self, settings):
+        settings.USAGE_AGGREGATION_SHARDS = 2
+        records = self.corrupt_aggregates()
+        DataUsageRecordFactory.create(subscription_id=records[0].subscription_id, usage_date=records[0].usage_date)
+        call_command("rebuild_usage_aggregates")
+        call_command("compact_usage_shards")
+
+        assert not models.UsageRecordShard.objects.exists()
+        usage_record = models.UsageRecord.objects.get(subscription=records[0].subscription_id)
+        assert usage_record.price == sum(
+            record.price for record in models.DataUsageRecord.objects.filter(subscription_id=records[0].subscription_id)
+        )
+
+    def test_rebuild_chunks_records_without_subscription(self):
+        record = DataUsageRecordFactory.create(subscription_id=None, usage_date=datetime(2022, 1, 1, tzinfo=pytz.utc))
+        models.UsageRecord.objects.update(price=0, used=0)
+        call_command("rebuild_usage_aggregates", subscription_chunk_size=2, stdout=io.StringIO())
+        self.assert_aggregates_match([record])
+
+    def test_rebuild_keeps_aggregates_of_dropped_records(self):
+        records = self.corrupt_aggregates()
+        dropped = DataUsageRecordFactory.create(usage_date=datetime(2021, 11, 30, tzinfo=pytz.utc))
+        kept = VoiceUsageRecordFactory.create(usage_date=dropped.usage_date)
+        RawUsagePartitions(models.DataUsageRecord).drop_before(date(2021, 12, 1))
+        models.UsageRecord.objects.filter(subscription=kept.subscription_id).update(price=0)
+
+        with pytest.raises(CommandError):
+            call_command("rebuild_usage_aggregates", date_from=date(2021, 11, 30), date_to=date(2021, 12, 1))
+        call_command("rebuild_usage_aggregates", stdout=io.StringIO())
+        # the voice aggregate is rebuilt from its raw record, the data one is the only copy of the dropped record
+        self.assert_aggregates_match(records + [kept, dropped])
+
+    @pytest.mark.django_db(transaction=True)
+    def test_rebuild_in_worker_processes(self):
+        records = self.corrupt_aggregates()
+        call_command("rebuild_usage_aggregates", workers=2, subscription_chunk_size=1)
+        self.assert_aggregates_match(records)
+
+
+class TestReconcileUsageAggregatesCommand:
+    usage_date = datetime(2022, 1, 1, 12, tzinfo=pytz.utc)
+
+    def create_drift(self):
+        """Writes around the signals, one subscription of the three is left in sync"""
+        drifted, in_sync, deleted = [DataUsageRecordFactory.create(usage_date=self.usage_date) for _ in range(3)]
+        models.DataUsageRecord.objects.filter(pk=drifted.pk).update(
+            price=F("price") + 1, kilobytes_used=F("kilobytes_used") + 5
+        )
+        models.DataUsageRecord.objects.bulk_create(
+            [
+                models.DataUsageRecord(
+                    subscription_id=drifted.subscription_id, price=2, usage_date=self.usage_date, kilobytes_used=7
+                )
+            ]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {models.DataUsageRecord._meta.db_table} WHERE id = %s", [deleted.pk])
+        return drifted, in_sync, deleted
+
+    def reconcile(self, **options) -> str:
+        stdout = io.StringIO()
+        call_command("reconcile_usage_aggregates", stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def assert_aggregates_match(self):
+        raw = models.DataUsageRecord.objects.values("subscription_id").annotate(
+            price=Sum("price"), used=Sum("kilobytes_used")
+        )
+        expected = {record["subscription_id"]: (record["price"], record["used"]) for record in raw}
+        for model, price, used in [
+            (models.UsageRecord, "price", "used"),
+            (models.UsageRecordTotal, "total_price", "total_used"),
+        ]:
+            stored = model.objects.exclude(**{price: 0, used: 0}).values_list("subscription_id", price, used)
+            assert {subscription_id: (price, used) for subscription_id, price, used in stored} == expected
+
+    def test_reconcile_repairs_mismatched_chunks(self):
+        self.create_drift()
+        output = self.reconcile(subscription_chunk_size=1)
+
+        assert "2022-01-01: 2 of 3 chunks mismatched, 2 aggregates repaired" in output
+        self.assert_aggregates_match()
+        assert "0 mismatched" in self.reconcile()
+
+    def test_reconcile_repairs_records_without_subscription(self):
+        DataUsageRecordFactory.create(usage_date=self.usage_date, subscription_id=None, price=3)
+        models.UsageRecord.objects.update(price=0)
+        output = self.reconcile(subscription_chunk_size=1)
+
+        assert "1 mismatched: 1 aggregates repaired" in output
+        assert models.UsageRecord.objects.get(subscription=None).price == 3
+
+    def test_dry_run_reports_drift(self):
+        drifted, _, deleted = self.create_drift()
+        output = self.reconcile(subscription_chunk_size=1, dry_run=True)
+
+        price_drift, used_drift = 1 + 2 + deleted.price, 5 + 7 + deleted.kilobytes_used
+        assert f"2 mismatched: 2 aggregates drifted, price drift {price_drift:.2f}, used drift {used_drift}" in output
+        assert models.UsageRecord.objects.get(subscription=deleted.subscription_id).price == deleted.price
+
+    def test_reconcile_counts_pending_shards(self, settings):
+        settings.USAGE_AGGREGATION_SHARDS = 2
+        DataUsageRecordFactory.create_batch(2, usage_date=self.usage_date)
+        assert "0 mismatched" in self.reconcile()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_reconcile_in_worker_processes(self):
+        self.create_drift()
+        DataUsageRecordFactory.create(usage_date=self.usage_date + timedelta(days=1))
+        models.DataUsageRecord.objects.update(price=1)
+        self.reconcile(workers=2)
+        self.assert_aggregates_match()
+
+    def test_reconcile_needs_stored_aggregates(self, settings):
+        settings.USAGE_AGGREGATION_BACKEND = MATERIALIZED_VIEW
+        with pytest.raises(CommandError):
+            self.reconcile()
+
+
+@pytest.mark.parametrize("aggregation_backend", [SIGNALS, TRIGGERS], indirect=True)
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+class TestArchiveRawUsageCommand:
+    @pytest.fixture(autouse=True)
+    def archive_format(self, aggregation_backend, file_format):
+        if file_format == "parquet":
+            pytest.importorskip("pyarrow")
+
+    def get_raw_records(self):
+        return sorted(
+            (record_type, *values)
+            for record_type, model in models.UsageRecord.RAW_MODELS.items()
+            for values in model.objects.values_list("id", "subscription_id", "price", "usage_date", model.USED_FIELD)
+        )
+
+    def get_aggregates(self):
+        return sorted(models.UsageRecord.objects.values_list("subscription_id", "usage_date", "price", "used"))
+
+    def test_archive_and_restore(self, tmp_path, file_format):
+        first_day = datetime(2022, 1, 1, 12, tzinfo=pytz.utc)
+        DataUsageRecordFactory.create_batch(2, usage_date=first_day)
+        VoiceUsageRecordFactory.create(usage_date=first_day)
+        DataUsageRecordFactory.create(usage_date=first_day + timedelta(days=1))
+        recent = DataUsageRecordFactory.create(usage_date=datetime(2022, 1, 3, tzinfo=pytz.utc))
+        raw_records, aggregates = self.get_raw_records(), self.get_aggregates()
+
+        options = {"directory": str(tmp_path), "file_format": file_format, "delete_batch_size": 1}
+        call_command("archive_raw_usage", before=date(2022, 1, 3), stdout=io.StringIO(), **options)
+        assert [record[1] for record in self.get_raw_records()] == [recent.pk]
+        assert self.get_aggregates() == aggregates
+        manifest = json.loads((tmp_path / "manifest.json").read_text())["files"]
+        assert sorted((entry["type_of_usage"], entry["usage_date"], entry["rows"]) for entry in manifest) == [
+            ("data", "2022-01-01", 2),
+            ("data", "2022-01-02", 1),
+            ("voice", "2022-01-01", 1),
+        ]
+        assert set(models.RawUsageRemoval.objects.values_list("type_of_usage", "reason", "date_from", "date_to")) == {
+            (record_type, models.RawUsageRemoval.REASONS.archive, day, day)
+            for record_type, day in [
+                (models.UsageRecord.USAGE_TYPES.data, date(2022, 1, 1)),
+                (models.UsageRecord.USAGE_TYPES.data, date(2022, 1, 2)),
+                (models.UsageRecord.USAGE_TYPES.voice, date(2022, 1, 1)),
+            ]
+        }
+
+        days = {"date_from": date(2022, 1, 1), "date_to": date(2022, 1, 2)}
+        call_command("restore_raw_usage", directory=str(tmp_path), **days)
+        assert self.get_raw_records() == raw_records
+        assert self.get_aggregates() == aggregates
+        assert json.loads((tmp_path / "manifest.json").read_text())["files"] == []
+        assert not models.RawUsageRemoval.objects.exists()
+        assert not list(tmp_path.glob("*/*"))
+
+    def test_rebuild_keeps_aggregates_of_archived_days(self, tmp_path, file_format):
+        DataUsageRecordFactory.create(usage_date=datetime(2022, 1, 1, 12, tzinfo=pytz.utc))
+        aggregates = self.get_aggregates()
+        options = {"directory": str(tmp_path), "file_format": file_format, "before": date(2022, 1, 2)}
+        call_command("archive_raw_usage", stdout=io.StringIO(), **options)
+
+        call_command("rebuild_usage_aggregates", stdout=io.StringIO())
+        assert self.get_aggregates() == aggregates
+        with pytest.raises(CommandError):
+            call_command("rebuild_usage_aggregates", date_from=date(2022, 1, 1), date_to=date(2022, 1, 1))
+
+    def test_reconcile_keeps_aggregates_of_archived_days(self, tmp_path, file_format):
+        usage_date = datetime(2022, 1, 2, 12, tzinfo=pytz.utc)
+        DataUsageRecordFactory.create(usage_date=usage_date, price=5)
+        VoiceUsageRecordFactory.create(usage_date=usage_date)
+        DataUsageRecordFactory.create(usage_date=usage_date + timedelta(days=1))
+        rollups = [
+            sorted(models.MonthlyUsageRecord.objects.values_list("subscription_id", "type_of_usage", "price", "used")),
+            sorted(models.UsageRecordTotal.objects.values_list("subscription_id", "type_of_usage", "total_price")),
+        ]
+        aggregates = self.get_aggregates()
+        options = {"directory": str(tmp_path), "file_format": file_format, "type_of_usage": "data"}
+        call_command("archive_raw_usage", before=date(2022, 1, 3), stdout=io.StringIO(), **options)
+
+        stdout = io.StringIO()
+        call_command("reconcile_usage_aggregates", stdout=stdout)
+        assert "Checked 2 days in 2 chunks, 0 mismatched" in stdout.getvalue()
+        assert self.get_aggregates() == aggregates
+        assert rollups == [
+            sorted(models.MonthlyUsageRecord.objects.values_list("subscription_id", "type_of_usage", "price", "used")),
+            sorted(models.UsageRecordTotal.objects.values_list("subscription_id", "type_of_usage", "total_price")),
+        ]
+        with pytest.raises(CommandError):
+            call_command("reconcile_usage_aggregates", date_from=date(2022, 1, 1))
+
+    def test_late_records_get_another_part(self, tmp_path, file_format):
+        usage_date = datetime(2022, 1, 1, 12, tzinfo=pytz.utc)
+        DataUsageRecordFactory.create(usage_date=usage_date)
+        options = {"directory": str(tmp_path), "file_format": file_format, "before": date(2022, 1, 2)}
+        call_command("archive_raw_usage", stdout=io.StringIO(), **options)
+        DataUsageRecordFactory.create(usage_date=usage_date)
+        call_command("archive_raw_usage", stdout=io.StringIO(), **options)
+
+        assert not models.DataUsageRecord.objects.exists()
+        stdout = io.StringIO()
+        days = {"date_from": date(2022, 1, 1), "date_to": date(2022, 1, 1)}
+        call_command("restore_raw_usage", directory=str(tmp_path), stdout=stdout, **days)
+        assert "Restored 2 raw usage records" in stdout.getvalue()
+        assert models.DataUsageRecord.objects.count() == 2
+
+
+class TestGenerateUsageCommand:
+    def get_raw_records(self):
+        return sorted(
+            (record_type, *values)
+            for record_type, model in models.UsageRecord.RAW_MODELS.items()
+            for values in model.objects.values_list("subscription_id", "price", "usage_date", model.USED_FIELD)
+        )
+
+    def test_generate(self):
+        call_command("generate_usage", records=500, subscriptions=20, date_from=date(2022, 1, 20), batch_size=100)
+
+        assert models.DataUsageRecord.objects.count() == 350
+        assert models.VoiceUsageRecord.objects.count() == 150
+        for record_type, model in models.UsageRecord.RAW_MODELS.items():
+            raw = model.objects.aggregate(price=Sum("price"), used=Sum(model.USED_FIELD))
+            daily = models.UsageRecord.objects.filter(type_of_usage=record_type).aggregate(
+                price=Sum("price"), used=Sum("used")
+            )
+            assert raw == daily
+        # zipfian activity, the most active subscription has much more than an even share of records
+        most_active = models.UsageRecord.objects.values("subscription").annotate(used=Count("id")).order_by("-used")
+        assert most_active[0]["used"] > 2 * most_active.last()["used"]
+
+    def test_generate_is_reproducible(self):
+        SubscriptionFactory.create_batch(5)
+        options = {"records": 100, "subscriptions": 0, "date_from": date(2022, 1, 1), "date_to": date(2022, 2, 28)}
+        call_command("generate_usage", seed=1, **options)
+        first_run = self.get_raw_records()
+        for model in models.UsageRecord.RAW_MODELS.values():
+            model.objects.all().delete()
+        call_command("generate_usage", seed=1, **options)
+
+        assert self.get_raw_records() == first_run
+
+
+class TestRefreshUsageViewCommand:
+    def test_refresh(self, settings):
+        settings.USAGE_AGGREGATION_BACKEND = MATERIALIZED_VIEW
+        sync_aggregation_backend()
+        records = DataUsageRecordFactory.create_batch(2)
+        call_command("refresh_usage_view")
+
+        assert models.UsageRecordMaterializedView.objects.aggregate(price=Sum("price")) == {
+            "price": sum(record.price for record in records)
+        }
+
+    def test_refresh_needs_materialized_view_backend(self):
+        with pytest.raises(CommandError):
+            call_command("refresh_usage_view")
+
+
+class TestExportUsageCommand:
+    def test_export_parquet(self, tmp_path):
+        pyarrow = pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+
+        records = DataUsageRecordFactory.create_batch(3, usage_date=datetime(2022, 1, 1, 12, tzinfo=pytz.utc))
+        DataUsageRecordFactory.create(usage_date=datetime(2022, 2, 1, 12, tzinfo=pytz.utc))
+        path = tmp_path / "usage.parquet"
+        call_command("export_usage", str(path), file_format="parquet", date_to=date(2022, 1, 31), batch_size=2)
+
+        parquet_file = pyarrow.parquet.ParquetFile(str(path))
+        assert parquet_file.num_row_groups == 2
+        table = parquet_file.read()
+        assert table.column("price").to_pylist() == [
+            record.price for record in sorted(records, key=lambda record: record.subscription_id_id)
+        ]
@@ -6,8 +6,10 @@ import pytz
 from tests.subscription.factories import SubscriptionFactory
 from tests.usage_record.factories import DataUsageRecordFactory, VoiceUsageRecordFactory
 from wingtel.usage import models
+from wingtel.usage.backends import VIEW
+from wingtel.usage.selectors import get_daily_usage_records
 
-pytestmark = pytest.mark.django_db
+pytestmark = [pytest.mark.django_db, pytest.mark.usefixtures("aggregation_backend")]
 
 
 @pytest.mark.parametrize(
@@ -17,9 +19,9 @@ pytestmark = pytest.mark.django_db
         (models.UsageRecord.USAGE_TYPES.voice, VoiceUsageRecordFactory),
     ],
 )
-def test_create_one_usage_record(record_type: str, factory_record_class):
+def test_create_one_usage_record(record_type: int, factory_record_class):
     record = factory_record_class.create()
-    usage_record = models.UsageRecord.objects.all().first()
+    usage_record = get_daily_usage_records().all().first()
     assert usage_record
     assert usage_record.type_of_usage == record_type
     assert usage_record.subscription == record.subscription_id
@@ -38,10 +40,10 @@ def test_create_one_usage_record(record_type: str, factory_record_class):
         (models.UsageRecord.USAGE_TYPES.voice, VoiceUsageRecordFactory),
     ],
 )
-def test_create_two_usage_records(record_type: str, factory_record_class):
+def test_create_two_usage_records(record_type: int, factory_record_class):
     first_record = factory_record_class.create()
     second_record = factory_record_class.create(subscription_id=first_record.subscription_id)
-    usage_record = models.UsageRecord.objects.all().first()
+    usage_record = get_daily_usage_records().all().first()
     assert usage_record
     assert usage_record.type_of_usage == record_type
     assert usage_record.subscription == first_record.subscription_id == second_record.subscription_id
@@ -56,8 +58,8 @@ def test_create_different_types_usage_records():
     """Create usage records with different types"""
     data_record = DataUsageRecordFactory.create()
     voice_record = VoiceUsageRecordFactory.create()
-    data_usage_record = models.UsageRecord.objects.filter(type_of_usage=models.UsageRecord.USAGE_TYPES.data).first()
-    voice_usage_record = models.UsageRecord.objects.filter(type_of_usage=models.UsageRecord.USAGE_TYPES.voice).first()
+    data_usage_record = get_daily_usage_records().filter(type_of_usage=models.UsageRecord.USAGE_TYPES.data).first()
+    voice_usage_record = get_daily_usage_records().filter(type_of_usage=models.UsageRecord.USAGE_TYPES.voice).first()
     assert data_usage_record
     assert voice_usage_record
     assert data_usage_record.subscription == data_record.subscription_id
@@ -74,8 +76,8 @@ def test_create_different_subscription_usage_records():
     second_subscription = SubscriptionFactory.create(user=first_subscription.user)
     first_record = DataUsageRecordFactory.create(subscription_id=first_subscription)
     second_record = DataUsageRecordFactory.create(subscription_id=second_subscription)
-    first_data_usage_record = models.UsageRecord.objects.filter(subscription=first_subscription).first()
-    second_data_usage_record = models.UsageRecord.objects.filter(subscription=second_subscription).first()
+    first_data_usage_record = get_daily_usage_records().filter(subscription=first_subscription).first()
+    second_data_usage_record = get_daily_usage_records().filter(subscription=second_subscription).first()
     assert first_data_usage_record
     assert second_data_usage_record
     assert first_data_usage_record.subscription == first_record.subscription_id
@@ -92,8 +94,8 @@ def test_create_different_usage_date_usage_records():
     yesterday = today - timedelta(days=1)
     first_record = DataUsageRecordFactory.create(usage_date=today)
     second_record = DataUsageRecordFactory.create(usage_date=yesterday)
-    first_data_usage_record = models.UsageRecord.objects.filter(usage_date=today).first()
-    second_data_usage_record = models.UsageRecord.objects.filter(usage_date=yesterday).first()
+    first_data_usage_record = get_daily_usage_records().filter(usage_date=today).first()
+    second_data_usage_record = get_daily_usage_records().filter(usage_date=yesterday).first()
     assert first_data_usage_record
     assert second_data_usage_record
     assert first_data_usage_record.subscription == first_record.subscription_id
@@ -111,7 +113,7 @@ def test_create_different_usage_date_usage_records():
         (models.UsageRecord.USAGE_TYPES.voice, VoiceUsageRecordFactory, -100, -100),
     ],
 )
-def test_update_one_usage_record(record_type: str, factory_record_class, price_update: int, used_update: int):
+def test_update_one_usage_record(record_type: int, factory_record_class, price_update: int, used_update: int):
     record = factory_record_class.create()
 
     record.price += price_update
@@ -122,7 +124,7 @@ def test_update_one_usage_record(record_type: str, factory_record_class, price_u
         record.seconds_used += used_update
         new_fields = ["seconds_used"]
     record.save(update_fields=["price"] + new_fields)
-    usage_record = models.UsageRecord.objects.all().first()
+    usage_record = get_daily_usage_records().all().first()
     assert usage_record
     assert usage_record.type_of_usage == record_type
     assert usage_record.subscription == record.subscription_id
@@ -141,11 +143,10 @@ def test_update_one_usage_record(record_type: str, factory_record_class, price_u
         (models.UsageRecord.USAGE_TYPES.voice, VoiceUsageRecordFactory),
     ],
 )
-def test_delete_one_usage_record(record_type: str, factory_record_class):
+def test_delete_one_usage_record(aggregation_backend: str, record_type: int, factory_record_class):
     record = factory_record_class.create()
     record.delete()
-    usage_record = models.UsageRecord.objects.all().first()
     assert factory_record_class._meta.model.objects.all().count() == 0
-    assert usage_record
-    assert usage_record.price == 0
-    assert usage_record.used == 0
+    # the view has no rows without raw records, stored aggregates are kept with zero values
+    expected = [] if aggregation_backend == VIEW else [(0, 0)]
+    assert list(get_daily_usage_records().values_list("price", "used")) == expected
@@ -0,0 +1,79 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+import pytz
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.utils import timezone
+
+from tests.usage_record.factories import DataUsageRecordFactory
+from wingtel.usage import models
+from wingtel.usage.backends import VIEW
+from wingtel.usage.partitions import RawUsagePartitions
+from wingtel.usage.utils import add_months
+
+pytestmark = pytest.mark.django_db
+
+
+def get_partition_name(record) -> str:
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT tableoid::regclass::text FROM {record._meta.db_table} WHERE id = %s", [record.id])
+        return cursor.fetchone()[0]
+
+
+def test_future_partitions_are_created_on_migrate():
+    current = timezone.now().date().replace(day=1)
+    months = RawUsagePartitions(models.DataUsageRecord).get_months()
+    assert {add_months(current, months) for months in range(4)} <= set(months)
+
+
+def test_record_lands_in_its_month_partition():
+    record = DataUsageRecordFactory.create(usage_date=timezone.now())
+    assert get_partition_name(record) == f"usage_datausagerecord_p{timezone.now():%Y_%m}"
+
+
+def test_create_partition_moves_rows_from_default():
+    partitions = RawUsagePartitions(models.DataUsageRecord)
+    record = DataUsageRecordFactory.create(usage_date=datetime(2010, 5, 10, tzinfo=pytz.utc))
+    assert get_partition_name(record) == "usage_datausagerecord_default"
+
+    assert partitions.create(date(2010, 5, 1)) == "usage_datausagerecord_p2010_05"
+    assert get_partition_name(record) == "usage_datausagerecord_p2010_05"
+    assert date(2010, 5, 1) in partitions.get_months()
+
+
+def test_drop_expired_partitions_keeps_aggregates():
+    partitions = RawUsagePartitions(models.DataUsageRecord)
+    partitions.create(date(2010, 5, 1))
+    expired = DataUsageRecordFactory.create(usage_date=datetime(2010, 5, 10, tzinfo=pytz.utc))
+    expired_default = DataUsageRecordFactory.create(usage_date=datetime(2010, 4, 10, tzinfo=pytz.utc))
+    kept = DataUsageRecordFactory.create(usage_date=timezone.now())
+
+    call_command("drop_usage_partitions", keep_months=1)
+
+    assert list(models.DataUsageRecord.objects.values_list("id", flat=True)) == [kept.id]
+    assert date(2010, 5, 1) not in partitions.get_months()
+    assert models.UsageRecord.objects.filter(subscription=expired.subscription_id).exists()
+    assert models.UsageRecord.objects.filter(subscription=expired_default.subscription_id).exists()
+    cutoff = add_months(timezone.now().date().replace(day=1), -1)
+    assert set(models.RawUsageRemoval.objects.values_list("type_of_usage", "reason", "date_from", "date_to")) == {
+        (record_type, models.RawUsageRemoval.REASONS.retention, None, cutoff - timedelta(days=1))
+        for record_type in models.UsageRecord.RAW_MODELS
+    }
+
+
+def test_drop_expired_partitions_needs_stored_aggregates(settings):
+    settings.USAGE_AGGREGATION_BACKEND = VIEW
+    record = DataUsageRecordFactory.create(usage_date=datetime(2010, 4, 10, tzinfo=pytz.utc))
+
+    with pytest.raises(CommandError):
+        call_command("drop_usage_partitions", keep_months=1)
+    assert models.DataUsageRecord.objects.filter(id=record.id).exists()
+
+
+def test_longer_retention_keeps_the_recorded_cutoff():
+    partitions = RawUsagePartitions(models.DataUsageRecord)
+    partitions.drop_before(date(2010, 6, 1))
+    partitions.drop_before(date(2010, 5, 1))
+
+    assert models.RawUsageRemoval.objects.get().date_to == date(2010, 5, 31)
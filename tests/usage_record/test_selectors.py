@@ -0,0 +1,173 @@
+import random
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import pytest
+import pytz
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+
+from tests.subscription.factories import SubscriptionFactory
+from wingtel.usage import models
+from wingtel.usage.selectors import (
+    count_time_series_buckets,
+    get_top_usage_subscriptions,
+    get_usage_records_group_by_subscription_id,
+    get_usage_records_with_exceeded_price,
+    get_usage_time_series,
+    get_whole_months,
+)
+from wingtel.usage.services import BulkCreateUsageRecordService
+
+pytestmark = pytest.mark.django_db
+
+FIRST_DAY = date(2021, 11, 20)
+LAST_DAY = date(2022, 4, 10)
+
+
+def get_daily_totals(subscription_id, type_of_usage=None, date_from=None, date_to=None):
+    """Reference path that sums daily records only"""
+    records = models.UsageRecord.objects.filter(subscription_id=subscription_id)
+    if type_of_usage:
+        records = records.filter(type_of_usage=type_of_usage)
+    if date_from:
+        records = records.filter(usage_date__gte=date_from)
+    if date_to:
+        records = records.filter(usage_date__lte=date_to)
+    return list(records.values("subscription_id").annotate(total_price=Sum("price"), total_used=Sum("used")))
+
+
+def create_random_usage(rnd: random.Random, subscription):
+    days = (LAST_DAY - FIRST_DAY).days
+    for record_type, model in models.UsageRecord.RAW_MODELS.items():
+        records = [
+            model(
+                subscription_id=subscription,
+                price=Decimal(rnd.randint(0, 99999)) / 100,
+                usage_date=datetime.combine(FIRST_DAY, datetime.min.time(), pytz.utc)
+                + timedelta(days=rnd.randint(0, days), hours=rnd.randint(0, 23)),
+                **{model.USED_FIELD: rnd.randint(0, 1000)},
+            )
+            for _ in range(300)
+        ]
+        BulkCreateUsageRecordService(records, record_type).create()
+
+
+def get_random_date(rnd: random.Random):
+    if rnd.random() < 0.15:
+        return None
+    day = FIRST_DAY + timedelta(days=rnd.randint(-20, (LAST_DAY - FIRST_DAY).days + 20))
+    # month edges are the interesting cases
+    return rnd.choice([day, day.replace(day=1), day.replace(day=1) - timedelta(days=1)])
+
+
+@pytest.mark.parametrize(
+    "date_from,date_to,whole_months",
+    [
+        (date(2022, 1, 1), date(2022, 3, 31), (date(2022, 1, 1), date(2022, 3, 1))),
+        (date(2022, 1, 2), date(2022, 3, 30), (date(2022, 2, 1), date(2022, 2, 1))),
+        (date(2022, 1, 2), date(2022, 1, 30), (date(2022, 2, 1), date(2021, 12, 1))),
+        (date(2021, 12, 31), date(2022, 2, 28), (date(2022, 1, 1), date(2022, 2, 1))),
+        (None, date(2022, 2, 27), (None, date(2022, 1, 1))),
+        (date(2022, 2, 27), None, (date(2022, 3, 1), None)),
+        (None, None, (None, None)),
+    ],
+)
+def test_get_whole_months(date_from, date_to, whole_months):
+    assert get_whole_months(date_from, date_to) == whole_months
+
+
+def test_monthly_rollup_matches_daily_records():
+    rnd = random.Random(42)
+    subscription = SubscriptionFactory.create()
+    create_random_usage(rnd, subscription)
+    create_random_usage(rnd, SubscriptionFactory.create(user=subscription.user))
+
+    for _ in range(200):
+        date_from, date_to = get_random_date(rnd), get_random_date(rnd)
+        type_of_usage = rnd.choice([None, *models.UsageRecord.RAW_MODELS])
+        expected = get_daily_totals(subscription.id, type_of_usage, date_from, date_to)
+        result = get_usage_records_group_by_subscription_id(subscription.id, type_of_usage, date_from, date_to)
+        assert result == expected, (type_of_usage, date_from, date_to)
+
+
+@pytest.mark.parametrize(
+    "selector",
+    [
+        lambda subscription_id: get_usage_records_group_by_subscription_id(
+            subscription_id, date_from=date(2021, 12, 10), date_to=date(2022, 3, 5)
+        ),
+        lambda subscription_id: list(get_usage_records_with_exceeded_price(100)),
+        lambda subscription_id: get_top_usage_subscriptions(
+            "used", 10, models.UsageRecord.USAGE_TYPES.data, date(2021, 12, 10), date(2022, 3, 5)
+        ),
+        lambda subscription_id: get_top_usage_subscriptions(
+            "price", 10, models.UsageRecord.USAGE_TYPES.data, date(2021, 12, 10), date(2022, 3, 5), approximate=True
+        ),
+        lambda subscription_id: get_usage_time_series(subscription_id, "week", date(2021, 12, 10), date(2022, 3, 5)),
+    ],
+    ids=["usage_metrics", "price_limit", "top_usage", "top_usage_monthly", "time_series"],
+)
+def test_selectors_read_covering_indexes(selector):
+    """Aggregates are answered from the indexes alone, without heap lookups of visible pages"""
+    subscription = SubscriptionFactory.create()
+    create_random_usage(random.Random(0), subscription)
+    with CaptureQueriesContext(connection) as context:
+        selector(subscription.id)
+
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("SET LOCAL enable_bitmapscan = off")
+        for query in context.captured_queries:
+            cursor.execute(f"EXPLAIN {query['sql']}")
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            assert "Index Only Scan" in plan
+            assert "Index Scan" not in plan.replace("Index Only Scan", "")
+
+
+@pytest.mark.parametrize("bucket", ["day", "week", "month"])
+def test_time_series_matches_raw_records(settings, bucket):
+    """Every bucket of the range is returned once and pending shards are counted"""
+    settings.USAGE_AGGREGATION_SHARDS = 2
+    subscription = SubscriptionFactory.create()
+    create_random_usage(random.Random(7), subscription)
+    date_from, date_to = date(2021, 12, 10), date(2022, 3, 5)
+
+    series = get_usage_time_series(subscription.id, bucket, date_from, date_to)
+    assert len(series) == count_time_series_buckets(bucket, date_from, date_to)
+    assert models.UsageRecordShard.objects.exists()
+    for type_of_usage, model in models.UsageRecord.RAW_MODELS.items():
+        name = models.UsageRecord.USAGE_TYPE_NAMES[type_of_usage]
+        expected = model.objects.filter(usage_date__date__range=(date_from, date_to)).aggregate(
+            price=Sum("price"), used=Sum(model.USED_FIELD)
+        )
+        assert sum(item[f"{name}_price"] for item in series) == expected["price"]
+        assert sum(item[f"{name}_used"] for item in series) == expected["used"]
+
+
+def test_top_usage_counts_pending_shards(settings):
+    settings.USAGE_AGGREGATION_SHARDS = 2
+    subscriptions = SubscriptionFactory.create_batch(3)
+    for seed, subscription in enumerate(subscriptions):
+        create_random_usage(random.Random(seed), subscription)
+    date_from, date_to = date(2021, 12, 10), date(2022, 3, 5)
+
+    top = get_top_usage_subscriptions("price", 2, date_from=date_from, date_to=date_to)
+    assert models.UsageRecordShard.objects.exists()
+    prices = {
+        subscription.id: sum(
+            model.objects.filter(subscription_id=subscription, usage_date__date__range=(date_from, date_to)).aggregate(
+                price=Sum("price")
+            )["price"]
+            for model in models.UsageRecord.RAW_MODELS.values()
+        )
+        for subscription in subscriptions
+    }
+    expected = sorted(((price, subscription_id) for subscription_id, price in prices.items()), reverse=True)
+    assert [(item["total_price"], item["subscription_id"]) for item in top] == expected[:2]
+
+
+def test_approximate_top_usage_needs_type_of_usage():
+    with pytest.raises(ValueError):
+        get_top_usage_subscriptions("used", 10, approximate=True)
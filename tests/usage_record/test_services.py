@@ -0,0 +1,349 @@
+import threading
+from datetime import date, datetime, timedelta
+
+import pytest
+import pytz
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+
+from tests.subscription.factories import SubscriptionFactory
+from tests.usage_record.factories import DataUsageRecordFactory, VoiceUsageRecordFactory
+from wingtel.plans.models import Plan
+from wingtel.usage import models
+from wingtel.usage.backends import (
+    MATERIALIZED_VIEW,
+    SIGNALS,
+    TRIGGERS,
+    skip_database_aggregation,
+)
+from wingtel.usage.schema import sync_aggregation_backend
+from wingtel.usage.selectors import (
+    get_daily_usage_records,
+    get_usage_records_group_by_subscription_id,
+    get_usage_records_with_exceeded_price,
+    get_usage_refreshed_at,
+)
+from wingtel.usage.services import (
+    BulkCreateUsageRecordService,
+    CompactUsageRecordShardsService,
+    RefreshUsageRecordMaterializedViewService,
+    deferred_usage_aggregation,
+)
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.mark.parametrize(
+    "record_type,factory_record_class",
+    [
+        (models.UsageRecord.USAGE_TYPES.data, DataUsageRecordFactory),
+        (models.UsageRecord.USAGE_TYPES.voice, VoiceUsageRecordFactory),
+    ],
+)
+def test_bulk_create_usage_records(record_type: int, factory_record_class):
+    subscription = SubscriptionFactory.create()
+    today = datetime.now(pytz.utc)
+    yesterday = today - timedelta(days=1)
+    records = [
+        factory_record_class.build(subscription_id=subscription, usage_date=usage_date)
+        for usage_date in (today, today, yesterday)
+    ]
+    BulkCreateUsageRecordService(records, record_type).create()
+
+    used_field = models.UsageRecord.RAW_MODELS[record_type].USED_FIELD
+    assert factory_record_class._meta.model.objects.count() == 3
+    assert models.UsageRecord.objects.count() == 2
+    today_record = models.UsageRecord.objects.get(usage_date=today.date())
+    yesterday_record = models.UsageRecord.objects.get(usage_date=yesterday.date())
+    assert today_record.type_of_usage == record_type
+    assert today_record.price == records[0].price + records[1].price
+    assert today_record.used == getattr(records[0], used_field) + getattr(records[1], used_field)
+    assert yesterday_record.price == records[2].price
+    assert yesterday_record.used == getattr(records[2], used_field)
+
+
+def test_bulk_create_updates_existing_usage_record():
+    record = DataUsageRecordFactory.create()
+    new_records = DataUsageRecordFactory.build_batch(
+        2, subscription_id=record.subscription_id, usage_date=record.usage_date
+    )
+    BulkCreateUsageRecordService(new_records, models.UsageRecord.USAGE_TYPES.data).create()
+
+    usage_record = models.UsageRecord.objects.get()
+    assert usage_record.price == sum(item.price for item in [record] + new_records)
+    assert usage_record.used == sum(item.kilobytes_used for item in [record] + new_records)
+
+
+@pytest.mark.parametrize("aggregation_backend", [SIGNALS, TRIGGERS], indirect=True)
+def test_records_without_subscription_share_aggregates(aggregation_backend):
+    usage_date = datetime(2022, 1, 1, tzinfo=pytz.utc)
+    records = DataUsageRecordFactory.create_batch(2, subscription_id=None, usage_date=usage_date)
+    VoiceUsageRecordFactory.create(subscription_id=None, usage_date=usage_date)
+
+    usage_record = models.UsageRecord.objects.get(type_of_usage=models.UsageRecord.USAGE_TYPES.data)
+    assert usage_record.subscription_id is None
+    assert usage_record.price == sum(record.price for record in records)
+    assert models.MonthlyUsageRecord.objects.count() == 2
+    assert models.UsageRecordTotal.objects.count() == 2
+
+
+def test_bulk_create_runs_constant_number_of_queries():
+    subscriptions = SubscriptionFactory.create_batch(5)
+    queries_count = []
+    for size in (10, 100):
+        records = [
+            DataUsageRecordFactory.build(subscription_id=subscriptions[index % len(subscriptions)])
+            for index in range(size)
+        ]
+        with CaptureQueriesContext(connection) as context:
+            BulkCreateUsageRecordService(records, models.UsageRecord.USAGE_TYPES.data, batch_size=None).create()
+        queries_count.append(len(context.captured_queries))
+    assert queries_count[0] == queries_count[1]
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("shards", [0, 4])
+def test_concurrent_saves_keep_aggregate_exact(settings, shards):
+    """Writers for the same subscription and day must not lose updates or duplicate the aggregate"""
+    settings.USAGE_AGGREGATION_SHARDS = shards
+    threads_count, records_per_thread = 8, 25
+    subscription = SubscriptionFactory.create()
+    usage_date = datetime.now(pytz.utc)
+    barrier = threading.Barrier(threads_count)
+    errors = []
+
+    def write_records():
+        try:
+            barrier.wait()
+            for _ in range(records_per_thread):
+                DataUsageRecordFactory.create(subscription_id=subscription, usage_date=usage_date)
+        except Exception as error:  # pragma: no cover
+            errors.append(error)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=write_records) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    CompactUsageRecordShardsService().compact()
+    records = models.DataUsageRecord.objects.filter(subscription_id=subscription)
+    assert records.count() == threads_count * records_per_thread
+    usage_record = models.UsageRecord.objects.get(subscription=subscription)
+    assert usage_record.price == sum(record.price for record in records)
+    assert usage_record.used == sum(record.kilobytes_used for record in records)
+
+
+def test_update_moves_record_to_another_day():
+    today = datetime.now(pytz.utc)
+    yesterday = today - timedelta(days=1)
+    record = DataUsageRecordFactory.create(usage_date=today)
+    record.usage_date = yesterday
+    record.save()
+
+    assert models.UsageRecord.objects.get(usage_date=today.date()).price == 0
+    assert models.UsageRecord.objects.get(usage_date=yesterday.date()).price == record.price
+
+
+def test_rollups_follow_daily_records():
+    today = datetime.now(pytz.utc)
+    record = DataUsageRecordFactory.create(usage_date=today)
+    DataUsageRecordFactory.create(subscription_id=record.subscription_id, usage_date=today - timedelta(days=40))
+    VoiceUsageRecordFactory.create(subscription_id=record.subscription_id, usage_date=today)
+    record.price += 1
+    record.save()
+    VoiceUsageRecordFactory._meta.model.objects.get().delete()
+
+    for type_of_usage in models.UsageRecord.RAW_MODELS:
+        daily = models.UsageRecord.objects.filter(type_of_usage=type_of_usage).aggregate(
+            price=Sum("price"), used=Sum("used")
+        )
+        monthly = models.MonthlyUsageRecord.objects.filter(type_of_usage=type_of_usage).aggregate(
+            price=Sum("price"), used=Sum("used")
+        )
+        total = models.UsageRecordTotal.objects.get(type_of_usage=type_of_usage, subscription=record.subscription_id)
+        assert daily == monthly == {"price": total.total_price, "used": total.total_used}
+
+
+def test_sharded_writes_are_read_before_and_after_compaction(settings):
+    settings.USAGE_AGGREGATION_SHARDS = 4
+    today = datetime.now(pytz.utc)
+    record = DataUsageRecordFactory.create(usage_date=today, price=200)
+    DataUsageRecordFactory.create(subscription_id=record.subscription_id, usage_date=today, price=300)
+    subscription_id = record.subscription_id.id
+
+    def read():
+        return (
+            get_usage_records_group_by_subscription_id(subscription_id, date_from=today.date()),
+            list(get_usage_records_with_exceeded_price(100)),
+        )
+
+    assert not models.UsageRecord.objects.exists()
+    assert models.UsageRecordShard.objects.count() == 1
+    pending = read()
+    assert pending[1] == [
+        {
+            "type_of_usage": models.UsageRecord.USAGE_TYPES.data,
+            "subscription_id": subscription_id,
+            "price_exceeded": 400,
+        }
+    ]
+
+    assert CompactUsageRecordShardsService(batch_size=1).compact() == 1
+    assert not models.UsageRecordShard.objects.exists()
+    assert models.UsageRecord.objects.get().price == 500
+    assert models.MonthlyUsageRecord.objects.get().price == 500
+    assert read() == pending
+
+
+def test_sharded_price_limit_adds_pending_shards_of_every_key(settings):
+    settings.USAGE_AGGREGATION_SHARDS = 4
+    today = datetime.now(pytz.utc)
+    below = DataUsageRecordFactory.create(usage_date=today, price=90)
+    DataUsageRecordFactory.create(usage_date=today, price=50)
+    CompactUsageRecordShardsService().compact()
+    DataUsageRecordFactory.create(subscription_id=below.subscription_id, usage_date=today, price=20)
+    DataUsageRecordFactory.create(subscription_id=None, usage_date=today, price=150)
+
+    records = get_usage_records_with_exceeded_price(100).order_by("subscription_id")
+    assert list(records) == [
+        {
+            "type_of_usage": models.UsageRecord.USAGE_TYPES.data,
+            "subscription_id": subscription_id,
+            "price_exceeded": price,
+        }
+        for subscription_id, price in ((below.subscription_id.id, 10), (None, 50))
+    ]
+
+
+def test_deferred_aggregation_writes_once_per_block():
+    subscriptions = SubscriptionFactory.create_batch(5)
+    today = datetime.now(pytz.utc)
+    with CaptureQueriesContext(connection) as context:
+        with deferred_usage_aggregation():
+            records = [
+                DataUsageRecordFactory.create(subscription_id=subscriptions[index % 5], usage_date=today)
+                for index in range(50)
+            ]
+            records[0].price += 1
+            records[0].save()
+            records.pop().delete()
+            assert not models.UsageRecord.objects.exists()
+
+    upserts = [query for query in context.captured_queries if "ON CONFLICT" in query["sql"]]
+    assert len(upserts) == 1
+    for subscription in subscriptions:
+        usage_record = models.UsageRecord.objects.get(subscription=subscription)
+        subscription_records = [record for record in records if record.subscription_id == subscription]
+        assert usage_record.price == sum(record.price for record in subscription_records)
+        assert usage_record.used == sum(record.kilobytes_used for record in subscription_records)
+
+
+def test_deferred_aggregation_is_rolled_back_with_block():
+    with pytest.raises(ValueError):
+        with deferred_usage_aggregation():
+            DataUsageRecordFactory.create()
+            raise ValueError
+
+    assert not models.DataUsageRecord.objects.exists()
+    assert not models.UsageRecord.objects.exists()
+
+
+def test_deferred_aggregation_drops_deltas_of_rolled_back_savepoint():
+    subscription = SubscriptionFactory.create()
+    with deferred_usage_aggregation():
+        kept = DataUsageRecordFactory.create(
+            subscription_id=subscription, usage_date=datetime(2022, 1, 1, tzinfo=pytz.utc)
+        )
+        with pytest.raises(ValueError):
+            with transaction.atomic():
+                DataUsageRecordFactory.create(subscription_id=subscription, usage_date=kept.usage_date)
+                raise ValueError
+
+    assert models.DataUsageRecord.objects.get() == kept
+    usage_record = models.UsageRecord.objects.get()
+    assert (usage_record.price, usage_record.used) == (kept.price, kept.kilobytes_used)
+
+
+def test_bulk_writes_are_aggregated_once(aggregation_backend):
+    records = DataUsageRecordFactory.build_batch(3, subscription_id=SubscriptionFactory.create())
+    BulkCreateUsageRecordService(records, models.UsageRecord.USAGE_TYPES.data).create()
+    records[0].delete()
+
+    assert get_daily_usage_records().aggregate(price=Sum("price"), used=Sum("used")) == {
+        "price": records[1].price + records[2].price,
+        "used": records[1].kilobytes_used + records[2].kilobytes_used,
+    }
+
+
+def test_triggers_skip_aggregation(settings):
+    settings.USAGE_AGGREGATION_BACKEND = TRIGGERS
+    sync_aggregation_backend()
+    record = DataUsageRecordFactory.create()
+    with skip_database_aggregation():
+        models.DataUsageRecord.objects.filter(id=record.id).update(price=0)
+
+    assert models.UsageRecord.objects.get().price == record.price
+
+
+@pytest.mark.parametrize("concurrently", [True, False])
+def test_materialized_view_is_stale_until_refresh(settings, concurrently):
+    settings.USAGE_AGGREGATION_BACKEND = MATERIALIZED_VIEW
+    sync_aggregation_backend()
+    created_at = get_usage_refreshed_at()
+    record = DataUsageRecordFactory.create()
+
+    assert created_at
+    assert not get_daily_usage_records().exists()
+    assert not models.UsageRecord.objects.exists()
+    refreshed_at = RefreshUsageRecordMaterializedViewService(concurrently=concurrently).refresh()
+    assert refreshed_at == get_usage_refreshed_at() > created_at
+    usage_record = get_daily_usage_records().get()
+    assert (usage_record.subscription, usage_record.price, usage_record.used) == (
+        record.subscription_id,
+        record.price,
+        record.kilobytes_used,
+    )
+
+
+@pytest.mark.parametrize("aggregation_backend", [SIGNALS, TRIGGERS], indirect=True)
+def test_price_threshold_crossings_are_recorded_once(aggregation_backend):
+    subscription = SubscriptionFactory.create(plan=Plan.objects.create(name="basic"))
+    data = models.UsageRecord.USAGE_TYPES.data
+    total = models.PriceThreshold.objects.create(price_limit=100)
+    daily = models.PriceThreshold.objects.create(
+        price_limit=50, period="day", type_of_usage=data, subscription=subscription
+    )
+    monthly = models.PriceThreshold.objects.create(price_limit=50, period="month", plan=subscription.plan)
+    # not matching the record
+    models.PriceThreshold.objects.create(price_limit=1, type_of_usage=models.UsageRecord.USAGE_TYPES.voice)
+    models.PriceThreshold.objects.create(price_limit=1, plan=Plan.objects.create(name="other"))
+    models.PriceThreshold.objects.create(price_limit=1, is_active=False)
+    usage_date = datetime(2022, 1, 10, 12, tzinfo=pytz.utc)
+
+    first = DataUsageRecordFactory.create(subscription_id=subscription, usage_date=usage_date, price=60)
+    DataUsageRecordFactory.create(subscription_id=subscription, usage_date=usage_date, price=60)
+    first.delete()
+    DataUsageRecordFactory.create(subscription_id=subscription, usage_date=usage_date, price=60)
+
+    events = models.PriceThresholdEvent.objects.order_by("threshold_id")
+    assert [(event.threshold_id, event.period_start, event.price) for event in events] == [
+        (total.id, None, 120),
+        (daily.id, usage_date.date(), 60),
+        (monthly.id, date(2022, 1, 1), 60),
+    ]
+    assert {(event.subscription_id, event.type_of_usage) for event in events} == {(subscription.id, data)}
+
+
+def test_price_thresholds_of_sharded_writes_are_evaluated_by_compaction(settings):
+    settings.USAGE_AGGREGATION_SHARDS = 2
+    threshold = models.PriceThreshold.objects.create(price_limit=10)
+    DataUsageRecordFactory.create(price=20)
+
+    assert not models.PriceThresholdEvent.objects.exists()
+    CompactUsageRecordShardsService().compact()
+    assert models.PriceThresholdEvent.objects.get().threshold == threshold
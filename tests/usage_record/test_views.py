@@ -1,10 +1,20 @@
+import csv
+import io
+import json
+from datetime import date
+
 import pytest
 from django.urls import reverse
 
-from tests.usage_record.factories import UsageRecordFactory
-from wingtel.usage.models import UsageRecord
+from tests.subscription.factories import SubscriptionFactory
+from tests.usage_record.factories import DataUsageRecordFactory, UsageRecordFactory
+from wingtel.plans.models import Plan
+from wingtel.usage.backends import MATERIALIZED_VIEW, SIGNALS
+from wingtel.usage.models import PriceThreshold, UsageRecord
+from wingtel.usage.selectors import get_daily_usage_records
+from wingtel.usage.services import RefreshUsageRecordMaterializedViewService
 
-pytestmark = pytest.mark.django_db
+pytestmark = [pytest.mark.django_db, pytest.mark.usefixtures("aggregation_backend")]
 usage_price_limit_url = reverse("usage-price_limit")
 
 
@@ -21,7 +31,7 @@ class TestUsageRecordPriceLimitView:
         response = api_client.get(usage_price_limit_url, {"price_limit": price + 5})
         response_json = response.json()
 
-        assert UsageRecord.objects.all().count() == 2
+        assert get_daily_usage_records().count() == 2
         assert len(response_json) == 1
         record = response_json[0]
         assert record["price_exceeded"] == 5
@@ -31,22 +41,65 @@ class TestUsageRecordPriceLimitView:
         UsageRecordFactory.create(price=price, type_of_usage=UsageRecord.USAGE_TYPES.data)
         UsageRecordFactory.create(price=price, type_of_usage=UsageRecord.USAGE_TYPES.voice)
 
-        data_response = api_client.get(
-            usage_price_limit_url, {"price_limit": price - 1, "type_of_usage": UsageRecord.USAGE_TYPES.data}
-        )
+        data_response = api_client.get(usage_price_limit_url, {"price_limit": price - 1, "type_of_usage": "data"})
         data_response_json = data_response.json()
         assert len(data_response_json) == 1
         record = data_response_json[0]
         assert record["price_exceeded"] == 1
+        assert record["type_of_usage"] == "data"
 
-        voice_response = api_client.get(
-            usage_price_limit_url, {"price_limit": price - 1, "type_of_usage": UsageRecord.USAGE_TYPES.voice}
-        )
+        voice_response = api_client.get(usage_price_limit_url, {"price_limit": price - 1, "type_of_usage": "voice"})
         voice_response_json = voice_response.json()
         assert len(voice_response_json) == 1
         record = voice_response_json[0]
         assert record["price_exceeded"] == 1
 
+    def test_view_with_keyset_pagination(self, api_client):
+        for type_of_usage in UsageRecord.RAW_MODELS:
+            UsageRecordFactory.create_batch(3, price=20, type_of_usage=type_of_usage)
+        expected = api_client.get(usage_price_limit_url, {"price_limit": 10}).json()
+
+        records, url, params = [], usage_price_limit_url, {"price_limit": 10, "page_size": 4}
+        while url:
+            response_json = api_client.get(url, params).json()
+            assert len(response_json["results"]) <= 4
+            records += response_json["results"]
+            url, params = response_json["next"], None
+
+        keys = [(record["subscription_id"], record["type_of_usage"]) for record in records]
+        assert keys == sorted(keys)
+        assert sorted(records, key=lambda record: record["subscription_id"]) == sorted(
+            expected, key=lambda record: record["subscription_id"]
+        )
+
+    def test_keyset_pagination_of_records_without_subscription(self, api_client):
+        UsageRecordFactory.create(price=20)
+        for type_of_usage in UsageRecord.RAW_MODELS:
+            UsageRecordFactory.create(price=20, type_of_usage=type_of_usage, subscription=None)
+
+        records, url, params = [], usage_price_limit_url, {"price_limit": 10, "page_size": 1}
+        while url:
+            response = api_client.get(url, params)
+            assert response.status_code == 200
+            records += response.json()["results"]
+            url, params = response.json()["next"], None
+
+        assert [record["subscription_id"] for record in records][1:] == [None, None]
+        assert [record["type_of_usage"] for record in records][1:] == ["data", "voice"]
+
+    def test_view_with_invalid_cursor(self, api_client):
+        response = api_client.get(usage_price_limit_url, {"price_limit": 10, "cursor": "invalid"})
+        assert response.status_code == 404
+
+    def test_view_with_streaming(self, api_client):
+        UsageRecordFactory.create_batch(3, price=20)
+        UsageRecordFactory.create(price=5)
+        response = api_client.get(usage_price_limit_url, {"price_limit": 10, "stream": "true"})
+
+        records = json.loads(b"".join(response.streaming_content))
+        assert len(records) == 3
+        assert {record["price_exceeded"] for record in records} == {10}
+
 
 class TestUsageRecordTotalMetricsView:
     def test_view_with_empty_response(self, api_client):
@@ -66,3 +119,325 @@ class TestUsageRecordTotalMetricsView:
         assert record["subscription_id"] == usage_record.subscription_id
         assert record["total_price"] == usage_record.price
         assert record["total_used"] == usage_record.used
+
+    def test_view_with_filtering(self, api_client):
+        first_record = UsageRecordFactory.create(usage_date=date(2022, 1, 31))
+        second_record = UsageRecordFactory.create(subscription=first_record.subscription, usage_date=date(2022, 2, 1))
+        # outside of the date range
+        UsageRecordFactory.create(subscription=first_record.subscription, usage_date=date(2022, 2, 28))
+        usage_metrics_url = reverse("usage-metrics", kwargs={"subscription_id": first_record.subscription_id})
+        response = api_client.get(
+            usage_metrics_url,
+            {"usage_date__gte": "2022-01-02", "usage_date__lte": "2022-02-27", "type_of_usage": "data"},
+        )
+        assert response.json() == [
+            {
+                "subscription_id": first_record.subscription_id,
+                "total_price": first_record.price + second_record.price,
+                "total_used": first_record.used + second_record.used,
+            }
+        ]
+
+    def test_view_with_invalid_filter(self, api_client):
+        usage_metrics_url = reverse("usage-metrics", kwargs={"subscription_id": 1})
+        response = api_client.get(usage_metrics_url, {"usage_date__gte": "yesterday"})
+        assert response.status_code == 400
+
+
+class TestUsageRecordTimeSeriesView:
+    def get_url(self, subscription_id):
+        return reverse("usage-metrics_series", kwargs={"subscription_id": subscription_id})
+
+    def test_view_fills_empty_buckets(self, api_client):
+        # Monday, outside of the date range
+        record = UsageRecordFactory.create(usage_date=date(2022, 1, 3), price=1, used=10)
+        voice_record = UsageRecordFactory.create(
+            subscription=record.subscription,
+            usage_date=date(2022, 1, 5),
+            type_of_usage=UsageRecord.USAGE_TYPES.voice,
+            price=2,
+            used=20,
+        )
+        data_records = [
+            UsageRecordFactory.create(subscription=record.subscription, usage_date=usage_date, price=3, used=30)
+            for usage_date in (date(2022, 1, 12), date(2022, 1, 16))
+        ]
+        # another subscription
+        UsageRecordFactory.create(usage_date=date(2022, 1, 12))
+        response = api_client.get(
+            self.get_url(record.subscription_id),
+            {"usage_date__gte": "2022-01-04", "usage_date__lte": "2022-01-20", "bucket": "week"},
+        )
+        zero = {"data_price": "0.00", "data_used": 0, "voice_price": "0.00", "voice_used": 0}
+        assert response.json() == [
+            {**zero, "bucket": "2022-01-03", "voice_price": f"{voice_record.price:.2f}", "voice_used": 20},
+            {
+                **zero,
+                "bucket": "2022-01-10",
+                "data_price": f"{sum(item.price for item in data_records):.2f}",
+                "data_used": 60,
+            },
+            {**zero, "bucket": "2022-01-17"},
+        ]
+
+    @pytest.mark.parametrize(
+        "bucket, buckets",
+        [("day", ["2022-01-31", "2022-02-01", "2022-02-02"]), ("month", ["2022-01-01", "2022-02-01"])],
+    )
+    def test_view_buckets(self, api_client, bucket, buckets):
+        record = UsageRecordFactory.create(usage_date=date(2022, 2, 1))
+        response = api_client.get(
+            self.get_url(record.subscription_id),
+            {"usage_date__gte": "2022-01-31", "usage_date__lte": "2022-02-02", "bucket": bucket},
+        )
+        assert [item["bucket"] for item in response.json()] == buckets
+        assert sum(item["data_used"] for item in response.json()) == record.used
+
+    @pytest.mark.parametrize(
+        "params",
+        [
+            {"usage_date__gte": "2022-01-01"},
+            {"usage_date__gte": "2022-01-02", "usage_date__lte": "2022-01-01"},
+            {"usage_date__gte": "2022-01-01", "usage_date__lte": "2022-01-11", "bucket": "hour"},
+            {"usage_date__gte": "2022-01-01", "usage_date__lte": "2022-01-11"},
+        ],
+    )
+    def test_view_with_invalid_range(self, api_client, settings, params):
+        settings.USAGE_TIME_SERIES_MAX_BUCKETS = 10
+        response = api_client.get(self.get_url(1), params)
+        assert response.status_code == 400
+
+
+class TestUsageRecordBatchMetricsView:
+    url = reverse("usage-metrics_batch")
+
+    def test_view_with_subscription_ids(self, api_client):
+        first_record = UsageRecordFactory.create(usage_date=date(2022, 1, 31))
+        second_record = UsageRecordFactory.create(usage_date=date(2022, 2, 1))
+        UsageRecordFactory.create(
+            subscription=second_record.subscription,
+            usage_date=date(2022, 2, 1),
+            type_of_usage=UsageRecord.USAGE_TYPES.voice,
+        )
+        # not requested
+        UsageRecordFactory.create(usage_date=date(2022, 2, 1))
+        response = api_client.post(
+            self.url,
+            {
+                "subscription_ids": [first_record.subscription_id, second_record.subscription_id],
+                "usage_date__gte": "2022-01-02",
+                "type_of_usage": "data",
+            },
+            format="json",
+        )
+        assert response.json() == [
+            {"subscription_id": record.subscription_id, "total_price": record.price, "total_used": record.used}
+            for record in (first_record, second_record)
+        ]
+
+    def test_view_with_subscription_filter(self, api_client, django_assert_num_queries):
+        record = UsageRecordFactory.create(subscription__type_of_subscription="sprint")
+        UsageRecordFactory.create(subscription__type_of_subscription="att")
+        # the subscription ids and the metrics
+        with django_assert_num_queries(2):
+            response = api_client.post(self.url, {"type_of_subscription": "sprint"}, format="json")
+        assert [item["subscription_id"] for item in response.json()] == [record.subscription_id]
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            {},
+            {"subscription_ids": [1, 2, 3]},
+            {"type_of_subscription": "att"},
+            {"subscription_ids": [1], "type_of_subscription": "att"},
+        ],
+    )
+    def test_view_with_invalid_batch(self, api_client, settings, data):
+        settings.USAGE_METRICS_BATCH_MAX_SIZE = 2
+        UsageRecordFactory.create_batch(3, subscription__type_of_subscription="att")
+        response = api_client.post(self.url, data, format="json")
+        assert response.status_code == 400
+
+
+class TestUsageRecordTopView:
+    url = reverse("usage-top")
+
+    def test_view_orders_ties_by_subscription(self, api_client):
+        first_record, second_record, third_record, fourth_record = [
+            UsageRecordFactory.create(usage_date=date(2022, 2, 1), price=price) for price in (30, 50, 30, 10)
+        ]
+        # outside of the date range and of another type of usage
+        UsageRecordFactory.create(subscription=fourth_record.subscription, usage_date=date(2022, 1, 1), price=100)
+        UsageRecordFactory.create(
+            subscription=fourth_record.subscription,
+            usage_date=date(2022, 2, 1),
+            type_of_usage=UsageRecord.USAGE_TYPES.voice,
+            price=100,
+        )
+        response = api_client.get(
+            self.url, {"limit": 3, "type_of_usage": "data", "usage_date__gte": "2022-01-15", "metric": "price"}
+        )
+        assert response.json() == [
+            {
+                "rank": rank,
+                "subscription_id": record.subscription_id,
+                "total_price": record.price,
+                "total_used": record.used,
+            }
+            for rank, record in [(1, second_record), (2, first_record), (2, third_record)]
+        ]
+
+    @pytest.mark.parametrize("aggregation_backend", [SIGNALS], indirect=True)
+    def test_view_with_approximate_totals(self, api_client):
+        first_record = UsageRecordFactory.create(usage_date=date(2022, 1, 2), used=10)
+        second_record = UsageRecordFactory.create(usage_date=date(2022, 2, 1), used=20)
+        UsageRecordFactory.create(subscription=first_record.subscription, usage_date=date(2022, 3, 1), used=15)
+        params = {"metric": "used", "usage_date__gte": "2022-01-15", "usage_date__lte": "2022-02-10"}
+
+        exact = api_client.get(self.url, params).json()
+        monthly = api_client.get(self.url, {**params, "type_of_usage": "data", "approximate": "true"}).json()
+        totals = api_client.get(self.url, {"metric": "used", "type_of_usage": "data", "approximate": "true"}).json()
+        assert [item["subscription_id"] for item in exact] == [second_record.subscription_id]
+        assert [(item["subscription_id"], item["total_used"]) for item in monthly] == [
+            (second_record.subscription_id, 20),
+            (first_record.subscription_id, 10),
+        ]
+        assert [(item["subscription_id"], item["total_used"]) for item in totals] == [
+            (first_record.subscription_id, 25),
+            (second_record.subscription_id, 20),
+        ]
+
+    @pytest.mark.parametrize(
+        "params", [{"limit": 0}, {"limit": 1001}, {"metric": "seconds"}, {"metric": "used", "approximate": "true"}]
+    )
+    def test_view_with_invalid_params(self, api_client, params):
+        response = api_client.get(self.url, params)
+        assert response.status_code == 400
+
+
+class TestUsageRecordExportView:
+    url = reverse("usage-export")
+
+    def test_csv_export(self, api_client):
+        first_record = UsageRecordFactory.create(
+            usage_date=date(2022, 1, 1), type_of_usage=UsageRecord.USAGE_TYPES.data
+        )
+        second_record = UsageRecordFactory.create(
+            usage_date=date(2022, 1, 2), type_of_usage=UsageRecord.USAGE_TYPES.data
+        )
+        # out of the date range and of another type
+        UsageRecordFactory.create(usage_date=date(2022, 1, 3), type_of_usage=UsageRecord.USAGE_TYPES.data)
+        UsageRecordFactory.create(usage_date=date(2022, 1, 2), type_of_usage=UsageRecord.USAGE_TYPES.voice)
+        response = api_client.get(
+            self.url, {"usage_date__gte": "2022-01-01", "usage_date__lte": "2022-01-02", "type_of_usage": "data"}
+        )
+
+        assert response["Content-Type"] == "text/csv"
+        rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+        assert rows == [["type_of_usage", "subscription_id", "usage_date", "price", "used"]] + [
+            ["data", str(record.subscription_id), str(record.usage_date), str(record.price), str(record.used)]
+            for record in (first_record, second_record)
+        ]
+
+    @pytest.mark.parametrize("file_format", ["arrow", "parquet"])
+    def test_columnar_export(self, api_client, settings, file_format):
+        pyarrow = pytest.importorskip("pyarrow")
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        settings.USAGE_EXPORT_BATCH_SIZE = 2
+        records = sorted(
+            UsageRecordFactory.create_batch(5), key=lambda record: (record.subscription_id, record.type_of_usage)
+        )
+        response = api_client.get(self.url, {"file_format": file_format})
+        content = b"".join(response.streaming_content)
+
+        if file_format == "parquet":
+            parquet_file = pyarrow.parquet.ParquetFile(pyarrow.BufferReader(content))
+            assert parquet_file.num_row_groups == 3
+            table = parquet_file.read()
+        else:
+            table = pyarrow.ipc.open_stream(content).read_all()
+        assert table.to_pylist() == [
+            {
+                "type_of_usage": UsageRecord.USAGE_TYPE_NAMES[record.type_of_usage],
+                "subscription_id": record.subscription_id,
+                "usage_date": record.usage_date,
+                "price": record.price,
+                "used": record.used,
+            }
+            for record in records
+        ]
+
+    def test_invalid_format(self, api_client):
+        assert api_client.get(self.url, {"file_format": "xlsx"}).status_code == 400
+
+
+class TestUsageRefreshedAt:
+    def test_up_to_date_backends_have_no_header(self, api_client):
+        response = api_client.get(usage_price_limit_url, {"price_limit": 10})
+        assert "X-Usage-Refreshed-At" not in response
+
+    @pytest.mark.parametrize("aggregation_backend", [MATERIALIZED_VIEW], indirect=True)
+    def test_materialized_view_reports_refresh(self, api_client, run_on_commit):
+        record = DataUsageRecordFactory.create(price=20)
+        usage_metrics_url = reverse("usage-metrics", kwargs={"subscription_id": record.subscription_id.id})
+        assert api_client.get(usage_price_limit_url, {"price_limit": 10}).json() == []
+
+        refreshed_at = RefreshUsageRecordMaterializedViewService().refresh()
+        run_on_commit()
+        for response in (
+            api_client.get(usage_price_limit_url, {"price_limit": 10}),
+            api_client.get(usage_metrics_url),
+        ):
+            assert response["X-Usage-Refreshed-At"] == refreshed_at.isoformat()
+            assert len(response.json()) == 1
+
+
+class TestPriceThresholdViews:
+    def test_create(self, api_client):
+        subscription = SubscriptionFactory.create()
+        response = api_client.post(
+            reverse("usage-price_thresholds"),
+            {"price_limit": "10.50", "period": "month", "type_of_usage": "voice", "subscription": subscription.id},
+        )
+
+        assert response.status_code == 201
+        threshold = PriceThreshold.objects.get()
+        assert (threshold.type_of_usage, threshold.subscription) == (UsageRecord.USAGE_TYPES.voice, subscription)
+        assert api_client.get(reverse("usage-price_thresholds")).json()[0]["type_of_usage"] == "voice"
+
+    def test_subscription_and_plan_are_exclusive(self, api_client):
+        threshold = PriceThreshold.objects.create(price_limit=10, plan=Plan.objects.create(name="basic"))
+        url = reverse("usage-price_threshold", kwargs={"pk": threshold.id})
+        response = api_client.patch(url, {"subscription": SubscriptionFactory.create().id})
+
+        assert response.status_code == 400
+
+    @pytest.mark.django_db(transaction=True)
+    @pytest.mark.parametrize("aggregation_backend", [SIGNALS], indirect=True)
+    def test_events_are_polled_with_cursor(self, api_client, settings):
+        """Events are visible after their transaction and all older ones finish"""
+        # committed writes would be read from a lagging replica
+        settings.DATABASE_READ_REPLICAS = []
+        url = reverse("usage-price_threshold_events")
+        threshold = PriceThreshold.objects.create(price_limit=10)
+        records = [DataUsageRecordFactory.create(price=20) for _ in range(3)]
+        DataUsageRecordFactory.create(subscription_id=records[0].subscription_id, price=20)
+
+        first_page = api_client.get(url, {"page_size": 2}).json()
+        second_page = api_client.get(url, {"cursor": first_page["cursor"]}).json()
+        assert [event["subscription"] for event in first_page["results"] + second_page["results"]] == [
+            record.subscription_id.id for record in records
+        ]
+        assert second_page["results"][0]["period"] == "total"
+        assert second_page["results"][0]["threshold"] == threshold.id
+
+        assert api_client.get(url, {"cursor": second_page["cursor"]}).json() == {
+            "cursor": second_page["cursor"],
+            "results": [],
+        }
+        record = DataUsageRecordFactory.create(price=20)
+        assert [
+            event["subscription"] for event in api_client.get(url, {"cursor": second_page["cursor"]}).json()["results"]
+        ] == [record.subscription_id.id]
@@ -0,0 +1,95 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """
+    Cumulative histogram per label values in the Prometheus text format.
+    Values are kept in process memory, every worker process exposes its own ones
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str], buckets: Sequence[float]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> (counts by bucket with +Inf, sum)
+        self.samples: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            counts, total = self.samples.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self.samples[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observe the duration of the block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            samples = sorted((key, (list(counts), total)) for key, (counts, total) in self.samples.items())
+        for key, (counts, total) in samples:
+            labels = [f'{name}="{escape(value)}"' for name, value in zip(self.label_names, key)]
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            lines.append(f'{self.name}_sum{{{",".join(labels)}}} {total}')
+            lines.append(f'{self.name}_count{{{",".join(labels)}}} {cumulative}')
+        return lines
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_DURATION = Histogram(
+    "wingtel_http_request_duration_seconds", "Duration of HTTP requests.", ("view", "method"), DURATION_BUCKETS
+)
+REQUEST_QUERIES = Histogram(
+    "wingtel_http_request_queries", "Number of SQL queries per HTTP request.", ("view", "method"), COUNT_BUCKETS
+)
+REQUEST_SQL_DURATION = Histogram(
+    "wingtel_http_request_sql_duration_seconds",
+    "Total duration of SQL queries per HTTP request.",
+    ("view", "method"),
+    DURATION_BUCKETS,
+)
+REQUEST_RENDER_DURATION = Histogram(
+    "wingtel_http_response_render_duration_seconds",
+    "Duration of serializing responses to JSON/HTML.",
+    ("view", "method"),
+    DURATION_BUCKETS,
+)
+AGGREGATION_DURATION = Histogram(
+    "wingtel_usage_aggregation_duration_seconds",
+    "Duration of usage aggregation writes of raw record saves and deletes.",
+    ("service",),
+    DURATION_BUCKETS,
+)
+REGISTRY = (REQUEST_DURATION, REQUEST_QUERIES, REQUEST_SQL_DURATION, REQUEST_RENDER_DURATION, AGGREGATION_DURATION)
+
+
+def render_metrics() -> str:
+    return "\n".join(line for histogram in REGISTRY for line in histogram.render()) + "\n"
@@ -0,0 +1,103 @@
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Iterator
+
+from django.db import connections
+
+from wingtel.monitoring.metrics import (
+    REQUEST_DURATION,
+    REQUEST_QUERIES,
+    REQUEST_RENDER_DURATION,
+    REQUEST_SQL_DURATION,
+)
+
+
+class RequestTimings:
+    def __init__(self) -> None:
+        self.queries = 0
+        self.sql_duration = 0.0
+        self.render_duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        """connection.execute_wrapper hook, times every SQL query of the request"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_duration += time.perf_counter() - started
+
+
+def get_view_label(request) -> str:
+    """Class name of the resolved view (APIView, ViewSet) or the view function name"""
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    view_class = getattr(match.func, "cls", None) or getattr(match.func, "view_class", None)
+    return view_class.__name__ if view_class else match.func.__name__
+
+
+class RequestMetricsMiddleware:
+    """
+    Count SQL queries and their total time, time response rendering and the whole request.
+    They are sent in the Server-Timing header and observed in the /metrics histograms labeled by view.
+    Streaming responses are observed when their content is consumed, their headers are sent before it,
+    so they have no Server-Timing header
+    """
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = request.timings = RequestTimings()
+        started = time.perf_counter()
+        with self.time_queries(timings):
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = self.stream(request, response.streaming_content, timings, started)
+            return response
+        duration = time.perf_counter() - started
+
+        self.observe(request, timings, duration)
+        response["Server-Timing"] = ", ".join(
+            [
+                f'db;desc="{timings.queries} queries";dur={timings.sql_duration * 1000:.2f}',
+                f"render;dur={timings.render_duration * 1000:.2f}",
+                f"total;dur={duration * 1000:.2f}",
+            ]
+        )
+        return response
+
+    @staticmethod
+    @contextmanager
+    def time_queries(timings: RequestTimings):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timings))
+            yield
+
+    def stream(self, request, content: Iterator[bytes], timings: RequestTimings, started: float) -> Iterator[bytes]:
+        """
+        Time the queries run while the content is consumed (server-side cursors, exports),
+        the fetches of a server-side cursor are a part of the total duration only
+        """
+        try:
+            with self.time_queries(timings):
+                yield from content
+        finally:
+            self.observe(request, timings, time.perf_counter() - started)
+
+    @staticmethod
+    def observe(request, timings: RequestTimings, duration: float):
+        labels = {"view": get_view_label(request), "method": request.method}
+        REQUEST_DURATION.observe(duration, **labels)
+        REQUEST_QUERIES.observe(timings.queries, **labels)
+        REQUEST_SQL_DURATION.observe(timings.sql_duration, **labels)
+        REQUEST_RENDER_DURATION.observe(timings.render_duration, **labels)
+
+    def process_template_response(self, request, response):
+        """DRF responses are rendered here to time serialization, Django doesn't render them twice"""
+        started = time.perf_counter()
+        response.render()
+        request.timings.render_duration += time.perf_counter() - started
+        return response
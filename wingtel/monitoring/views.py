@@ -0,0 +1,8 @@
+from django.http import HttpResponse
+
+from wingtel.monitoring.metrics import render_metrics
+
+
+def metrics(request):
+    """Histograms of this process in the Prometheus text format"""
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
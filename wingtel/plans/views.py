@@ -2,9 +2,10 @@ from rest_framework import viewsets
 
 from wingtel.plans.models import Plan
 from wingtel.plans.serializers import PlanSerializer
+from wingtel.replicas.mixins import ReplicaReadsMixin
 
 
-class PlanViewSet(viewsets.ReadOnlyModelViewSet):
+class PlanViewSet(ReplicaReadsMixin, viewsets.ReadOnlyModelViewSet):
     # class PlanViewSet(viewsets.ModelViewSet):
     """
     A viewset that provides `retrieve`, `create`, and `list` actions.
@@ -2,9 +2,10 @@ from rest_framework import viewsets
 
 from wingtel.purchases.models import Purchase
 from wingtel.purchases.serializers import PurchaseSerializer
+from wingtel.replicas.mixins import ReplicaReadsMixin
 
 
-class PurchaseViewSet(viewsets.ModelViewSet):
+class PurchaseViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     """
     A viewset that provides `retrieve`, `create`, and `list` actions.
     """
@@ -0,0 +1,15 @@
+from wingtel.replicas.routers import reset_replica_state
+
+
+class ReplicaPinningMiddleware:
+    """Pinning to the primary after a write lasts until the end of the request"""
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset_replica_state()
+        try:
+            return self.get_response(request)
+        finally:
+            reset_replica_state()
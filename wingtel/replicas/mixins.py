@@ -0,0 +1,22 @@
+from wingtel.replicas.routers import replica_reads
+
+
+class ReplicaReadsMixin:
+    """
+    Reads of the list and retrieve actions of viewsets and of replica_methods requests of the other views
+    go to a replica, see wingtel.replicas.routers. Querysets streamed after the view returns must be bound
+    to their database with queryset.using(queryset.db) inside it
+    """
+
+    replica_actions = ("list", "retrieve")
+    replica_methods = ("GET", "HEAD")
+
+    def reads_from_replica(self, request) -> bool:
+        action_map = getattr(self, "action_map", None)
+        if action_map is not None:
+            return action_map.get(request.method.lower()) in self.replica_actions
+        return request.method in self.replica_methods
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads(self.reads_from_replica(request)):
+            return super().dispatch(request, *args, **kwargs)
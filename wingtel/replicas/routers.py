@@ -0,0 +1,168 @@
+"""
+Reporting reads on read replicas. Reads go to a replica only inside replica_reads() (the selectors of
+wingtel.usage and the list/retrieve actions of ReplicaReadsMixin views), everything else stays on the primary.
+Inside a block reads fall back to the primary after a write of the same request or thread, inside a transaction
+of the primary and when every replica lags more than DATABASE_REPLICA_MAX_LAG seconds or is down
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.models import QuerySet
+
+# seconds the replica is behind the primary, 0 when it replayed everything it received, NULL when it's unknown
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+_state = threading.local()
+
+
+def get_replicas() -> List[str]:
+    return list(settings.DATABASE_READ_REPLICAS)
+
+
+class ReplicaLag:
+    """Lag of every replica measured at most once per DATABASE_REPLICA_LAG_CHECK_INTERVAL seconds in a process"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # alias -> (checked at, lag in seconds or None when unknown)
+        self.checks: Dict[str, Tuple[float, Optional[float]]] = {}
+
+    def get(self, alias: str) -> Optional[float]:
+        now = time.monotonic()
+        with self.lock:
+            checked_at, lag = self.checks.get(alias, (None, None))
+        if checked_at is None or now - checked_at >= settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL:
+            lag = self.measure(alias)
+            with self.lock:
+                self.checks[alias] = (now, lag)
+        return lag
+
+    @staticmethod
+    def measure(alias: str) -> Optional[float]:
+        """None when the replica can't be reached, the connection is reopened by the next query"""
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                lag = cursor.fetchone()[0]
+        except DatabaseError:
+            connections[alias].close()
+            return None
+        return None if lag is None else float(lag)
+
+    def is_fresh(self, alias: str) -> bool:
+        lag = self.get(alias)
+        return lag is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG
+
+    def reset(self):
+        with self.lock:
+            self.checks.clear()
+
+
+replica_lag = ReplicaLag()
+
+
+@contextmanager
+def replica_reads(enabled: bool = True):
+    """Reads inside the block go to a replica where it's safe, the block is also a decorator"""
+    previous = getattr(_state, "replica_reads", False)
+    _state.replica_reads = enabled
+    try:
+        yield
+    finally:
+        _state.replica_reads = previous
+
+
+def replica_selector(selector):
+    """
+    Run the selector inside replica_reads(). A returned queryset is bound to the chosen database,
+    it's usually evaluated after the selector returns
+    """
+
+    @wraps(selector)
+    def wrapper(*args, **kwargs):
+        with replica_reads():
+            result = selector(*args, **kwargs)
+            if isinstance(result, QuerySet):
+                result = result.using(result.db)
+        return result
+
+    return wrapper
+
+
+@contextmanager
+def primary_reads():
+    """Reads inside the block go to the primary, even inside replica_reads()"""
+    previous = getattr(_state, "primary_reads", False)
+    _state.primary_reads = True
+    try:
+        yield
+    finally:
+        _state.primary_reads = previous
+
+
+def pin_to_primary():
+    """Following reads of the request (or thread outside requests) see its writes, they go to the primary"""
+    _state.pinned = True
+
+
+def reset_replica_state():
+    """Called at the start and the end of every request by ReplicaPinningMiddleware"""
+    _state.pinned = False
+    _state.replica = None
+    _state.replica_reads = False
+    _state.primary_reads = False
+
+
+def get_read_database() -> str:
+    """Database of a read inside replica_reads(), a fresh replica or the primary"""
+    replicas = get_replicas()
+    if (
+        not replicas
+        or getattr(_state, "pinned", False)
+        or getattr(_state, "primary_reads", False)
+        or connections[DEFAULT_DB_ALIAS].in_atomic_block
+    ):
+        return DEFAULT_DB_ALIAS
+    # reads of one request stay on the same replica while it's fresh
+    replica = getattr(_state, "replica", None)
+    if replica in replicas and replica_lag.is_fresh(replica):
+        return replica
+    fresh = [alias for alias in replicas if alias != replica and replica_lag.is_fresh(alias)]
+    _state.replica = random.choice(fresh) if fresh else None
+    return _state.replica or DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+    """Replicas are read-only copies of the primary: they are never written or migrated"""
+
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        if not getattr(_state, "replica_reads", False):
+            return None
+        return get_read_database()
+
+    def db_for_write(self, model, **hints) -> str:
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> Optional[bool]:
+        # rows read from a replica are rows of the primary
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db: str, app_label: str, model_name: Optional[str] = None, **hints) -> Optional[bool]:
+        if db in get_replicas():
+            return False
+        return None
@@ -22,7 +22,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_KEY = ")g@2v1pys*6foi*gyq9zs4m3d@!edp4u0srq8o_#c&8=w4+lbb"
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get("DJANGO_DEBUG", "true").lower() == "true"
 
 ALLOWED_HOSTS = []
 
@@ -40,11 +40,14 @@ INSTALLED_APPS = [
     "wingtel.plans.apps.PlansConfig",
     "wingtel.purchases.apps.PurchasesConfig",
     "wingtel.usage.apps.UsageConfig",
-    "debug_toolbar",
     "django_filters",
 ]
 
 MIDDLEWARE = [
+    # query count, SQL and rendering time per view in Server-Timing headers and /metrics
+    "wingtel.monitoring.middleware.RequestMetricsMiddleware",
+    # reads after a write of the request go to the primary database
+    "wingtel.replicas.middleware.ReplicaPinningMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -52,9 +55,12 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
 ]
 
+if DEBUG:
+    INSTALLED_APPS.append("debug_toolbar")
+    MIDDLEWARE.append("debug_toolbar.middleware.DebugToolbarMiddleware")
+
 INTERNAL_IPS = [
     # ...
     "127.0.0.1",
@@ -83,6 +89,7 @@ WSGI_APPLICATION = "wingtel.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# PostgreSQL 15+, unique constraints of the usage aggregates are NULLS NOT DISTINCT (migration 0015 checks it)
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql_psycopg2",
@@ -94,6 +101,50 @@ DATABASES = {
         "CONN_MAX_AGE": 3600,
     }
 }
+# streaming replicas of the default database as comma separated host:port, e.g. DATABASE_REPLICAS=127.0.0.1:5433.
+# Tests create the test database on the primary only, replicas receive it with replication
+for number, address in enumerate(filter(None, os.environ.get("DATABASE_REPLICAS", "").split(",")), 1):
+    host, _, port = address.strip().partition(":")
+    DATABASES[f"replica_{number}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_ROUTERS = ["wingtel.replicas.routers.ReplicaRouter"]
+# reporting reads (usage selectors, list/retrieve actions) go to these aliases, see wingtel.replicas.routers
+DATABASE_READ_REPLICAS = [alias for alias in DATABASES if alias.startswith("replica_")]
+# seconds, reads fall back to the primary when every replica lags more
+DATABASE_REPLICA_MAX_LAG = float(os.environ.get("DATABASE_REPLICA_MAX_LAG", 5))
+# seconds between lag checks of a replica in a process
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = 1
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # results of the usage APIs, local memory is LRU bounded by MAX_ENTRIES and per process,
+    # use a shared backend (memcached, redis) to invalidate across processes
+    "usage": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "usage",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+# None disables the cache of the usage APIs
+USAGE_CACHE_ALIAS = "usage"
+# the most subscriptions of one usage_metrics/batch/ request
+USAGE_METRICS_BATCH_MAX_SIZE = 1000
+# the greatest limit of usage_top/ requests
+USAGE_TOP_MAX_LIMIT = 1000
+# the most buckets of one usage_metrics/<id>/series/ request
+USAGE_TIME_SERIES_MAX_BUCKETS = 1000
+# rows per server-side cursor fetch and per CSV chunk/Arrow record batch/Parquet row group of usage exports
+USAGE_EXPORT_BATCH_SIZE = 100000
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -132,5 +183,16 @@ USE_TZ = True
 STATIC_URL = "/static/"
 
 
+# Raw usage tables are partitioned by month
+USAGE_PARTITIONS_MONTHS_AHEAD = 3
+USAGE_RAW_RETENTION_MONTHS = 6
+# raw records older than the dispute window are moved to files of USAGE_ARCHIVE_DIRECTORY by archive_raw_usage
+USAGE_RAW_DISPUTE_WINDOW_DAYS = 90
+USAGE_ARCHIVE_DIRECTORY = os.environ.get("USAGE_ARCHIVE_DIRECTORY", os.path.join(BASE_DIR, "archive"))
+# how UsageRecord is kept: "signals", "triggers", "view" or "materialized_view", see wingtel.usage.backends
+USAGE_AGGREGATION_BACKEND = os.environ.get("USAGE_AGGREGATION_BACKEND", "signals")
+# number of shard rows per UsageRecord key for hot writers, 0 writes UsageRecord directly
+USAGE_AGGREGATION_SHARDS = 0
+
 # REST
 REST_FRAMEWORK = {"DEFAULT_FILTER_BACKENDS": ["django_filters.rest_framework.DjangoFilterBackend"]}
@@ -1,5 +1,6 @@
 from rest_framework import viewsets
 
+from wingtel.replicas.mixins import ReplicaReadsMixin
 from wingtel.subscriptions.models import Subscription
 from wingtel.subscriptions.serializers import (
     ATTSubscriptionSerializer,
@@ -7,7 +8,7 @@ from wingtel.subscriptions.serializers import (
 )
 
 
-class ATTSubscriptionViewSet(viewsets.ModelViewSet):
+class ATTSubscriptionViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     """
     A viewset that provides `retrieve`, `create`, and `list` actions.
     """
@@ -16,7 +17,7 @@ class ATTSubscriptionViewSet(viewsets.ModelViewSet):
     serializer_class = ATTSubscriptionSerializer
 
 
-class SprintSubscriptionViewSet(viewsets.ModelViewSet):
+class SprintSubscriptionViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     """
     A viewset that provides `retrieve`, `create`, and `list` actions.
     """
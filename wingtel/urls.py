@@ -13,12 +13,13 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-import debug_toolbar
+from django.conf import settings
 from django.conf.urls import include, url
 from django.contrib import admin
 from django.urls import path
 from rest_framework import routers
 
+from wingtel.monitoring.views import metrics
 from wingtel.plans.views import PlanViewSet
 from wingtel.purchases.views import PurchaseViewSet
 from wingtel.subscriptions.views import (
@@ -37,5 +38,10 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     url(r"^api/", include((router.urls, "api"), namespace="api")),
     path("api/usage/", include("wingtel.usage.urls")),
-    path("__debug__/", include(debug_toolbar.urls)),
+    path("metrics", metrics, name="metrics"),
 ]
+
+if settings.DEBUG:
+    import debug_toolbar
+
+    urlpatterns.append(path("__debug__/", include(debug_toolbar.urls)))
@@ -1,7 +1,12 @@
 from django.contrib import admin
 
 # Register your models here.
-from wingtel.usage.models import DataUsageRecord, UsageRecord, VoiceUsageRecord
+from wingtel.usage.models import (
+    DataUsageRecord,
+    PriceThreshold,
+    UsageRecord,
+    VoiceUsageRecord,
+)
 
 
 class AdminDataUsageRecord(admin.ModelAdmin):
@@ -25,6 +30,14 @@ class AdminUsageRecord(admin.ModelAdmin):
         model = VoiceUsageRecord
 
 
+class AdminPriceThreshold(admin.ModelAdmin):
+    list_display = ["id", "name", "price_limit", "period", "type_of_usage", "subscription", "plan", "is_active"]
+
+    class Meta:
+        model = PriceThreshold
+
+
 admin.site.register(DataUsageRecord, AdminDataUsageRecord)
 admin.site.register(VoiceUsageRecord, AdminVoiceUsageRecord)
 admin.site.register(UsageRecord, AdminUsageRecord)
+admin.site.register(PriceThreshold, AdminPriceThreshold)
@@ -0,0 +1,273 @@
+"""
+Archive of expired raw usage records in a local directory. Every day of a raw table is streamed from
+a server-side cursor to a compressed columnar file, zstd Parquet with pyarrow or gzipped CSV without it,
+listed in manifest.json with its row count, sums and sha256. Archived rows are deleted in short batches
+of the ids read back from the file, restore loads a day back with COPY. UsageRecord aggregates and
+their rollups are kept as they are either way, archived days are recorded as RawUsageRemoval until restored
+"""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pytz
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils import timezone
+
+from wingtel.usage.backends import skip_database_aggregation
+from wingtel.usage.exports import batched, import_pyarrow
+from wingtel.usage.models import RawUsageRemoval, UsageRecord
+
+CSV, PARQUET = "csv", "parquet"
+ARCHIVE_FORMATS = (PARQUET, CSV)
+EXTENSIONS = {CSV: "csv.gz", PARQUET: "parquet"}
+ARCHIVE_FIELDS = ("id", "subscription_id", "price", "usage_date", "used")
+MANIFEST = "manifest.json"
+
+
+def get_default_format() -> str:
+    try:
+        import_pyarrow()
+    except ImproperlyConfigured:
+        return CSV
+    return PARQUET
+
+
+class RawUsageArchive:
+    """
+    Files of one day and type of usage are <directory>/<raw table>/<day>.<part>.<extension>, a day archived again
+    (late records or an interrupted delete) gets another part. Restored parts are removed from the manifest and
+    the directory, the rows are back in the database
+    """
+
+    DELETE_SQL = "DELETE FROM {table} WHERE id = ANY(%s) AND usage_date >= %s AND usage_date < %s"
+    COPY_SQL = "COPY {table} (id, {subscription_column}, price, usage_date, {used_column}) FROM STDIN WITH (FORMAT csv)"
+
+    def __init__(self, directory: str, file_format: Optional[str] = None, batch_size: int = 100000) -> None:
+        self.directory = Path(directory)
+        self.file_format = file_format or get_default_format()
+        if self.file_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Archive format must be one of {', '.join(ARCHIVE_FORMATS)}")
+        if self.file_format == PARQUET:
+            import_pyarrow()
+        self.batch_size = batch_size
+
+    def archive_day(self, record_type: int, day: date, delete_batch_size: int = 5000) -> Optional[Dict]:
+        """Archive and delete raw records of the day, return the manifest entry or None for a day without records"""
+        model = UsageRecord.RAW_MODELS[record_type]
+        start, end = self.__get_bounds(day)
+        # rows of an interrupted run are in its file already, they must not get to the new part too
+        for entry in self.get_manifest():
+            if self.__matches(entry, record_type, day):
+                self.__mark_archived(record_type, day)
+                self.__delete(model, entry, day, delete_batch_size)
+        rows = (
+            model.objects.filter(usage_date__gte=start, usage_date__lt=end)
+            .order_by("id")
+            .values_list(*ARCHIVE_FIELDS[:-1], model.USED_FIELD)
+            .iterator(chunk_size=self.batch_size)
+        )
+        entry = self.__write(model, record_type, day, rows)
+        if entry is not None:
+            # the day is aggregate-only before its first row is deleted
+            self.__mark_archived(record_type, day)
+            entry["deleted"] = self.__delete(model, entry, day, delete_batch_size)
+        return entry
+
+    def restore_day(self, record_type: int, day: date) -> int:
+        """Load the archived parts of the day back with COPY in one transaction, return the number of rows"""
+        model = UsageRecord.RAW_MODELS[record_type]
+        entries = [entry for entry in self.get_manifest() if self.__matches(entry, record_type, day)]
+        copy_sql = self.COPY_SQL.format(
+            table=model._meta.db_table,
+            subscription_column=model._meta.get_field("subscription_id").column,
+            used_column=model.USED_FIELD,
+        )
+        restored = 0
+        with skip_database_aggregation(), connection.cursor() as cursor:
+            for entry in entries:
+                path = self.directory / entry["file"]
+                if self.__get_sha256(path) != entry["sha256"]:
+                    raise ValueError(f"{entry['file']} doesn't match its checksum in the manifest")
+                copied = 0
+                for stream in self.__read_csv(entry):
+                    cursor.copy_expert(copy_sql, stream)
+                    copied += cursor.rowcount
+                if copied != entry["rows"]:
+                    raise ValueError(f"{entry['file']} has {copied} rows, the manifest lists {entry['rows']}")
+                restored += copied
+            RawUsageRemoval.objects.filter(
+                type_of_usage=record_type, reason=RawUsageRemoval.REASONS.archive, date_from=day
+            ).delete()
+        for entry in entries:
+            self.__remove_entry(entry)
+            (self.directory / entry["file"]).unlink()
+        return restored
+
+    def get_manifest(self) -> List[Dict]:
+        path = self.directory / MANIFEST
+        if not path.exists():
+            return []
+        return json.loads(path.read_text())["files"]
+
+    def __write(self, model, record_type: int, day: date, rows) -> Optional[Dict]:
+        table = model._meta.db_table
+        part = sum(1 for entry in self.get_manifest() if self.__matches(entry, record_type, day))
+        name = f"{table}/{day}.{part}.{EXTENSIONS[self.file_format]}"
+        path = self.directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f".{path.name}.partial")
+        stats = {"rows": 0, "price": Decimal(0), "used": 0}
+
+        def counted(batches):
+            for batch in batches:
+                stats["rows"] += len(batch)
+                stats["price"] += sum(row[2] for row in batch)
+                stats["used"] += sum(row[4] for row in batch)
+                yield batch
+
+        batches = counted(batched(rows, self.batch_size))
+        if self.file_format == PARQUET:
+            self.__write_parquet(partial, batches)
+        else:
+            self.__write_csv(partial, batches)
+        if not stats["rows"]:
+            partial.unlink()
+            return None
+        # the file is complete on disk before it's listed and the rows are deleted
+        with open(partial, "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(partial, path)
+        entry = {
+            "file": name,
+            "table": table,
+            "type_of_usage": UsageRecord.USAGE_TYPE_NAMES[record_type],
+            "usage_date": day.isoformat(),
+            "format": self.file_format,
+            "rows": stats["rows"],
+            "price": str(stats["price"]),
+            "used": stats["used"],
+            "sha256": self.__get_sha256(path),
+            "archived_at": timezone.now().isoformat(),
+        }
+        self.__write_manifest(self.get_manifest() + [entry])
+        return entry
+
+    def get_arrow_schema(self):
+        pyarrow = import_pyarrow()
+        return pyarrow.schema(
+            [
+                ("id", pyarrow.int64()),
+                ("subscription_id", pyarrow.int64()),
+                ("price", pyarrow.decimal128(5, 2)),
+                ("usage_date", pyarrow.timestamp("us", tz="UTC")),
+                ("used", pyarrow.int64()),
+            ]
+        )
+
+    def __write_parquet(self, path: Path, batches):
+        pyarrow = import_pyarrow()
+        schema = self.get_arrow_schema()
+        with pyarrow.parquet.ParquetWriter(str(path), schema, compression="zstd") as writer:
+            for batch in batches:
+                writer.write_table(
+                    pyarrow.Table.from_arrays(
+                        [pyarrow.array(column, field.type) for column, field in zip(zip(*batch), schema)],
+                        schema=schema,
+                    )
+                )
+
+    def __write_csv(self, path: Path, batches):
+        with gzip.open(path, "wt", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(ARCHIVE_FIELDS)
+            for batch in batches:
+                writer.writerows((*row[:3], row[3].isoformat(), row[4]) for row in batch)
+
+    def __delete(self, model, entry: Dict, day: date, batch_size: int) -> int:
+        deleted = 0
+        for ids in self.__read_ids(entry, batch_size):
+            # short transactions, the triggers backend keeps the aggregates of the deleted rows
+            with skip_database_aggregation(), connection.cursor() as cursor:
+                cursor.execute(self.DELETE_SQL.format(table=model._meta.db_table), [ids, *self.__get_bounds(day)])
+                deleted += cursor.rowcount
+        return deleted
+
+    def __read_ids(self, entry: Dict, batch_size: int) -> Iterator[List[int]]:
+        """Ids of the archived rows read back from the file, so only rows that made it to the file are deleted"""
+        path = self.directory / entry["file"]
+        if entry["format"] == PARQUET:
+            pyarrow = import_pyarrow()
+            for record_batch in pyarrow.parquet.ParquetFile(str(path)).iter_batches(batch_size, columns=["id"]):
+                yield record_batch.column(0).to_pylist()
+            return
+        with gzip.open(path, "rt", newline="") as file:
+            reader = csv.reader(file)
+            next(reader)
+            for rows in batched(reader, batch_size):
+                yield [int(row[0]) for row in rows]
+
+    def __read_csv(self, entry: Dict) -> Iterator[io.TextIOBase]:
+        """CSV streams without a header for COPY, one per Parquet row group"""
+        path = self.directory / entry["file"]
+        if entry["format"] == CSV:
+            with gzip.open(path, "rt", newline="") as file:
+                file.readline()
+                yield file
+            return
+        pyarrow = import_pyarrow()
+        parquet_file = pyarrow.parquet.ParquetFile(str(path))
+        for row_group in range(parquet_file.num_row_groups):
+            stream = io.StringIO()
+            columns = parquet_file.read_row_group(row_group).to_pydict()
+            writer = csv.writer(stream)
+            for row in zip(*(columns[field] for field in ARCHIVE_FIELDS)):
+                writer.writerow((*row[:3], row[3].isoformat(), row[4]))
+            stream.seek(0)
+            yield stream
+
+    @staticmethod
+    def __mark_archived(record_type: int, day: date):
+        """Rebuilds and reconciliations must keep the aggregates of the day, see RawUsageRemoval"""
+        RawUsageRemoval.objects.get_or_create(
+            type_of_usage=record_type,
+            reason=RawUsageRemoval.REASONS.archive,
+            date_from=day,
+            defaults={"date_to": day, "removed_at": timezone.now()},
+        )
+
+    def __remove_entry(self, removed: Dict):
+        self.__write_manifest([entry for entry in self.get_manifest() if entry["file"] != removed["file"]])
+
+    def __write_manifest(self, entries: List[Dict]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        partial = self.directory / f".{MANIFEST}.partial"
+        partial.write_text(json.dumps({"files": entries}, indent=2))
+        os.replace(partial, self.directory / MANIFEST)
+
+    @staticmethod
+    def __matches(entry: Dict, record_type: int, day: date) -> bool:
+        return (
+            entry["table"] == UsageRecord.RAW_MODELS[record_type]._meta.db_table
+            and entry["usage_date"] == day.isoformat()
+        )
+
+    @staticmethod
+    def __get_bounds(day: date) -> Tuple[datetime, datetime]:
+        start = datetime.combine(day, time(), pytz.utc)
+        return start, start + timedelta(days=1)
+
+    @staticmethod
+    def __get_sha256(path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
@@ -0,0 +1,34 @@
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+
+# UsageRecord and its rollups are written by the services called from Django signals
+SIGNALS = "signals"
+# UsageRecord and its rollups are written by statement level triggers on the raw tables
+TRIGGERS = "triggers"
+# nothing is stored, daily aggregates are read from a view over the raw tables
+VIEW = "view"
+# nothing is written with raw records, daily aggregates are read from a periodically refreshed materialized view
+MATERIALIZED_VIEW = "materialized_view"
+AGGREGATION_BACKENDS = (SIGNALS, TRIGGERS, VIEW, MATERIALIZED_VIEW)
+
+# set to "on" in a transaction, raw records written by it aren't aggregated by the triggers
+SKIP_AGGREGATION_SETTING = "wingtel.skip_usage_aggregation"
+
+
+def get_aggregation_backend() -> str:
+    backend = settings.USAGE_AGGREGATION_BACKEND
+    if backend not in AGGREGATION_BACKENDS:
+        raise ImproperlyConfigured(f"USAGE_AGGREGATION_BACKEND must be one of {', '.join(AGGREGATION_BACKENDS)}")
+    return backend
+
+
+@contextmanager
+def skip_database_aggregation():
+    """Raw records written with SQL inside the block don't change the aggregates of the triggers backend"""
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT set_config(%s, 'on', true)", [SKIP_AGGREGATION_SETTING])
+        yield
+        cursor.execute("SELECT set_config(%s, 'off', true)", [SKIP_AGGREGATION_SETTING])
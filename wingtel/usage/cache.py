@@ -0,0 +1,157 @@
+import random
+import threading
+import time
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from wingtel.replicas.routers import primary_reads
+
+# (type_of_usage, subscription_id, usage_date) of a changed daily aggregate
+UsageRecordKey = Tuple[int, Optional[int], date]
+
+# version of the cached results of a subscription and type of usage, "*" is any of them
+VERSION_KEY = "usage:version:{subscription_id}:{type_of_usage}"
+# time of the last eviction of everything, it clears the bump times of the versions too
+CLEARED_AT_KEY = "usage:cleared_at"
+
+
+class UsageCacheStats:
+    """Hit/miss/eviction counters of the usage cache in this process"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def as_dict(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict.fromkeys(self.counters, 0)
+
+
+stats = UsageCacheStats()
+
+
+def get_usage_cache():
+    """Return the configured cache, None when USAGE_CACHE_ALIAS is None"""
+    alias = getattr(settings, "USAGE_CACHE_ALIAS", None)
+    return caches[alias] if alias else None
+
+
+def get_version_key(subscription_id: Optional[int], type_of_usage: Optional[int]) -> str:
+    return VERSION_KEY.format(subscription_id=subscription_id or "*", type_of_usage=type_of_usage or "*")
+
+
+def get_version(cache, version_key: str) -> Tuple[int, float]:
+    """
+    Return the version and the time of its last change. A missing version starts at a random value,
+    entries cached under an evicted version are never read again
+    """
+    bumped_at_key = f"{version_key}:bumped_at"
+    values = cache.get_many([version_key, bumped_at_key, CLEARED_AT_KEY])
+    if version_key not in values:
+        cache.add(version_key, random.getrandbits(48), None)
+        values[version_key] = cache.get(version_key)
+    return values[version_key], max(values.get(bumped_at_key, 0), values.get(CLEARED_AT_KEY, 0))
+
+
+def get_or_set(key: str, version_key: str, compute: Callable[[], List]) -> List:
+    """
+    Return a cached result or compute and cache it. The key includes the version of the subscription and type
+    of usage it reads, a change bumps the version and the entries of the old one are left to expire.
+    Replicas may not have replayed a change for up to DATABASE_REPLICA_MAX_LAG seconds (plus a lag check interval),
+    a miss that soon after the last bump is computed on the primary, otherwise the reads are routed as usual
+    """
+    cache = get_usage_cache()
+    if cache is None:
+        return compute()
+    version, bumped_at = get_version(cache, version_key)
+    versioned_key = f"{key}:{version}"
+    result = cache.get(versioned_key)
+    if result is not None:
+        stats.increment("hits")
+        return result
+    stats.increment("misses")
+    if time.time() - bumped_at <= settings.DATABASE_REPLICA_MAX_LAG + settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL:
+        with primary_reads():
+            result = compute()
+    else:
+        result = compute()
+    # a result computed across a bump is cached under the old version, nobody reads it
+    cache.set(versioned_key, result)
+    return result
+
+
+def get_cached_usage_metrics(
+    subscription_id: int,
+    type_of_usage: Optional[int],
+    date_from: Optional[date],
+    date_to: Optional[date],
+    compute: Callable[[], List],
+) -> List:
+    key = f"usage:metrics:{subscription_id}:{type_of_usage or '*'}:{date_from or '*'}:{date_to or '*'}"
+    return get_or_set(key, get_version_key(subscription_id, type_of_usage), compute)
+
+
+def get_cached_exceeded_price(
+    price_limit: int, subscription_id: Optional[int], type_of_usage: Optional[int], compute: Callable[[], List]
+) -> List:
+    key = f"usage:price_limit:{price_limit}:{subscription_id or '*'}:{type_of_usage or '*'}"
+    return get_or_set(key, get_version_key(subscription_id, type_of_usage), compute)
+
+
+def evict_usage_records(keys: Iterable[UsageRecordKey]):
+    """Bump the versions of the changed subscriptions and types of usage, one incr per version"""
+    cache = get_usage_cache()
+    if cache is None:
+        return
+    version_keys: Set[str] = set()
+    for type_of_usage, subscription_id, _ in keys:
+        version_keys.update([get_version_key(None, type_of_usage), get_version_key(None, None)])
+        # records without a subscription are read by the results of all subscriptions only
+        if subscription_id is not None:
+            version_keys.update(
+                [get_version_key(subscription_id, type_of_usage), get_version_key(subscription_id, None)]
+            )
+    if not version_keys:
+        return
+    bumped = 0
+    for version_key in version_keys:
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            # nothing was cached under a missing version
+            continue
+        bumped += 1
+    # a missing version is created by the next miss, it must not be computed on a replica behind this change either
+    cache.set_many(dict.fromkeys([f"{version_key}:bumped_at" for version_key in version_keys], time.time()), None)
+    stats.increment("evictions", bumped)
+
+
+def evict_all():
+    cache = get_usage_cache()
+    if cache is not None:
+        cache.clear()
+        cache.set(CLEARED_AT_KEY, time.time(), None)
+
+
+def invalidate_usage_records(keys: Optional[Iterable[UsageRecordKey]]):
+    """
+    Evict cached results touching the changed aggregates, all of them when keys are unknown (set-based writes).
+    It's done after commit, a result cached before it is cached under the old version
+    """
+    if keys is None:
+        transaction.on_commit(evict_all)
+        return
+    keys = list(keys)
+    transaction.on_commit(lambda: evict_usage_records(keys))
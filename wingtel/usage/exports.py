@@ -0,0 +1,131 @@
+"""
+Streaming exports of daily usage records as CSV, Arrow IPC stream or Parquet.
+Records are read in batches from a server-side cursor and every batch is written out as one row group,
+so memory is bounded by the batch size. pyarrow is optional, it's needed by the arrow and parquet formats only
+"""
+import csv
+import io
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
+from django.core.exceptions import ImproperlyConfigured
+
+CSV, ARROW, PARQUET = "csv", "arrow", "parquet"
+EXPORT_FORMATS = (CSV, ARROW, PARQUET)
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    ARROW: "application/vnd.apache.arrow.stream",
+    PARQUET: "application/vnd.apache.parquet",
+}
+EXTENSIONS = {CSV: "csv", ARROW: "arrows", PARQUET: "parquet"}
+EXPORT_FIELDS = ("type_of_usage", "subscription_id", "usage_date", "price", "used")
+
+# values of EXPORT_FIELDS
+UsageRecordRow = Tuple
+
+
+def batched(rows: Iterable[UsageRecordRow], batch_size: int) -> Iterator[List[UsageRecordRow]]:
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ImproperlyConfigured("Arrow and Parquet exports need pyarrow, pip install pyarrow")
+    return pyarrow
+
+
+class DrainableBuffer(io.RawIOBase):
+    """Write-only file whose content written so far is taken out by drain, pyarrow writers write to it"""
+
+    def __init__(self) -> None:
+        self.buffer = io.BytesIO()
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        size = self.buffer.write(data)
+        self.position += size
+        return size
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        return data
+
+
+class UsageRecordExporter:
+    """Encode rows of EXPORT_FIELDS in the given format, yielding one bytes chunk per batch of batch_size rows"""
+
+    def __init__(self, export_format: str, batch_size: int = 100000) -> None:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Export format must be one of {', '.join(EXPORT_FORMATS)}")
+        if export_format != CSV:
+            # fail before the first chunk is sent
+            import_pyarrow()
+        self.export_format = export_format
+        self.batch_size = batch_size
+
+    def export(self, rows: Iterable[UsageRecordRow]) -> Iterator[bytes]:
+        batches = batched(rows, self.batch_size)
+        if self.export_format == CSV:
+            return self.export_csv(batches)
+        return self.export_arrow(batches)
+
+    def export_csv(self, batches: Iterable[List[UsageRecordRow]]) -> Iterator[bytes]:
+        file = io.StringIO()
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_FIELDS)
+        for batch in batches:
+            writer.writerows(batch)
+            yield file.getvalue().encode()
+            file.seek(0)
+            file.truncate()
+        # the header of an empty export
+        if file.tell():
+            yield file.getvalue().encode()
+
+    def get_arrow_schema(self):
+        pyarrow = import_pyarrow()
+        return pyarrow.schema(
+            [
+                ("type_of_usage", pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+                ("subscription_id", pyarrow.int64()),
+                ("usage_date", pyarrow.date32()),
+                ("price", pyarrow.decimal128(12, 2)),
+                ("used", pyarrow.int64()),
+            ]
+        )
+
+    def export_arrow(self, batches: Iterable[List[UsageRecordRow]]) -> Iterator[bytes]:
+        pyarrow = import_pyarrow()
+        schema = self.get_arrow_schema()
+        sink = DrainableBuffer()
+        if self.export_format == PARQUET:
+            writer = pyarrow.parquet.ParquetWriter(sink, schema)
+            write = writer.write_table
+        else:
+            writer = pyarrow.ipc.new_stream(sink, schema)
+            write = writer.write_batch
+        try:
+            for batch in batches:
+                record_batch = pyarrow.RecordBatch.from_arrays(
+                    [pyarrow.array(column, field.type) for column, field in zip(zip(*batch), schema)], schema=schema
+                )
+                write(pyarrow.Table.from_batches([record_batch]) if self.export_format == PARQUET else record_batch)
+                yield sink.drain()
+        finally:
+            writer.close()
+        yield sink.drain()
@@ -0,0 +1,62 @@
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from wingtel.usage.archive import ARCHIVE_FORMATS, RawUsageArchive
+from wingtel.usage.backends import MATERIALIZED_VIEW, VIEW, get_aggregation_backend
+from wingtel.usage.models import UsageRecord
+
+
+class Command(BaseCommand):
+    help = (
+        "Move raw usage records older than the dispute window to compressed Parquet (or gzipped CSV) files, "
+        "one per day and type of usage, listed in manifest.json. Archived rows are deleted in small batches, "
+        "UsageRecord aggregates are kept, archived days are recorded so rebuilds and reconciliations skip them. "
+        "restore_raw_usage loads them back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--directory", default=settings.USAGE_ARCHIVE_DIRECTORY)
+        parser.add_argument(
+            "--before",
+            type=date.fromisoformat,
+            help=f"Archive days before this one, defaults to {settings.USAGE_RAW_DISPUTE_WINDOW_DAYS} days ago",
+        )
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="Defaults to the first usage")
+        parser.add_argument("--type", dest="type_of_usage", choices=list(UsageRecord.USAGE_TYPE_CODES))
+        parser.add_argument("--format", dest="file_format", choices=ARCHIVE_FORMATS, help="parquet with pyarrow")
+        parser.add_argument("--batch-size", type=int, default=100000, help="Rows per fetch and Parquet row group")
+        parser.add_argument("--delete-batch-size", type=int, default=5000, help="Rows per DELETE transaction")
+
+    def handle(self, *args, **options):
+        if get_aggregation_backend() in (VIEW, MATERIALIZED_VIEW):
+            raise CommandError("The view backends aggregate the raw tables, archived records would be lost to them")
+        try:
+            archive = RawUsageArchive(options["directory"], options["file_format"], options["batch_size"])
+        except ImproperlyConfigured as error:
+            raise CommandError(str(error))
+        before = options["before"] or timezone.now().date() - timedelta(days=settings.USAGE_RAW_DISPUTE_WINDOW_DAYS)
+        record_types = (
+            [UsageRecord.USAGE_TYPE_CODES[options["type_of_usage"]]]
+            if options["type_of_usage"]
+            else list(UsageRecord.RAW_MODELS)
+        )
+
+        archived = 0
+        for record_type in record_types:
+            model = UsageRecord.RAW_MODELS[record_type]
+            first = options["date_from"]
+            if first is None:
+                cutoff = datetime.combine(before, time(), timezone.utc)
+                oldest = model.objects.filter(usage_date__lt=cutoff).aggregate(oldest=Min("usage_date"))["oldest"]
+                first = oldest and timezone.localtime(oldest, timezone.utc).date()
+            for day in range((before - first).days if first else 0):
+                entry = archive.archive_day(record_type, first + timedelta(days=day), options["delete_batch_size"])
+                if entry:
+                    archived += entry["rows"]
+                    self.stdout.write(f"Archived {entry['rows']} rows to {entry['file']}, deleted {entry['deleted']}")
+        self.stdout.write(f"Archived {archived} raw usage records before {before} to {options['directory']}")
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from wingtel.usage.services import CompactUsageRecordShardsService
+
+
+class Command(BaseCommand):
+    help = "Fold pending UsageRecordShard rows of the sharded mode into UsageRecord and its rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="Shards folded per statement")
+        parser.add_argument(
+            "--interval", type=float, default=None, help="Keep compacting every given number of seconds"
+        )
+
+    def handle(self, *args, **options):
+        service = CompactUsageRecordShardsService(batch_size=options["batch_size"])
+        while True:
+            batches = service.compact()
+            self.stdout.write(f"Compacted usage shards in {batches} batches")
+            if options["interval"] is None:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wingtel.usage.partitions import get_raw_usage_partitions
+
+
+class Command(BaseCommand):
+    help = "Create monthly partitions of the raw usage tables ahead of time, run it from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months-ahead", type=int, default=settings.USAGE_PARTITIONS_MONTHS_AHEAD)
+
+    def handle(self, *args, **options):
+        for partitions in get_raw_usage_partitions():
+            for name in partitions.ensure(options["months_ahead"]):
+                self.stdout.write(f"Created {name}")
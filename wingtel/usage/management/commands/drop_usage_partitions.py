@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from wingtel.usage.backends import MATERIALIZED_VIEW, VIEW, get_aggregation_backend
+from wingtel.usage.partitions import get_raw_usage_partitions
+from wingtel.usage.utils import add_months
+
+
+class Command(BaseCommand):
+    help = (
+        "Detach and drop raw usage partitions older than the retention period. "
+        "UsageRecord aggregates of the dropped records are kept and become the only copy of those days, "
+        "the cutoff is recorded so rebuild_usage_aggregates and reconcile_usage_aggregates don't zero them. "
+        "Refused with the view backends, which aggregate the raw tables"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep-months",
+            type=int,
+            default=settings.USAGE_RAW_RETENTION_MONTHS,
+            help="Number of full months to keep before the current one",
+        )
+
+    def handle(self, *args, **options):
+        if get_aggregation_backend() in (VIEW, MATERIALIZED_VIEW):
+            raise CommandError("The view backends aggregate the raw tables, dropped records would be lost to them")
+        current = timezone.now().date().replace(day=1)
+        cutoff = add_months(current, -options["keep_months"])
+        for partitions in get_raw_usage_partitions():
+            for name in partitions.drop_before(cutoff):
+                self.stdout.write(f"Dropped {name}")
+        self.stdout.write(f"Raw usage records before {cutoff} are removed")
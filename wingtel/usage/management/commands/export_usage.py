@@ -0,0 +1,48 @@
+import sys
+import time
+from datetime import date
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from wingtel.usage.exports import EXPORT_FORMATS, UsageRecordExporter
+from wingtel.usage.models import UsageRecord
+from wingtel.usage.selectors import get_usage_records_for_export
+
+
+class Command(BaseCommand):
+    help = (
+        "Export daily usage records of a date range as CSV, an Arrow IPC stream or Parquet. "
+        "Records are read from a server-side cursor and written one batch (row group) at a time"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Output file, - writes to stdout")
+        parser.add_argument("--format", dest="file_format", choices=EXPORT_FORMATS, default=EXPORT_FORMATS[0])
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat)
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat)
+        parser.add_argument("--type", dest="type_of_usage", choices=list(UsageRecord.USAGE_TYPE_CODES))
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.USAGE_EXPORT_BATCH_SIZE, help="Rows per batch/row group"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            exporter = UsageRecordExporter(options["file_format"], options["batch_size"])
+        except ImproperlyConfigured as error:
+            raise CommandError(str(error))
+        records = get_usage_records_for_export(
+            options["date_from"], options["date_to"], UsageRecord.USAGE_TYPE_CODES.get(options["type_of_usage"])
+        ).iterator(chunk_size=options["batch_size"])
+
+        started, size = time.perf_counter(), 0
+        file = sys.stdout.buffer if options["output"] == "-" else open(options["output"], "wb")
+        try:
+            for chunk in exporter.export(records):
+                file.write(chunk)
+                size += len(chunk)
+        finally:
+            if file is not sys.stdout.buffer:
+                file.close()
+        self.stderr.write(f"Exported {size} bytes in {time.perf_counter() - started:.2f}s")
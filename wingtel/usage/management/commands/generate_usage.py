@@ -0,0 +1,132 @@
+import csv
+import io
+import math
+import random
+import time
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+from typing import List
+
+import pytz
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from wingtel.subscriptions.models import Subscription
+from wingtel.usage.models import UsageRecord
+from wingtel.usage.partitions import RawUsagePartitions
+from wingtel.usage.services import ImportUsageRecordService
+from wingtel.usage.utils import add_months
+
+MAX_PRICE = 999.99
+# relative activity by hour of day (UTC), the lowest at 08:00 and the highest at 20:00
+HOUR_WEIGHTS = [0.2 + 1 + math.cos(2 * math.pi * (hour - 20) / 24) for hour in range(24)]
+# log-normal parameters of used kilobytes/seconds and the unit price of a record type
+USAGE_PROFILES = {
+    UsageRecord.USAGE_TYPES.data: (math.log(500), 1.0, float(Subscription.ONE_KILOBYTE_PRICE)),
+    UsageRecord.USAGE_TYPES.voice: (math.log(120), 0.8, float(Subscription.ONE_SECOND_PRICE)),
+}
+
+
+class UsageGenerator:
+    """
+    Random raw usage records: subscription activity follows a Zipf distribution, timestamps a diurnal profile,
+    price is proportional to the used kilobytes/seconds with some noise. The same seed gives the same records
+    """
+
+    def __init__(self, subscription_ids: List[int], date_from: date, date_to: date, zipf_exponent: float, seed: int):
+        self.rnd = random.Random(seed)
+        self.subscription_ids = list(subscription_ids)
+        # the most active subscriptions are spread over the id range
+        self.rnd.shuffle(self.subscription_ids)
+        self.subscription_weights = list(
+            accumulate(1 / rank**zipf_exponent for rank in range(1, len(self.subscription_ids) + 1))
+        )
+        self.hour_weights = list(accumulate(HOUR_WEIGHTS))
+        self.start = datetime.combine(date_from, datetime.min.time(), pytz.utc)
+        self.days = (date_to - date_from).days + 1
+
+    def write_batch(self, file, record_type: int, size: int):
+        """Write size records of record_type as CSV with a header"""
+        mu, sigma, unit_price = USAGE_PROFILES[record_type]
+        subscription_ids = self.rnd.choices(self.subscription_ids, cum_weights=self.subscription_weights, k=size)
+        hours = self.rnd.choices(range(24), cum_weights=self.hour_weights, k=size)
+        writer = csv.writer(file)
+        writer.writerow(["subscription_id", "price", "usage_date", UsageRecord.RAW_MODELS[record_type].USED_FIELD])
+        for subscription_id, hour in zip(subscription_ids, hours):
+            usage_date = self.start + timedelta(
+                days=self.rnd.randrange(self.days), hours=hour, seconds=self.rnd.randrange(3600)
+            )
+            used = min(int(self.rnd.lognormvariate(mu, sigma)), 2**31 - 1)
+            price = min(used * unit_price * max(self.rnd.gauss(1, 0.1), 0), MAX_PRICE)
+            writer.writerow([subscription_id, f"{price:.2f}", usage_date.isoformat(), used])
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate subscriptions and random data/voice usage records for load testing. "
+        "Records are written in batches through COPY and aggregated with set-based SQL, signals are not fired"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--records", type=int, default=100000, help="Number of raw usage records")
+        parser.add_argument(
+            "--subscriptions", type=int, default=1000, help="New subscriptions, 0 spreads records over existing ones"
+        )
+        parser.add_argument("--voice-ratio", type=float, default=0.3, help="Share of voice records")
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="Defaults to 90 days ago")
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="Defaults to today")
+        parser.add_argument("--zipf-exponent", type=float, default=1.1, help="Skew of the subscription activity")
+        parser.add_argument("--batch-size", type=int, default=100000, help="Records per COPY")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        date_to = options["date_to"] or timezone.now().date()
+        date_from = options["date_from"] or date_to - timedelta(days=89)
+        if date_from > date_to:
+            raise CommandError("--from is after --to")
+        subscription_ids = self.get_subscription_ids(options["subscriptions"])
+        if not subscription_ids:
+            raise CommandError("There are no subscriptions to generate usage for")
+        self.create_partitions(date_from, date_to)
+
+        generator = UsageGenerator(subscription_ids, date_from, date_to, options["zipf_exponent"], options["seed"])
+        voice_records = round(options["records"] * options["voice_ratio"])
+        started = time.perf_counter()
+        for record_type, count in (
+            (UsageRecord.USAGE_TYPES.data, options["records"] - voice_records),
+            (UsageRecord.USAGE_TYPES.voice, voice_records),
+        ):
+            for offset in range(0, count, options["batch_size"]):
+                file = io.StringIO()
+                generator.write_batch(file, record_type, min(options["batch_size"], count - offset))
+                file.seek(0)
+                ImportUsageRecordService(file, record_type).import_records()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Generated {options['records']} usage records for {len(subscription_ids)} subscriptions "
+            f"in {elapsed:.2f}s ({options['records'] / elapsed:.0f} rows/s)"
+        )
+
+    @staticmethod
+    def get_subscription_ids(count: int) -> List[int]:
+        if not count:
+            return list(Subscription.objects.order_by("id").values_list("id", flat=True))
+        user, _ = User.objects.get_or_create(username="generate_usage")
+        subscriptions = Subscription.objects.bulk_create(
+            [Subscription(user=user, type_of_subscription=Subscription.SUBSCRIPTION_TYPE.att) for _ in range(count)],
+            batch_size=10000,
+        )
+        return [subscription.id for subscription in subscriptions]
+
+    @staticmethod
+    def create_partitions(date_from: date, date_to: date):
+        """Monthly partitions of the date range, so the records don't land in the default partition"""
+        months, month = [], date_from.replace(day=1)
+        while month <= date_to:
+            months.append(month)
+            month = add_months(month, 1)
+        for model in UsageRecord.RAW_MODELS.values():
+            partitions = RawUsagePartitions(model)
+            if partitions.is_partitioned():
+                partitions.create_missing(months)
@@ -0,0 +1,44 @@
+import gzip
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DataError, IntegrityError
+
+from wingtel.usage.models import UsageRecord
+from wingtel.usage.services import ImportUsageRecordService
+
+
+class Command(BaseCommand):
+    help = "Import raw data/voice usage records from CSV or NDJSON files (optionally gzipped) through COPY"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+")
+        parser.add_argument("--type", dest="record_type", required=True, choices=list(UsageRecord.USAGE_TYPE_CODES))
+        parser.add_argument(
+            "--format",
+            dest="file_format",
+            choices=ImportUsageRecordService.FORMATS,
+            help="Detected from the file extension by default",
+        )
+
+    def handle(self, *args, **options):
+        record_type = UsageRecord.USAGE_TYPE_CODES[options["record_type"]]
+        for path in options["paths"]:
+            file_format = options["file_format"] or self.get_file_format(path)
+            opener = gzip.open if path.endswith(".gz") else open
+            started = time.perf_counter()
+            try:
+                with opener(path, "rt", newline="") as file:
+                    imported = ImportUsageRecordService(file, record_type, file_format).import_records()
+            except (OSError, ValueError, DataError, IntegrityError) as error:
+                raise CommandError(f"{path}: {error}")
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"Imported {imported} {options['record_type']} usage records from {path} "
+                f"in {elapsed:.2f}s ({imported / elapsed:.0f} rows/s)"
+            )
+
+    @staticmethod
+    def get_file_format(path: str) -> str:
+        name = path[: -len(".gz")] if path.endswith(".gz") else path
+        return "ndjson" if name.endswith((".ndjson", ".jsonl")) else "csv"
@@ -0,0 +1,110 @@
+import multiprocessing
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from wingtel.subscriptions.models import Subscription
+from wingtel.usage.models import UsageRecord, UsageRecordRebuildCheckpoint
+from wingtel.usage.selectors import get_raw_usage_types, get_usage_date_range
+from wingtel.usage.services import NULL_SUBSCRIPTION_RANGE, RebuildUsageRecordService
+
+Chunk = Tuple[date, Optional[int], Optional[int]]
+
+
+def rebuild_chunk(job: str, chunk: Chunk, record_types: List[int]) -> Chunk:
+    """Rebuild one chunk of the types of usage with raw records and checkpoint it in the same transaction"""
+    usage_date, subscription_from, subscription_to = chunk
+    subscription_range = (subscription_from, subscription_to) if subscription_from is not None else None
+    with transaction.atomic():
+        RebuildUsageRecordService(usage_date, subscription_range, record_types).rebuild()
+        UsageRecordRebuildCheckpoint.objects.create(
+            job=job, usage_date=usage_date, subscription_from=subscription_from, subscription_to=subscription_to
+        )
+    return chunk
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute UsageRecord from the raw usage tables with INSERT ... SELECT ... GROUP BY, "
+        "one day or subscription range at a time. Finished chunks are checkpointed, "
+        "so running the same job again resumes after an interruption. Days whose raw records were dropped "
+        "or archived keep their aggregates, a range given with --from/--to must not include them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="Defaults to the first usage")
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="Defaults to the last usage")
+        parser.add_argument(
+            "--subscription-chunk-size", type=int, help="Split every day into subscription id ranges of this size"
+        )
+        parser.add_argument("--workers", type=int, default=1, help="Rebuild chunks in parallel worker processes")
+        parser.add_argument("--job", help="Checkpoint name, defaults to one derived from the arguments")
+        parser.add_argument("--restart", action="store_true", help="Drop the job checkpoints and start over")
+
+    def handle(self, *args, **options):
+        date_from, date_to = self.get_date_range(options["date_from"], options["date_to"])
+        if date_from is None:
+            self.stdout.write("No usage records to aggregate")
+            return
+        days = self.get_days(date_from, date_to, bool(options["date_from"] or options["date_to"]))
+        chunk_size = options["subscription_chunk_size"]
+        job = options["job"] or f"{date_from}:{date_to}:{chunk_size or ''}"
+        checkpoints = UsageRecordRebuildCheckpoint.objects.filter(job=job)
+        if options["restart"]:
+            checkpoints.delete()
+        completed = set(checkpoints.values_list("usage_date", "subscription_from", "subscription_to"))
+        chunks = [chunk for chunk in self.get_chunks(days, chunk_size) if chunk not in completed]
+        self.stdout.write(f"Job {job}: {len(completed)} chunks already done, {len(chunks)} to rebuild")
+
+        if options["workers"] > 1:
+            # forked workers must open their own connections
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(options["workers"]) as pool:
+                for chunk in pool.starmap(rebuild_chunk, [(job, chunk, days[chunk[0]]) for chunk in chunks]):
+                    self.write_chunk(chunk)
+        else:
+            for chunk in chunks:
+                self.write_chunk(rebuild_chunk(job, chunk, days[chunk[0]]))
+
+    def get_date_range(self, date_from: Optional[date], date_to: Optional[date]):
+        if date_from and date_to:
+            if date_from > date_to:
+                raise CommandError("--from must not be after --to")
+            return date_from, date_to
+        first, last = get_usage_date_range()
+        if first is None:
+            return None, None
+        return date_from or first, date_to or last
+
+    def get_days(self, date_from: date, date_to: date, explicit: bool) -> Dict[date, List[int]]:
+        """Types of usage with raw records by day, the aggregates of dropped or archived ones are kept"""
+        raw_types = get_raw_usage_types(date_from, date_to)
+        removed = [day for day, record_types in raw_types.items() if len(record_types) < len(UsageRecord.RAW_MODELS)]
+        if explicit and removed:
+            raise CommandError(
+                f"Raw usage records of {len(removed)} days from {removed[0]} to {removed[-1]} were dropped or "
+                "archived, their aggregates can't be rebuilt"
+            )
+        return {day: record_types for day, record_types in raw_types.items() if record_types}
+
+    def get_chunks(self, days: Iterable[date], chunk_size: Optional[int]) -> List[Chunk]:
+        ranges: List[Tuple[Optional[int], Optional[int]]] = [(None, None)]
+        if chunk_size:
+            ids = Subscription.objects.aggregate(first=Min("id"), last=Max("id"))
+            first, last = ids["first"] or 0, ids["last"] or 0
+            ranges = [(start, start + chunk_size - 1) for start in range(first, last + 1, chunk_size)]
+            # BETWEEN never matches records without a subscription
+            ranges.append(NULL_SUBSCRIPTION_RANGE)
+        return [(day, *subscription_range) for day in days for subscription_range in ranges]
+
+    def write_chunk(self, chunk: Chunk):
+        usage_date, subscription_from, subscription_to = chunk
+        if subscription_from is None:
+            self.stdout.write(f"Rebuilt {usage_date}")
+        elif (subscription_from, subscription_to) == NULL_SUBSCRIPTION_RANGE:
+            self.stdout.write(f"Rebuilt {usage_date} records without a subscription")
+        else:
+            self.stdout.write(f"Rebuilt {usage_date} subscriptions {subscription_from}-{subscription_to}")
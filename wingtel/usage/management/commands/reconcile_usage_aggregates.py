@@ -0,0 +1,97 @@
+import multiprocessing
+from datetime import date
+from decimal import Decimal
+from typing import Dict, List, Optional, Union
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from wingtel.usage.backends import MATERIALIZED_VIEW, VIEW, get_aggregation_backend
+from wingtel.usage.models import UsageRecord
+from wingtel.usage.selectors import get_raw_usage_types, get_usage_date_range
+from wingtel.usage.services import ReconcileUsageRecordService
+
+Stats = Dict[str, Union[int, Decimal]]
+
+
+def reconcile_day(usage_date: date, chunk_size: int, repair: bool, record_types: List[int]) -> Stats:
+    return {"date": usage_date, **ReconcileUsageRecordService(usage_date, chunk_size, repair, record_types).reconcile()}
+
+
+class Command(BaseCommand):
+    help = (
+        "Find and repair drift of UsageRecord from the raw usage tables, e.g. after QuerySet.update()/delete(), "
+        "bulk_create or lost concurrent updates. Every day is compared by checksums of subscription id ranges "
+        "and only the ranges that differ are rebuilt. Days whose raw records were dropped or archived keep their "
+        "aggregates, a range given with --from/--to must not include them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="Defaults to the first usage")
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="Defaults to the last usage")
+        parser.add_argument(
+            "--subscription-chunk-size", type=int, default=1000, help="Subscription ids per checksum and repair"
+        )
+        parser.add_argument("--workers", type=int, default=1, help="Reconcile days in parallel worker processes")
+        parser.add_argument("--dry-run", action="store_true", help="Report the drift without repairing it")
+
+    def handle(self, *args, **options):
+        if get_aggregation_backend() in (VIEW, MATERIALIZED_VIEW):
+            raise CommandError("The view backends don't store aggregates, there is nothing to reconcile")
+        date_from, date_to = self.get_date_range(options["date_from"], options["date_to"])
+        if date_from is None:
+            self.stdout.write("No usage records to reconcile")
+            return
+        repair = not options["dry_run"]
+        days = self.get_days(date_from, date_to, bool(options["date_from"] or options["date_to"]))
+        arguments = [
+            (usage_date, options["subscription_chunk_size"], repair, record_types)
+            for usage_date, record_types in days.items()
+        ]
+
+        totals: Stats = {"days": 0, "chunks": 0, "mismatched_chunks": 0, "keys": 0, "price": Decimal(0), "used": 0}
+        if options["workers"] > 1:
+            # forked workers must open their own connections
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(options["workers"]) as pool:
+                for stats in pool.starmap(reconcile_day, arguments):
+                    self.add_day(totals, stats, repair)
+        else:
+            for day_arguments in arguments:
+                self.add_day(totals, reconcile_day(*day_arguments), repair)
+
+        self.stdout.write(
+            f"Checked {totals['days']} days in {totals['chunks']} chunks, {totals['mismatched_chunks']} mismatched: "
+            f"{totals['keys']} aggregates {'repaired' if repair else 'drifted'}, "
+            f"price drift {totals['price']}, used drift {totals['used']}"
+        )
+
+    def get_date_range(self, date_from: Optional[date], date_to: Optional[date]):
+        if date_from and date_to and date_from > date_to:
+            raise CommandError("--from must not be after --to")
+        first, last = get_usage_date_range()
+        if first is None and not (date_from and date_to):
+            return None, None
+        return date_from or first, date_to or last
+
+    def get_days(self, date_from: date, date_to: date, explicit: bool) -> Dict[date, List[int]]:
+        """Types of usage with raw records by day, the aggregates of dropped or archived ones are the only copy"""
+        raw_types = get_raw_usage_types(date_from, date_to)
+        removed = [day for day, record_types in raw_types.items() if len(record_types) < len(UsageRecord.RAW_MODELS)]
+        if explicit and removed:
+            raise CommandError(
+                f"Raw usage records of {len(removed)} days from {removed[0]} to {removed[-1]} were dropped or "
+                "archived, their aggregates can't be reconciled"
+            )
+        return {day: record_types for day, record_types in raw_types.items() if record_types}
+
+    def add_day(self, totals: Stats, stats: Stats, repair: bool):
+        usage_date = stats.pop("date")
+        totals["days"] += 1
+        for name, value in stats.items():
+            totals[name] += value
+        if stats["mismatched_chunks"]:
+            self.stdout.write(
+                f"{usage_date}: {stats['mismatched_chunks']} of {stats['chunks']} chunks mismatched, "
+                f"{stats['keys']} aggregates {'repaired' if repair else 'drifted'}"
+            )
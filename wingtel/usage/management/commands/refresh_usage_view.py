@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wingtel.usage.backends import MATERIALIZED_VIEW, get_aggregation_backend
+from wingtel.usage.services import RefreshUsageRecordMaterializedViewService
+
+
+class Command(BaseCommand):
+    help = "Refresh the materialized view of daily usage records of the materialized_view aggregation backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval", type=float, default=None, help="Keep refreshing every given number of seconds"
+        )
+        parser.add_argument(
+            "--blocking", action="store_true", help="Refresh without CONCURRENTLY, faster but blocks readers"
+        )
+
+    def handle(self, *args, **options):
+        if get_aggregation_backend() != MATERIALIZED_VIEW:
+            raise CommandError(f"USAGE_AGGREGATION_BACKEND isn't {MATERIALIZED_VIEW}")
+        service = RefreshUsageRecordMaterializedViewService(concurrently=not options["blocking"])
+        while True:
+            started = time.perf_counter()
+            refreshed_at = service.refresh()
+            self.stdout.write(
+                f"Refreshed usage records as of {refreshed_at.isoformat()} in {time.perf_counter() - started:.2f}s"
+            )
+            if options["interval"] is None:
+                return
+            time.sleep(options["interval"])
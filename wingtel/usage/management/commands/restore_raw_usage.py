@@ -0,0 +1,45 @@
+from datetime import date
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from wingtel.usage.archive import RawUsageArchive
+from wingtel.usage.models import UsageRecord
+
+
+class Command(BaseCommand):
+    help = (
+        "Load raw usage records of a day range archived by archive_raw_usage back with COPY, one transaction "
+        "per day and type of usage. Aggregates aren't changed, restored files are removed from the archive "
+        "and the days can be rebuilt and reconciled again"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--directory", default=settings.USAGE_ARCHIVE_DIRECTORY)
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat, required=True)
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat, required=True)
+        parser.add_argument("--type", dest="type_of_usage", choices=list(UsageRecord.USAGE_TYPE_CODES))
+
+    def handle(self, *args, **options):
+        if options["date_from"] > options["date_to"]:
+            raise CommandError("--from must not be after --to")
+        try:
+            # the format of every file is in the manifest
+            archive = RawUsageArchive(options["directory"])
+        except ImproperlyConfigured as error:
+            raise CommandError(str(error))
+        days = sorted(
+            {
+                (UsageRecord.USAGE_TYPE_CODES[entry["type_of_usage"]], date.fromisoformat(entry["usage_date"]))
+                for entry in archive.get_manifest()
+                if options["date_from"].isoformat() <= entry["usage_date"] <= options["date_to"].isoformat()
+                and options["type_of_usage"] in (None, entry["type_of_usage"])
+            }
+        )
+        restored = 0
+        for record_type, day in days:
+            rows = archive.restore_day(record_type, day)
+            restored += rows
+            self.stdout.write(f"Restored {rows} {UsageRecord.USAGE_TYPE_NAMES[record_type]} rows of {day}")
+        self.stdout.write(f"Restored {restored} raw usage records")
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+MERGE_DUPLICATES_SQL = """
+    UPDATE usage_usagerecord AS kept
+    SET price = duplicates.price, used = duplicates.used
+    FROM (
+        SELECT min(id) AS id, sum(price) AS price, sum(used) AS used
+        FROM usage_usagerecord
+        GROUP BY type_of_usage, subscription_id, usage_date
+        HAVING count(*) > 1
+    ) AS duplicates
+    WHERE kept.id = duplicates.id;
+
+    DELETE FROM usage_usagerecord AS duplicate
+    USING usage_usagerecord AS kept
+    WHERE duplicate.type_of_usage = kept.type_of_usage
+        AND duplicate.subscription_id = kept.subscription_id
+        AND duplicate.usage_date = kept.usage_date
+        AND duplicate.id > kept.id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("usage", "0002_add_usage_records"),
+    ]
+
+    operations = [
+        migrations.RunSQL(MERGE_DUPLICATES_SQL, migrations.RunSQL.noop),
+        migrations.AddConstraint(
+            model_name="usagerecord",
+            constraint=models.UniqueConstraint(
+                fields=("type_of_usage", "subscription", "usage_date"), name="unique_usage_record"
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("usage", "0003_usage_record_unique_constraint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsageRecordRebuildCheckpoint",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("job", models.CharField(max_length=100)),
+                ("usage_date", models.DateField()),
+                ("subscription_from", models.IntegerField(null=True)),
+                ("subscription_to", models.IntegerField(null=True)),
+                ("completed_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="usagerecordrebuildcheckpoint",
+            constraint=models.UniqueConstraint(
+                fields=("job", "usage_date", "subscription_from", "subscription_to"), name="unique_rebuild_checkpoint"
+            ),
+        ),
+    ]
@@ -0,0 +1,94 @@
+from datetime import date
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+from django.utils import timezone
+
+RAW_TABLES = ["usage_datausagerecord", "usage_voiceusagerecord"]
+MONTHS_AHEAD = 3
+
+
+def get_constraint_names(schema_editor, table):
+    with schema_editor.connection.cursor() as cursor:
+        constraints = schema_editor.connection.introspection.get_constraints(cursor, table)
+    foreign_key = next(name for name, options in constraints.items() if options["foreign_key"])
+    index = next(
+        name
+        for name, options in constraints.items()
+        if options["index"] and options["columns"] == ["subscription_id_id"] and not options["unique"]
+    )
+    return foreign_key, index
+
+
+def get_months(schema_editor, table):
+    """First days of months from the oldest raw record to MONTHS_AHEAD months from now"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"SELECT min(usage_date) FROM {table}")
+        oldest = cursor.fetchone()[0]
+    today = timezone.now().date()
+    month = min(oldest.date(), today).replace(day=1) if oldest else today.replace(day=1)
+    last = (today.year * 12 + today.month - 1) + MONTHS_AHEAD
+    months = []
+    while month.year * 12 + month.month - 1 <= last:
+        months.append(month)
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return months
+
+
+def rebuild_table(schema_editor, table, partitioned):
+    foreign_key, index = get_constraint_names(schema_editor, table)
+    old_table = f"{table}_old"
+    schema_editor.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+    if partitioned:
+        schema_editor.execute(
+            f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS) PARTITION BY RANGE (usage_date)"
+        )
+        schema_editor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        for month in get_months(schema_editor, old_table):
+            next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+            schema_editor.execute(
+                f"CREATE TABLE {table}_p{month:%Y_%m} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{month} 00:00+00') TO ('{next_month} 00:00+00')"
+            )
+    else:
+        schema_editor.execute(f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS)")
+    schema_editor.execute(f"INSERT INTO {table} SELECT * FROM {old_table}")
+    schema_editor.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+    schema_editor.execute(f"DROP TABLE {old_table} CASCADE")
+
+    primary_key = "id, usage_date" if partitioned else "id"
+    schema_editor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({primary_key})")
+    schema_editor.execute(
+        f"ALTER TABLE {table} ADD CONSTRAINT {foreign_key} FOREIGN KEY (subscription_id_id) "
+        f"REFERENCES subscriptions_subscription (id) DEFERRABLE INITIALLY DEFERRED"
+    )
+    schema_editor.execute(f"CREATE INDEX {index} ON {table} (subscription_id_id)")
+
+
+def partition_raw_tables(apps, schema_editor):
+    for table in RAW_TABLES:
+        rebuild_table(schema_editor, table, partitioned=True)
+
+
+def unpartition_raw_tables(apps, schema_editor):
+    for table in RAW_TABLES:
+        rebuild_table(schema_editor, table, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("usage", "0004_usage_record_rebuild_checkpoint"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_raw_tables, unpartition_raw_tables),
+        migrations.AddIndex(
+            model_name="datausagerecord",
+            index=django.contrib.postgres.indexes.BrinIndex(fields=["usage_date"], name="usage_data_date_brin"),
+        ),
+        migrations.AddIndex(
+            model_name="voiceusagerecord",
+            index=django.contrib.postgres.indexes.BrinIndex(fields=["usage_date"], name="usage_voice_date_brin"),
+        ),
+    ]
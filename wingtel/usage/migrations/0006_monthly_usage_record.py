@@ -0,0 +1,48 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+ADD_MONTHLY_USAGE_RECORDS_SQL = """
+    INSERT INTO usage_monthlyusagerecord (type_of_usage, subscription_id, usage_month, price, used)
+    SELECT type_of_usage, subscription_id, date_trunc('month', usage_date)::date, sum(price), sum(used)
+    FROM usage_usagerecord
+    GROUP BY type_of_usage, subscription_id, date_trunc('month', usage_date)::date
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("subscriptions", "0001_initial"),
+        ("usage", "0005_partition_raw_usage_records"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonthlyUsageRecord",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "type_of_usage",
+                    models.CharField(choices=[("data", "DataUsage"), ("voice", "VoiceUsage")], max_length=100),
+                ),
+                ("price", models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ("usage_month", models.DateField()),
+                ("used", models.BigIntegerField()),
+                (
+                    "subscription",
+                    models.ForeignKey(
+                        null=True, on_delete=django.db.models.deletion.PROTECT, to="subscriptions.Subscription"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="monthlyusagerecord",
+            constraint=models.UniqueConstraint(
+                fields=("type_of_usage", "subscription", "usage_month"), name="unique_monthly_usage_record"
+            ),
+        ),
+        migrations.RunSQL(ADD_MONTHLY_USAGE_RECORDS_SQL, migrations.RunSQL.noop),
+    ]
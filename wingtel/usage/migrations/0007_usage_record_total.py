@@ -0,0 +1,47 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+ADD_USAGE_RECORD_TOTALS_SQL = """
+    INSERT INTO usage_usagerecordtotal (type_of_usage, subscription_id, total_price, total_used)
+    SELECT type_of_usage, subscription_id, sum(price), sum(used)
+    FROM usage_usagerecord
+    GROUP BY type_of_usage, subscription_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("subscriptions", "0001_initial"),
+        ("usage", "0006_monthly_usage_record"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsageRecordTotal",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "type_of_usage",
+                    models.CharField(choices=[("data", "DataUsage"), ("voice", "VoiceUsage")], max_length=100),
+                ),
+                ("total_price", models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=14)),
+                ("total_used", models.BigIntegerField()),
+                (
+                    "subscription",
+                    models.ForeignKey(
+                        null=True, on_delete=django.db.models.deletion.PROTECT, to="subscriptions.Subscription"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="usagerecordtotal",
+            constraint=models.UniqueConstraint(
+                fields=("type_of_usage", "subscription"), name="unique_usage_record_total"
+            ),
+        ),
+        migrations.RunSQL(ADD_USAGE_RECORD_TOTALS_SQL, migrations.RunSQL.noop),
+    ]
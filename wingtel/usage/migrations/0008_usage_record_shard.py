@@ -0,0 +1,41 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("subscriptions", "0001_initial"),
+        ("usage", "0007_usage_record_total"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsageRecordShard",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "type_of_usage",
+                    models.CharField(choices=[("data", "DataUsage"), ("voice", "VoiceUsage")], max_length=100),
+                ),
+                ("usage_date", models.DateField()),
+                ("shard", models.PositiveSmallIntegerField()),
+                ("price", models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ("used", models.BigIntegerField()),
+                (
+                    "subscription",
+                    models.ForeignKey(
+                        null=True, on_delete=django.db.models.deletion.PROTECT, to="subscriptions.Subscription"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="usagerecordshard",
+            constraint=models.UniqueConstraint(
+                fields=("type_of_usage", "subscription", "usage_date", "shard"), name="unique_usage_record_shard"
+            ),
+        ),
+    ]
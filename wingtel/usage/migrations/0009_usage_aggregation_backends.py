@@ -0,0 +1,46 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:31
+
+from django.db import migrations, models
+
+# The view and the triggers are built from the current code by the post_migrate handler, once the app is at its
+# latest migration. SQL of the current code may refer to columns and tables of later migrations.
+# Rolling back drops them by name.
+RAW_TABLES = ["usage_datausagerecord", "usage_voiceusagerecord"]
+TRIGGER_EVENTS = ["insert", "update", "delete"]
+
+
+def remove_aggregation_backend(apps, schema_editor):
+    for table in RAW_TABLES:
+        for event in TRIGGER_EVENTS:
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_aggregate_{event} ON {table}")
+        schema_editor.execute(f"DROP FUNCTION IF EXISTS {table}_aggregate()")
+    schema_editor.execute("DROP MATERIALIZED VIEW IF EXISTS usage_usagerecordmaterializedview")
+    schema_editor.execute("DROP VIEW IF EXISTS usage_usagerecordview")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("usage", "0008_usage_record_shard"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsageRecordView",
+            fields=[
+                ("id", models.CharField(max_length=150, primary_key=True, serialize=False)),
+                (
+                    "type_of_usage",
+                    models.CharField(choices=[("data", "DataUsage"), ("voice", "VoiceUsage")], max_length=100),
+                ),
+                ("usage_date", models.DateField()),
+                ("price", models.DecimalField(decimal_places=2, max_digits=12)),
+                ("used", models.BigIntegerField()),
+            ],
+            options={
+                "db_table": "usage_usagerecordview",
+                "managed": False,
+            },
+        ),
+        migrations.RunPython(migrations.RunPython.noop, remove_aggregation_backend),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("usage", "0009_usage_aggregation_backends"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsageRecordMaterializedView",
+            fields=[
+                ("id", models.CharField(max_length=150, primary_key=True, serialize=False)),
+                (
+                    "type_of_usage",
+                    models.CharField(choices=[("data", "DataUsage"), ("voice", "VoiceUsage")], max_length=100),
+                ),
+                ("usage_date", models.DateField()),
+                ("price", models.DecimalField(decimal_places=2, max_digits=12)),
+                ("used", models.BigIntegerField()),
+            ],
+            options={
+                "db_table": "usage_usagerecordmaterializedview",
+                "managed": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="UsageViewRefresh",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("view", models.CharField(max_length=100, unique=True)),
+                ("refreshed_at", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,133 @@
+# Expand step of the compact aggregates layout, it runs online next to the running application:
+# the new columns are added empty and kept in sync with the old ones by a row trigger, existing rows are
+# backfilled in short batches and the covering indexes are built concurrently. 0012 swaps the columns.
+
+from django.db import migrations, transaction
+
+# table, unique constraint, its key and covering columns in the new layout, columns widened to bigint
+TABLES = [
+    ("usage_usagerecord", "unique_usage_record", "subscription_id, type_code, usage_date", "price, used_big", True),
+    (
+        "usage_monthlyusagerecord",
+        "unique_monthly_usage_record",
+        "subscription_id, type_code, usage_month",
+        "price, used",
+        False,
+    ),
+    ("usage_usagerecordtotal", "unique_usage_record_total", "subscription_id, type_code", "", False),
+    ("usage_usagerecordshard", "unique_usage_record_shard", "subscription_id, type_code, usage_date, shard", "", False),
+]
+TYPE_CODE_SQL = "CASE {column} WHEN 'data' THEN 1 WHEN 'voice' THEN 2 END"
+SYNC_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION {table}_sync_layout() RETURNS trigger LANGUAGE plpgsql AS $function$
+    BEGIN
+        NEW.type_code := {type_code};
+        {widen}
+        RETURN NEW;
+    END
+    $function$
+"""
+BACKFILL_BATCH_SIZE = 10000
+
+
+def get_columns(widen_used: bool) -> dict:
+    return {"type_code": "smallint", "used_big": "bigint"} if widen_used else {"type_code": "smallint"}
+
+
+def add_columns(apps, schema_editor):
+    """Empty nullable columns are a catalog change only, NOT NULL is proven by validated CHECKs later"""
+    for table, _, _, _, widen_used in TABLES:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            columns = get_columns(widen_used)
+            schema_editor.execute(
+                f"ALTER TABLE {table} "
+                + ", ".join(
+                    f"ADD COLUMN IF NOT EXISTS {column} {column_type}" for column, column_type in columns.items()
+                )
+            )
+            schema_editor.execute(
+                SYNC_FUNCTION_SQL.format(
+                    table=table,
+                    type_code=TYPE_CODE_SQL.format(column="NEW.type_of_usage"),
+                    widen="NEW.used_big := NEW.used;" if widen_used else "",
+                )
+            )
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_sync_layout ON {table}")
+            schema_editor.execute(
+                f"CREATE TRIGGER {table}_sync_layout BEFORE INSERT OR UPDATE ON {table} "
+                f"FOR EACH ROW EXECUTE PROCEDURE {table}_sync_layout()"
+            )
+            for column in columns:
+                schema_editor.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{column}_not_null")
+                schema_editor.execute(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_not_null "
+                    f"CHECK ({column} IS NOT NULL) NOT VALID"
+                )
+
+
+def backfill(apps, schema_editor):
+    """Copy old values to the new columns in id ranges, every batch is a short transaction of its own"""
+    for table, _, _, _, widen_used in TABLES:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"SELECT min(id), max(id) FROM {table}")
+            first_id, last_id = cursor.fetchone()
+        if first_id is None:
+            continue
+        widen = ", used_big = used" if widen_used else ""
+        for batch_from in range(first_id, last_id + 1, BACKFILL_BATCH_SIZE):
+            with transaction.atomic(using=schema_editor.connection.alias):
+                schema_editor.execute(
+                    f"UPDATE {table} SET type_code = {TYPE_CODE_SQL.format(column='type_of_usage')}{widen} "
+                    "WHERE id >= %s AND id < %s AND type_code IS NULL",
+                    [batch_from, batch_from + BACKFILL_BATCH_SIZE],
+                )
+
+
+def validate(apps, schema_editor):
+    """VALIDATE CONSTRAINT scans the table without blocking writes"""
+    for table, _, _, _, widen_used in TABLES:
+        for column in get_columns(widen_used):
+            schema_editor.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{column}_not_null")
+
+
+def create_indexes(apps, schema_editor):
+    for table, constraint, key, covering, _ in TABLES:
+        include = f" INCLUDE ({covering})" if covering else ""
+        schema_editor.execute(
+            f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {constraint}_compact ON {table} ({key}){include}"
+        )
+    # the price limit API is a range scan of the totals
+    schema_editor.execute(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS usage_total_price_covering "
+        "ON usage_usagerecordtotal (total_price) INCLUDE (type_code, subscription_id)"
+    )
+
+
+def remove_expanded_layout(apps, schema_editor):
+    schema_editor.execute("DROP INDEX IF EXISTS usage_total_price_covering")
+    for table, constraint, _, _, widen_used in TABLES:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            # it's a constraint after the reverse of 0012
+            schema_editor.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}_compact")
+            schema_editor.execute(f"DROP INDEX IF EXISTS {constraint}_compact")
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_sync_layout ON {table}")
+            schema_editor.execute(f"DROP FUNCTION IF EXISTS {table}_sync_layout()")
+            schema_editor.execute(
+                f"ALTER TABLE {table} "
+                + ", ".join(f"DROP COLUMN IF EXISTS {column}" for column in get_columns(widen_used))
+            )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("usage", "0010_usage_record_materialized_view"),
+    ]
+
+    operations = [
+        migrations.RunPython(add_columns, remove_expanded_layout),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        migrations.RunPython(validate, migrations.RunPython.noop),
+        migrations.RunPython(create_indexes, migrations.RunPython.noop),
+    ]
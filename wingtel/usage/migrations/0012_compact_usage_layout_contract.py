@@ -0,0 +1,387 @@
+# Contract step of the compact aggregates layout, deploy it with the code of the new layout. Every statement
+# is a catalog change: old columns are dropped, the expanded ones renamed, NOT NULL is proven by the validated
+# CHECKs of 0011 and the unique constraints are attached to the covering indexes built concurrently by it.
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# table, unique constraint and its old columns, columns widened to bigint, old index of the subscription foreign key
+TABLES = [
+    (
+        "usage_usagerecord",
+        "unique_usage_record",
+        "type_of_usage, subscription_id, usage_date",
+        True,
+        "usage_usagerecord_subscription_id_0746e4bb",
+    ),
+    (
+        "usage_monthlyusagerecord",
+        "unique_monthly_usage_record",
+        "type_of_usage, subscription_id, usage_month",
+        False,
+        "usage_monthlyusagerecord_subscription_id_d91fee60",
+    ),
+    (
+        "usage_usagerecordtotal",
+        "unique_usage_record_total",
+        "type_of_usage, subscription_id",
+        False,
+        "usage_usagerecordtotal_subscription_id_bed02d2a",
+    ),
+    (
+        "usage_usagerecordshard",
+        "unique_usage_record_shard",
+        "type_of_usage, subscription_id, usage_date, shard",
+        False,
+        "usage_usagerecordshard_subscription_id_bf6684d3",
+    ),
+]
+TYPE_NAME_SQL = "CASE type_code WHEN 1 THEN 'data' WHEN 2 THEN 'voice' END"
+
+# Database objects of the aggregation backends in the new layout, frozen as wingtel.usage.schema built them at this
+# migration. They are swapped in the contract transaction, so the triggers backend doesn't miss writes meanwhile.
+# post_migrate replaces them with the ones of the current code once the app is at its latest migration.
+# Rolling back drops them, they are installed again by this migration or post_migrate.
+# type code, raw table and its used column
+RAW_TABLES = [(1, "usage_datausagerecord", "kilobytes_used"), (2, "usage_voiceusagerecord", "seconds_used")]
+VIEW = "usage_usagerecordview"
+MATERIALIZED_VIEW = "usage_usagerecordmaterializedview"
+TRIGGER_EVENTS = {
+    "INSERT": "NEW TABLE AS new_records",
+    "UPDATE": "OLD TABLE AS old_records NEW TABLE AS new_records",
+    "DELETE": "OLD TABLE AS old_records",
+}
+VIEW_SQL = """
+    SELECT concat_ws(':', %s, subscription_id_id, usage_date::date) AS id,
+        %s::smallint AS type_of_usage,
+        subscription_id_id AS subscription_id,
+        usage_date::date AS usage_date,
+        sum(price) AS price,
+        sum({used_column})::bigint AS used
+    FROM {table}
+    GROUP BY subscription_id_id, usage_date::date
+"""
+REFRESHED_AT_SQL = """
+    INSERT INTO usage_usageviewrefresh (view, refreshed_at) VALUES (%s, now())
+    ON CONFLICT (view) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at
+"""
+FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION {table}_aggregate() RETURNS trigger LANGUAGE plpgsql AS $function$
+    BEGIN
+        IF current_setting('wingtel.skip_usage_aggregation', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP = 'INSERT' THEN
+            {insert_sql};
+        ELSIF TG_OP = 'UPDATE' THEN
+            {update_sql};
+        ELSE
+            {delete_sql};
+        END IF;
+        RETURN NULL;
+    END
+    $function$
+"""
+CHANGES_SQL = "SELECT subscription_id_id, usage_date, {sign}price, {sign}{used_column} FROM {records}"
+SOURCE_SQL = """
+    SELECT TG_ARGV[0]::smallint, subscription_id, usage_date::date, sum(price), sum(used)
+    FROM ({changes}) AS changes (subscription_id, usage_date, price, used)
+    GROUP BY subscription_id, usage_date::date
+"""
+UPSERT_SQL = """
+    WITH delta (type_of_usage, subscription_id, usage_date, price, used) AS (
+        {source}
+    ),
+    daily AS (
+        INSERT INTO usage_usagerecord AS aggregated (type_of_usage, subscription_id, usage_date, price, used)
+        SELECT * FROM delta
+        ORDER BY subscription_id, type_of_usage, usage_date
+        ON CONFLICT (type_of_usage, subscription_id, usage_date) DO UPDATE
+        SET price = aggregated.price + EXCLUDED.price, used = aggregated.used + EXCLUDED.used
+    ),
+    monthly AS (
+        INSERT INTO usage_monthlyusagerecord AS aggregated (type_of_usage, subscription_id, usage_month, price, used)
+        SELECT type_of_usage, subscription_id, date_trunc('month', usage_date)::date, sum(price), sum(used)
+        FROM delta
+        GROUP BY type_of_usage, subscription_id, date_trunc('month', usage_date)::date
+        ORDER BY subscription_id, type_of_usage, date_trunc('month', usage_date)::date
+        ON CONFLICT (type_of_usage, subscription_id, usage_month) DO UPDATE
+        SET price = aggregated.price + EXCLUDED.price, used = aggregated.used + EXCLUDED.used
+    )
+    INSERT INTO usage_usagerecordtotal AS aggregated (type_of_usage, subscription_id, total_price, total_used)
+    SELECT type_of_usage, subscription_id, sum(price), sum(used)
+    FROM delta
+    GROUP BY type_of_usage, subscription_id
+    ORDER BY subscription_id, type_of_usage
+    ON CONFLICT (type_of_usage, subscription_id) DO UPDATE
+    SET total_price = aggregated.total_price + EXCLUDED.total_price,
+        total_used = aggregated.total_used + EXCLUDED.total_used
+"""
+TRIGGER_SQL = """
+    CREATE TRIGGER {table}_aggregate_{name} AFTER {event} ON {table} REFERENCING {transition_tables}
+    FOR EACH STATEMENT EXECUTE PROCEDURE {table}_aggregate(%s)
+"""
+
+
+def contract(apps, schema_editor):
+    for table, constraint, _, widen_used, subscription_index in TABLES:
+        schema_editor.execute(f"DROP TRIGGER {table}_sync_layout ON {table}")
+        schema_editor.execute(f"DROP FUNCTION {table}_sync_layout()")
+        # the old unique constraint and indexes of type_of_usage are dropped with it
+        schema_editor.execute(f"ALTER TABLE {table} DROP COLUMN type_of_usage")
+        schema_editor.execute(f"ALTER TABLE {table} RENAME COLUMN type_code TO type_of_usage")
+        schema_editor.execute(f"ALTER TABLE {table} ALTER COLUMN type_of_usage SET NOT NULL")
+        schema_editor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_type_code_not_null")
+        if widen_used:
+            schema_editor.execute(f"ALTER TABLE {table} DROP COLUMN used")
+            schema_editor.execute(f"ALTER TABLE {table} RENAME COLUMN used_big TO used")
+            schema_editor.execute(f"ALTER TABLE {table} ALTER COLUMN used SET NOT NULL")
+            schema_editor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_used_big_not_null")
+        schema_editor.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {constraint} UNIQUE USING INDEX {constraint}_compact"
+        )
+        # the unique constraint starts with subscription_id
+        schema_editor.execute(f"DROP INDEX {subscription_index}")
+    schema_editor.execute("DROP INDEX usage_usagerecordtotal_total_price_1c064984")
+
+
+def expand(apps, schema_editor):
+    """Back to the layout of 0011, the old columns are filled from the new ones"""
+    schema_editor.execute(
+        "CREATE INDEX usage_usagerecordtotal_total_price_1c064984 ON usage_usagerecordtotal (total_price)"
+    )
+    for table, constraint, old_key, widen_used, subscription_index in TABLES:
+        schema_editor.execute(f"CREATE INDEX {subscription_index} ON {table} (subscription_id)")
+        schema_editor.execute(f"ALTER TABLE {table} RENAME CONSTRAINT {constraint} TO {constraint}_compact")
+        schema_editor.execute(f"ALTER TABLE {table} RENAME COLUMN type_of_usage TO type_code")
+        schema_editor.execute(f"ALTER TABLE {table} ALTER COLUMN type_code DROP NOT NULL")
+        schema_editor.execute(f"ALTER TABLE {table} ADD COLUMN type_of_usage varchar(100)")
+        if widen_used:
+            schema_editor.execute(f"ALTER TABLE {table} RENAME COLUMN used TO used_big")
+            schema_editor.execute(f"ALTER TABLE {table} ALTER COLUMN used_big DROP NOT NULL")
+            schema_editor.execute(f"ALTER TABLE {table} ADD COLUMN used integer")
+        # one UPDATE, rows updated twice in a transaction queue foreign key checks that block ALTER TABLE
+        schema_editor.execute(
+            f"UPDATE {table} SET type_of_usage = {TYPE_NAME_SQL}{', used = used_big' if widen_used else ''}"
+        )
+        schema_editor.execute(f"ALTER TABLE {table} ALTER COLUMN type_of_usage SET NOT NULL")
+        schema_editor.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {table}_type_code_not_null CHECK (type_code IS NOT NULL)"
+        )
+        if widen_used:
+            schema_editor.execute(f"ALTER TABLE {table} ALTER COLUMN used SET NOT NULL")
+            schema_editor.execute(
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_used_big_not_null CHECK (used_big IS NOT NULL)"
+            )
+            schema_editor.execute(
+                "CREATE INDEX usage_usagerecord_type_of_usage_ba222af6 ON usage_usagerecord (type_of_usage)"
+            )
+            schema_editor.execute(
+                "CREATE INDEX usage_usagerecord_type_of_usage_ba222af6_like "
+                "ON usage_usagerecord (type_of_usage varchar_pattern_ops)"
+            )
+        schema_editor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {constraint} UNIQUE ({old_key})")
+        schema_editor.execute(
+            f"CREATE FUNCTION {table}_sync_layout() RETURNS trigger LANGUAGE plpgsql AS $function$ "
+            "BEGIN "
+            "NEW.type_code := CASE NEW.type_of_usage WHEN 'data' THEN 1 WHEN 'voice' THEN 2 END; "
+            f"{'NEW.used_big := NEW.used; ' if widen_used else ''}"
+            "RETURN NEW; "
+            "END "
+            "$function$"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {table}_sync_layout BEFORE INSERT OR UPDATE ON {table} "
+            f"FOR EACH ROW EXECUTE PROCEDURE {table}_sync_layout()"
+        )
+
+
+def reinstall_aggregation_backend(apps, schema_editor):
+    """Trigger functions and views of the aggregation backends cast the type of usage to the new column type"""
+    drop_backend_objects(schema_editor)
+    create_backend_objects(schema_editor)
+
+
+def remove_aggregation_backend(apps, schema_editor):
+    drop_backend_objects(schema_editor)
+
+
+def drop_backend_objects(schema_editor):
+    for _, table, _ in RAW_TABLES:
+        for event in TRIGGER_EVENTS:
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_aggregate_{event.lower()} ON {table}")
+        schema_editor.execute(f"DROP FUNCTION IF EXISTS {table}_aggregate()")
+    schema_editor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {MATERIALIZED_VIEW}")
+    schema_editor.execute(f"DROP VIEW IF EXISTS {VIEW}")
+
+
+def create_backend_objects(schema_editor):
+    """The objects of USAGE_AGGREGATION_BACKEND as sync_aggregation_backend() created them at this migration"""
+    backend = settings.USAGE_AGGREGATION_BACKEND
+    sources, params = [], []
+    for type_of_usage, table, used_column in RAW_TABLES:
+        sources.append(VIEW_SQL.format(table=table, used_column=used_column))
+        params += [type_of_usage, type_of_usage]
+    view_sql = " UNION ALL ".join(sources)
+    schema_editor.execute(f"CREATE VIEW {VIEW} AS {view_sql}", params)
+    if backend == "materialized_view":
+        schema_editor.execute(f"CREATE MATERIALIZED VIEW {MATERIALIZED_VIEW} AS {view_sql} WITH DATA", params)
+        schema_editor.execute(f"CREATE UNIQUE INDEX {MATERIALIZED_VIEW}_id ON {MATERIALIZED_VIEW} (id)")
+        schema_editor.execute(
+            f"CREATE INDEX {MATERIALIZED_VIEW}_subscription_date ON {MATERIALIZED_VIEW} (subscription_id, usage_date)"
+        )
+        schema_editor.execute(REFRESHED_AT_SQL, [MATERIALIZED_VIEW])
+    for type_of_usage, table, used_column in RAW_TABLES:
+        schema_editor.execute(
+            FUNCTION_SQL.format(
+                table=table,
+                insert_sql=get_upsert_sql(used_column, "new_records"),
+                update_sql=get_upsert_sql(used_column, "new_records", "old_records"),
+                delete_sql=get_upsert_sql(used_column, "old_records"),
+            )
+        )
+        if backend != "triggers":
+            continue
+        for event, transition_tables in TRIGGER_EVENTS.items():
+            schema_editor.execute(
+                TRIGGER_SQL.format(table=table, name=event.lower(), event=event, transition_tables=transition_tables),
+                [type_of_usage],
+            )
+
+
+def get_upsert_sql(used_column: str, *records: str) -> str:
+    changes = [
+        CHANGES_SQL.format(used_column=used_column, sign="-" if name == "old_records" else "", records=name)
+        for name in records
+    ]
+    return UPSERT_SQL.format(source=SOURCE_SQL.format(changes=" UNION ALL ".join(changes)))
+
+
+USAGE_TYPES = [(1, "DataUsage"), (2, "VoiceUsage")]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("subscriptions", "0001_initial"),
+        ("usage", "0011_compact_usage_layout_expand"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(contract, expand)],
+            state_operations=[
+                migrations.RemoveConstraint(model_name="usagerecord", name="unique_usage_record"),
+                migrations.RemoveConstraint(model_name="monthlyusagerecord", name="unique_monthly_usage_record"),
+                migrations.RemoveConstraint(model_name="usagerecordtotal", name="unique_usage_record_total"),
+                migrations.RemoveConstraint(model_name="usagerecordshard", name="unique_usage_record_shard"),
+                migrations.AlterField(
+                    model_name="usagerecord",
+                    name="type_of_usage",
+                    field=models.PositiveSmallIntegerField(choices=USAGE_TYPES),
+                ),
+                migrations.AlterField(
+                    model_name="usagerecord",
+                    name="subscription",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="subscriptions.Subscription",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="monthlyusagerecord",
+                    name="type_of_usage",
+                    field=models.PositiveSmallIntegerField(choices=USAGE_TYPES),
+                ),
+                migrations.AlterField(
+                    model_name="monthlyusagerecord",
+                    name="subscription",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="subscriptions.Subscription",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="usagerecordtotal",
+                    name="type_of_usage",
+                    field=models.PositiveSmallIntegerField(choices=USAGE_TYPES),
+                ),
+                migrations.AlterField(
+                    model_name="usagerecordtotal",
+                    name="subscription",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="subscriptions.Subscription",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="usagerecordshard",
+                    name="type_of_usage",
+                    field=models.PositiveSmallIntegerField(choices=USAGE_TYPES),
+                ),
+                migrations.AlterField(
+                    model_name="usagerecordshard",
+                    name="subscription",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="subscriptions.Subscription",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="usagerecordview",
+                    name="type_of_usage",
+                    field=models.PositiveSmallIntegerField(choices=USAGE_TYPES),
+                ),
+                migrations.AlterField(
+                    model_name="usagerecordmaterializedview",
+                    name="type_of_usage",
+                    field=models.PositiveSmallIntegerField(choices=USAGE_TYPES),
+                ),
+                migrations.AlterField(model_name="usagerecord", name="used", field=models.BigIntegerField()),
+                migrations.AlterField(
+                    model_name="usagerecordtotal",
+                    name="total_price",
+                    field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                migrations.AddIndex(
+                    model_name="usagerecordtotal",
+                    index=models.Index(fields=["total_price"], name="usage_total_price_covering"),
+                ),
+                migrations.AddConstraint(
+                    model_name="usagerecord",
+                    constraint=models.UniqueConstraint(
+                        fields=("subscription", "type_of_usage", "usage_date"), name="unique_usage_record"
+                    ),
+                ),
+                migrations.AddConstraint(
+                    model_name="monthlyusagerecord",
+                    constraint=models.UniqueConstraint(
+                        fields=("subscription", "type_of_usage", "usage_month"), name="unique_monthly_usage_record"
+                    ),
+                ),
+                migrations.AddConstraint(
+                    model_name="usagerecordtotal",
+                    constraint=models.UniqueConstraint(
+                        fields=("subscription", "type_of_usage"), name="unique_usage_record_total"
+                    ),
+                ),
+                migrations.AddConstraint(
+                    model_name="usagerecordshard",
+                    constraint=models.UniqueConstraint(
+                        fields=("subscription", "type_of_usage", "usage_date", "shard"),
+                        name="unique_usage_record_shard",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(reinstall_aggregation_backend, remove_aggregation_backend),
+    ]
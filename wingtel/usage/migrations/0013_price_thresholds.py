@@ -0,0 +1,101 @@
+# Generated by Django 2.2.1 on 2026-10-18 14:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("subscriptions", "0001_initial"),
+        ("plans", "0001_initial"),
+        ("usage", "0012_compact_usage_layout_contract"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PriceThreshold",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(blank=True, default="", max_length=100)),
+                ("price_limit", models.DecimalField(decimal_places=2, max_digits=14)),
+                (
+                    "period",
+                    models.CharField(
+                        choices=[("day", "Day"), ("month", "Month"), ("total", "Total")], default="total", max_length=5
+                    ),
+                ),
+                (
+                    "type_of_usage",
+                    models.PositiveSmallIntegerField(
+                        blank=True, choices=[(1, "DataUsage"), (2, "VoiceUsage")], null=True
+                    ),
+                ),
+                ("is_active", models.BooleanField(default=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "plan",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to="plans.Plan"
+                    ),
+                ),
+                (
+                    "subscription",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="subscriptions.Subscription",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="PriceThresholdEvent",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("type_of_usage", models.PositiveSmallIntegerField(choices=[(1, "DataUsage"), (2, "VoiceUsage")])),
+                ("period_start", models.DateField(null=True)),
+                ("price", models.DecimalField(decimal_places=2, max_digits=14)),
+                ("transaction_id", models.BigIntegerField()),
+                ("created_at", models.DateTimeField()),
+                (
+                    "subscription",
+                    models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to="subscriptions.Subscription"),
+                ),
+                (
+                    "threshold",
+                    models.ForeignKey(
+                        db_index=False, on_delete=django.db.models.deletion.CASCADE, to="usage.PriceThreshold"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="pricethresholdevent",
+            index=models.Index(fields=["transaction_id", "id"], name="price_threshold_event_cursor"),
+        ),
+        migrations.AddConstraint(
+            model_name="pricethresholdevent",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(period_start__isnull=False),
+                fields=("threshold", "subscription", "type_of_usage", "period_start"),
+                name="unique_price_threshold_event",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="pricethresholdevent",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(period_start__isnull=True),
+                fields=("threshold", "subscription", "type_of_usage"),
+                name="unique_price_threshold_event_total",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="pricethreshold",
+            constraint=models.CheckConstraint(
+                check=models.Q(("subscription__isnull", True), ("plan__isnull", True), _connector="OR"),
+                name="price_threshold_scope",
+            ),
+        ),
+    ]
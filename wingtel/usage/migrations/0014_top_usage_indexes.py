@@ -0,0 +1,62 @@
+# Covering indexes of the top usage API, built CONCURRENTLY next to the running application. The date index
+# of UsageRecord is replaced by a covering one, so the table gets no extra index to maintain on every write.
+
+from django.db import migrations, models
+
+# name, table, key and covering columns
+INDEXES = [
+    ("usage_record_date_covering", "usage_usagerecord", "usage_date", "type_of_usage, subscription_id, price, used"),
+    (
+        "usage_monthly_month_covering",
+        "usage_monthlyusagerecord",
+        "usage_month",
+        "type_of_usage, subscription_id, price, used",
+    ),
+    ("usage_total_used_covering", "usage_usagerecordtotal", "total_used", "type_of_usage, subscription_id"),
+]
+OLD_DATE_INDEX = "usage_usagerecord_usage_date_b9bb2f17"
+
+
+def create_indexes(apps, schema_editor):
+    for name, table, key, covering in INDEXES:
+        schema_editor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({key}) INCLUDE ({covering})")
+    schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {OLD_DATE_INDEX}")
+
+
+def remove_indexes(apps, schema_editor):
+    schema_editor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {OLD_DATE_INDEX} ON usage_usagerecord (usage_date)")
+    for name, _, _, _ in INDEXES:
+        schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("usage", "0013_price_thresholds"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(create_indexes, remove_indexes)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name="usagerecord",
+                    name="usage_date",
+                    field=models.DateField(),
+                ),
+                migrations.AddIndex(
+                    model_name="usagerecord",
+                    index=models.Index(fields=["usage_date"], name="usage_record_date_covering"),
+                ),
+                migrations.AddIndex(
+                    model_name="monthlyusagerecord",
+                    index=models.Index(fields=["usage_month"], name="usage_monthly_month_covering"),
+                ),
+                migrations.AddIndex(
+                    model_name="usagerecordtotal",
+                    index=models.Index(fields=["total_used"], name="usage_total_used_covering"),
+                ),
+            ],
+        ),
+    ]
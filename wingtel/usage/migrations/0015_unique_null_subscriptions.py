@@ -0,0 +1,99 @@
+# Aggregates of raw records without a subscription have a NULL subscription_id. A plain unique constraint
+# never sees two NULLs as equal, so ON CONFLICT didn't fire for them and every write inserted another row.
+# Their duplicates are merged and the unique constraints recreated as NULLS NOT DISTINCT, a table is locked for
+# writes while its constraint is rebuilt. NULLS NOT DISTINCT makes PostgreSQL 15 the minimum server version,
+# the migration refuses to run on older servers.
+# 0003 merged the NULL-subscription duplicates of UsageRecord into one row without deleting them, run
+# reconcile_usage_aggregates over the days before 0003 to repair the aggregates of records without a subscription.
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import migrations, transaction
+
+MINIMUM_SERVER_VERSION = 150000
+
+# table, unique constraint, its key columns other than subscription_id, covering and summed columns
+TABLES = [
+    ("usage_usagerecord", "unique_usage_record", ["type_of_usage", "usage_date"], "price, used", ["price", "used"]),
+    (
+        "usage_monthlyusagerecord",
+        "unique_monthly_usage_record",
+        ["type_of_usage", "usage_month"],
+        "price, used",
+        ["price", "used"],
+    ),
+    ("usage_usagerecordtotal", "unique_usage_record_total", ["type_of_usage"], "", ["total_price", "total_used"]),
+    (
+        "usage_usagerecordshard",
+        "unique_usage_record_shard",
+        ["type_of_usage", "usage_date", "shard"],
+        "",
+        ["price", "used"],
+    ),
+]
+MERGE_DUPLICATES_SQL = """
+    UPDATE {table} AS kept
+    SET {assignments}
+    FROM (
+        SELECT min(id) AS id, {sums}
+        FROM {table}
+        WHERE subscription_id IS NULL
+        GROUP BY {key}
+        HAVING count(*) > 1
+    ) AS duplicates
+    WHERE kept.id = duplicates.id
+"""
+DELETE_DUPLICATES_SQL = """
+    DELETE FROM {table} AS duplicate
+    USING {table} AS kept
+    WHERE duplicate.subscription_id IS NULL AND kept.subscription_id IS NULL AND {conditions}
+        AND duplicate.id > kept.id
+"""
+CONSTRAINT_SQL = "ALTER TABLE {table} DROP CONSTRAINT {constraint}, ADD CONSTRAINT {constraint} UNIQUE {nulls}({key})"
+
+
+def recreate_constraint(schema_editor, table, constraint, key, covering, nulls):
+    schema_editor.execute(
+        CONSTRAINT_SQL.format(table=table, constraint=constraint, nulls=nulls, key=", ".join(["subscription_id", *key]))
+        + (f" INCLUDE ({covering})" if covering else "")
+    )
+
+
+def merge_null_subscriptions(apps, schema_editor):
+    if schema_editor.connection.pg_version < MINIMUM_SERVER_VERSION:
+        raise ImproperlyConfigured(
+            "PostgreSQL 15+ is required, unique constraints of the usage aggregates are NULLS NOT DISTINCT"
+        )
+    for table, constraint, key, covering, summed in TABLES:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+            schema_editor.execute(
+                MERGE_DUPLICATES_SQL.format(
+                    table=table,
+                    assignments=", ".join(f"{column} = duplicates.{column}" for column in summed),
+                    sums=", ".join(f"sum({column}) AS {column}" for column in summed),
+                    key=", ".join(key),
+                )
+            )
+            schema_editor.execute(
+                DELETE_DUPLICATES_SQL.format(
+                    table=table, conditions=" AND ".join(f"duplicate.{column} = kept.{column}" for column in key)
+                )
+            )
+            recreate_constraint(schema_editor, table, constraint, key, covering, "NULLS NOT DISTINCT ")
+
+
+def restore_nulls_distinct(apps, schema_editor):
+    for table, constraint, key, covering, _ in TABLES:
+        recreate_constraint(schema_editor, table, constraint, key, covering, "")
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("usage", "0014_top_usage_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_null_subscriptions, restore_nulls_distinct),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.1 on 2026-10-18 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("usage", "0015_unique_null_subscriptions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RawUsageRemoval",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("type_of_usage", models.PositiveSmallIntegerField(choices=[(1, "DataUsage"), (2, "VoiceUsage")])),
+                (
+                    "reason",
+                    models.CharField(choices=[("retention", "Retention"), ("archive", "Archive")], max_length=10),
+                ),
+                ("date_from", models.DateField(null=True)),
+                ("date_to", models.DateField()),
+                ("removed_at", models.DateTimeField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="rawusageremoval",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(reason="retention"), fields=("type_of_usage",), name="unique_raw_usage_retention"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="rawusageremoval",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(reason="archive"),
+                fields=("type_of_usage", "date_from"),
+                name="unique_raw_usage_archive",
+            ),
+        ),
+    ]
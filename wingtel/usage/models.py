@@ -1,37 +1,281 @@
+from django.contrib.postgres.indexes import BrinIndex
 from django.db import models
 from model_utils import Choices
 
+from wingtel.plans.models import Plan
 from wingtel.subscriptions.models import Subscription
 
 
 class DataUsageRecord(models.Model):
     """Raw data usage record for a subscription"""
 
+    USED_FIELD = "kilobytes_used"
+
     subscription_id = models.ForeignKey(Subscription, null=True, on_delete=models.PROTECT)
     price = models.DecimalField(decimal_places=2, max_digits=5, default=0)
     usage_date = models.DateTimeField(null=False)
     kilobytes_used = models.IntegerField(null=False)
 
+    class Meta:
+        # the table is range partitioned by usage_date, see wingtel.usage.partitions
+        indexes = [BrinIndex(fields=["usage_date"], name="usage_data_date_brin")]
+
 
 class VoiceUsageRecord(models.Model):
     """Raw voice usage record for a subscription"""
 
+    USED_FIELD = "seconds_used"
+
     subscription_id = models.ForeignKey(Subscription, null=True, on_delete=models.PROTECT)
     price = models.DecimalField(decimal_places=2, max_digits=5, default=0)
     usage_date = models.DateTimeField(null=False)
     seconds_used = models.IntegerField(null=False)
 
+    class Meta:
+        # the table is range partitioned by usage_date, see wingtel.usage.partitions
+        indexes = [BrinIndex(fields=["usage_date"], name="usage_voice_date_brin")]
+
 
 class UsageRecord(models.Model):
     """Aggregate representation for usage record"""
 
     USAGE_TYPES = Choices(
-        ("data", "DataUsage"),
-        ("voice", "VoiceUsage"),
+        (1, "data", "DataUsage"),
+        (2, "voice", "VoiceUsage"),
     )
+    # names of the type codes in the API and the commands
+    USAGE_TYPE_NAMES = {USAGE_TYPES.data: "data", USAGE_TYPES.voice: "voice"}
+    USAGE_TYPE_CODES = {name: code for code, name in USAGE_TYPE_NAMES.items()}
+    RAW_MODELS = {
+        USAGE_TYPES.data: DataUsageRecord,
+        USAGE_TYPES.voice: VoiceUsageRecord,
+    }
 
-    type_of_usage = models.CharField(max_length=100, choices=USAGE_TYPES, db_index=True)
-    subscription = models.ForeignKey(Subscription, null=True, on_delete=models.PROTECT)
+    type_of_usage = models.PositiveSmallIntegerField(choices=USAGE_TYPES)
+    # the unique constraint starts with the subscription
+    subscription = models.ForeignKey(Subscription, null=True, on_delete=models.PROTECT, db_index=False)
     price = models.DecimalField(decimal_places=2, max_digits=10, default=0)
-    usage_date = models.DateField(null=False, db_index=True)
-    used = models.IntegerField(null=False)
+    usage_date = models.DateField(null=False)
+    used = models.BigIntegerField(null=False)
+
+    class Meta:
+        constraints = [
+            # INCLUDE (price, used) in the database, metrics are read with index-only scans, see migration 0011.
+            # Unique constraints of the aggregates are NULLS NOT DISTINCT, see migration 0015
+            models.UniqueConstraint(fields=["subscription", "type_of_usage", "usage_date"], name="unique_usage_record"),
+        ]
+        # INCLUDE (type_of_usage, subscription_id, price, used) in the database, date ranges of all subscriptions
+        # are index-only scans, see migration 0014
+        indexes = [models.Index(fields=["usage_date"], name="usage_record_date_covering")]
+
+
+class MonthlyUsageRecord(models.Model):
+    """Monthly rollup of UsageRecord, usage_month is the first day of the month"""
+
+    type_of_usage = models.PositiveSmallIntegerField(choices=UsageRecord.USAGE_TYPES)
+    subscription = models.ForeignKey(Subscription, null=True, on_delete=models.PROTECT, db_index=False)
+    price = models.DecimalField(decimal_places=2, max_digits=12, default=0)
+    usage_month = models.DateField(null=False)
+    used = models.BigIntegerField(null=False)
+
+    class Meta:
+        constraints = [
+            # INCLUDE (price, used) in the database
+            models.UniqueConstraint(
+                fields=["subscription", "type_of_usage", "usage_month"], name="unique_monthly_usage_record"
+            ),
+        ]
+        # INCLUDE (type_of_usage, subscription_id, price, used) in the database
+        indexes = [models.Index(fields=["usage_month"], name="usage_monthly_month_covering")]
+
+
+class UsageRecordTotal(models.Model):
+    """All time totals of UsageRecord by subscription and type of usage"""
+
+    type_of_usage = models.PositiveSmallIntegerField(choices=UsageRecord.USAGE_TYPES)
+    subscription = models.ForeignKey(Subscription, null=True, on_delete=models.PROTECT, db_index=False)
+    total_price = models.DecimalField(decimal_places=2, max_digits=14, default=0)
+    total_used = models.BigIntegerField(null=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["subscription", "type_of_usage"], name="unique_usage_record_total"),
+        ]
+        # INCLUDE (type_of_usage, subscription_id) in the database, the price limit API is an index-only scan,
+        # the top usage API reads them in the order of the metric
+        indexes = [
+            models.Index(fields=["total_price"], name="usage_total_price_covering"),
+            models.Index(fields=["total_used"], name="usage_total_used_covering"),
+        ]
+
+
+class DailyUsageRecordView(models.Model):
+    """Raw tables grouped by type of usage, subscription and day, the id is type:subscription:day"""
+
+    id = models.CharField(max_length=150, primary_key=True)
+    type_of_usage = models.PositiveSmallIntegerField(choices=UsageRecord.USAGE_TYPES)
+    subscription = models.ForeignKey(Subscription, null=True, on_delete=models.DO_NOTHING, db_constraint=False)
+    usage_date = models.DateField()
+    price = models.DecimalField(decimal_places=2, max_digits=12)
+    used = models.BigIntegerField()
+
+    class Meta:
+        abstract = True
+
+
+class UsageRecordView(DailyUsageRecordView):
+    """
+    Daily aggregates of the view backend (USAGE_AGGREGATION_BACKEND = "view"), a database view
+    grouping the raw tables by type of usage, subscription and day. It's installed after migrate
+    """
+
+    class Meta:
+        managed = False
+        db_table = "usage_usagerecordview"
+
+
+class UsageRecordMaterializedView(DailyUsageRecordView):
+    """
+    Daily aggregates of the materialized_view backend, refreshed by refresh_usage_view.
+    It's created after migrate only for that backend
+    """
+
+    class Meta:
+        managed = False
+        db_table = "usage_usagerecordmaterializedview"
+
+
+class UsageViewRefresh(models.Model):
+    """Last refresh of a materialized view of usage records"""
+
+    view = models.CharField(max_length=100, unique=True)
+    refreshed_at = models.DateTimeField()
+
+
+class UsageRecordShard(models.Model):
+    """
+    Pending delta of a UsageRecord in sharded mode (USAGE_AGGREGATION_SHARDS), writers of a hot key
+    update one of the shard rows instead of the single UsageRecord row. Readers add pending shards,
+    compact_usage_shards folds them into UsageRecord and its rollups
+    """
+
+    type_of_usage = models.PositiveSmallIntegerField(choices=UsageRecord.USAGE_TYPES)
+    subscription = models.ForeignKey(Subscription, null=True, on_delete=models.PROTECT, db_index=False)
+    usage_date = models.DateField(null=False)
+    shard = models.PositiveSmallIntegerField()
+    price = models.DecimalField(decimal_places=2, max_digits=10, default=0)
+    used = models.BigIntegerField(null=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["subscription", "type_of_usage", "usage_date", "shard"], name="unique_usage_record_shard"
+            ),
+        ]
+
+
+class UsageRecordRebuildCheckpoint(models.Model):
+    """Chunk of a rebuild_usage_aggregates job that is already recomputed"""
+
+    job = models.CharField(max_length=100)
+    usage_date = models.DateField()
+    subscription_from = models.IntegerField(null=True)
+    subscription_to = models.IntegerField(null=True)
+    completed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["job", "usage_date", "subscription_from", "subscription_to"], name="unique_rebuild_checkpoint"
+            ),
+        ]
+
+
+class RawUsageRemoval(models.Model):
+    """
+    Days of a type of usage whose raw records were removed while their aggregates were kept: every day before
+    the retention cutoff of drop_usage_partitions (date_from is None) or a day moved out by archive_raw_usage.
+    The aggregates are the only copy of these days, rebuild_usage_aggregates and reconcile_usage_aggregates
+    must not recompute them from the empty raw tables
+    """
+
+    REASONS = Choices(("retention", "Retention"), ("archive", "Archive"))
+
+    type_of_usage = models.PositiveSmallIntegerField(choices=UsageRecord.USAGE_TYPES)
+    reason = models.CharField(max_length=10, choices=REASONS)
+    date_from = models.DateField(null=True)
+    date_to = models.DateField()
+    removed_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["type_of_usage"], condition=models.Q(reason="retention"), name="unique_raw_usage_retention"
+            ),
+            models.UniqueConstraint(
+                fields=["type_of_usage", "date_from"],
+                condition=models.Q(reason="archive"),
+                name="unique_raw_usage_archive",
+            ),
+        ]
+
+
+class PriceThreshold(models.Model):
+    """
+    Alert when the price of a subscription and type of usage goes above price_limit within a day, a month or
+    all time (period). It's global, or limited to a subscription or to the subscriptions of a plan,
+    and to a type of usage. Thresholds are evaluated by the aggregate upsert, see PriceThresholdEvent
+    """
+
+    PERIODS = Choices(("day", "Day"), ("month", "Month"), ("total", "Total"))
+
+    name = models.CharField(max_length=100, blank=True, default="")
+    price_limit = models.DecimalField(decimal_places=2, max_digits=14)
+    period = models.CharField(max_length=5, choices=PERIODS, default=PERIODS.total)
+    # None is any type of usage
+    type_of_usage = models.PositiveSmallIntegerField(choices=UsageRecord.USAGE_TYPES, null=True, blank=True)
+    subscription = models.ForeignKey(Subscription, null=True, blank=True, on_delete=models.CASCADE)
+    plan = models.ForeignKey(Plan, null=True, blank=True, on_delete=models.CASCADE)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(subscription__isnull=True) | models.Q(plan__isnull=True), name="price_threshold_scope"
+            ),
+        ]
+
+
+class PriceThresholdEvent(models.Model):
+    """
+    A subscription and type of usage went above a threshold in the period starting at period_start
+    (None for all time totals). It's recorded once per threshold and period by the upsert that crossed it.
+    Events are read in the order of (transaction_id, id), transaction_id is the writer's txid_current(),
+    so a reader never skips events committed after its read
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    threshold = models.ForeignKey(PriceThreshold, on_delete=models.CASCADE, db_index=False)
+    type_of_usage = models.PositiveSmallIntegerField(choices=UsageRecord.USAGE_TYPES)
+    subscription = models.ForeignKey(Subscription, on_delete=models.PROTECT)
+    period_start = models.DateField(null=True)
+    # price of the period right after the crossing
+    price = models.DecimalField(decimal_places=2, max_digits=14)
+    transaction_id = models.BigIntegerField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["threshold", "subscription", "type_of_usage", "period_start"],
+                condition=models.Q(period_start__isnull=False),
+                name="unique_price_threshold_event",
+            ),
+            models.UniqueConstraint(
+                fields=["threshold", "subscription", "type_of_usage"],
+                condition=models.Q(period_start__isnull=True),
+                name="unique_price_threshold_event_total",
+            ),
+        ]
+        indexes = [models.Index(fields=["transaction_id", "id"], name="price_threshold_event_cursor")]
@@ -0,0 +1,105 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class UsageRecordKeysetPagination(BasePagination):
+    """
+    Keyset pagination ordered by (subscription_id, type_of_usage). The next page starts right after
+    the last key of the previous one, so deep pages cost the same as the first one.
+    Records without a subscription are last, like NULLs in the ascending order of PostgreSQL.
+    It's used only when page_size or cursor parameter is given, otherwise the whole list is returned
+    """
+
+    page_size_query_param = "page_size"
+    cursor_query_param = "cursor"
+    page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = "Invalid cursor"
+    # the first key of the cursor is null for records without a subscription
+    nullable_first_key = True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_size_query_param not in request.GET and self.cursor_query_param not in request.GET:
+            return None
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = request.GET.get(self.cursor_query_param)
+        if cursor:
+            subscription_id, type_of_usage = self.decode_cursor(cursor)
+            if subscription_id is None:
+                queryset = queryset.filter(subscription_id__isnull=True, type_of_usage__gt=type_of_usage)
+            else:
+                queryset = queryset.filter(
+                    Q(subscription_id__gt=subscription_id)
+                    | Q(subscription_id=subscription_id, type_of_usage__gt=type_of_usage)
+                    | Q(subscription_id__isnull=True)
+                )
+        records = list(queryset.order_by("subscription_id", "type_of_usage")[: self.page_size + 1])
+        self.next_key = None
+        if len(records) > self.page_size:
+            records = records[: self.page_size]
+            self.next_key = [records[-1]["subscription_id"], records[-1]["type_of_usage"]]
+        return records
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.GET.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, cursor: str):
+        try:
+            first_key, second_key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if first_key is None and self.nullable_first_key:
+                return None, int(second_key)
+            return int(first_key), int(second_key)
+        except (binascii.Error, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if self.next_key is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_key))
+        return remove_query_param(url, "stream")
+
+    @staticmethod
+    def encode_cursor(key) -> str:
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([("next", self.get_next_link()), ("results", data)]))
+
+
+class PriceThresholdEventPagination(UsageRecordKeysetPagination):
+    """
+    Cursor over (transaction_id, id) of threshold events. A response has the cursor of its last event,
+    or the given one when there are no new events, consumers poll with it and get each event once
+    """
+
+    nullable_first_key = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.cursor = request.GET.get(self.cursor_query_param)
+        if self.cursor:
+            transaction_id, event_id = self.decode_cursor(self.cursor)
+            queryset = queryset.filter(
+                Q(transaction_id__gt=transaction_id) | Q(transaction_id=transaction_id, id__gt=event_id)
+            )
+        events = list(queryset.order_by("transaction_id", "id")[: self.page_size])
+        if events:
+            self.cursor = self.encode_cursor([events[-1].transaction_id, events[-1].id])
+        return events
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([("cursor", self.cursor), ("results", data)]))
@@ -0,0 +1,112 @@
+import re
+from datetime import date, timedelta
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from wingtel.usage.models import RawUsageRemoval, UsageRecord
+from wingtel.usage.utils import add_months
+
+
+class RawUsagePartitions:
+    """
+    Monthly range partitions of a raw usage table by usage_date.
+    Partitions are named <table>_pYYYY_MM, rows outside of them land in <table>_default
+    """
+
+    LIST_SQL = """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+    """
+
+    def __init__(self, model) -> None:
+        self.table = model._meta.db_table
+        self.record_type = next(code for code, raw_model in UsageRecord.RAW_MODELS.items() if raw_model is model)
+        self.default = f"{self.table}_default"
+        self.name_regex = re.compile(rf"^{self.table}_p(\d{{4}})_(\d{{2}})$")
+
+    def is_partitioned(self) -> bool:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [self.table])
+            return cursor.fetchone() is not None
+
+    def get_months(self) -> List[date]:
+        """First days of months that have a partition"""
+        with connection.cursor() as cursor:
+            cursor.execute(self.LIST_SQL, [self.table])
+            names = [name for name, in cursor.fetchall()]
+        matches = [self.name_regex.match(name) for name in names]
+        return sorted(date(int(match[1]), int(match[2]), 1) for match in matches if match)
+
+    @transaction.atomic
+    def create(self, month: date) -> str:
+        """
+        Create the partition of a month. Rows of that month which already landed in the default
+        partition are moved to it, otherwise attaching the partition fails
+        """
+        name = f"{self.table}_p{month:%Y_%m}"
+        bounds = [f"{month} 00:00+00", f"{add_months(month, 1)} 00:00+00"]
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE {name} (LIKE {self.table} INCLUDING DEFAULTS)")
+            cursor.execute(
+                f"WITH moved AS (DELETE FROM {self.default} WHERE usage_date >= %s AND usage_date < %s RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved",
+                bounds,
+            )
+            cursor.execute(f"ALTER TABLE {self.table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+        return name
+
+    def ensure(self, months_ahead: Optional[int] = None) -> List[str]:
+        """Create missing partitions from the current month up to months_ahead months from now"""
+        if months_ahead is None:
+            months_ahead = settings.USAGE_PARTITIONS_MONTHS_AHEAD
+        current = timezone.now().date().replace(day=1)
+        return self.create_missing([add_months(current, months) for months in range(months_ahead + 1)])
+
+    def create_missing(self, months: Iterable[date]) -> List[str]:
+        """Create partitions of the given months (first days) which don't exist yet"""
+        existing = set(self.get_months())
+        return [self.create(month) for month in sorted(set(months)) if month not in existing]
+
+    @transaction.atomic
+    def drop_before(self, month: date) -> List[str]:
+        """
+        Detach and drop partitions of months before the given one, it's a catalog change instead of
+        a huge DELETE. Expired rows of the default partition are deleted. Aggregates are kept,
+        the cutoff is recorded as a RawUsageRemoval so they aren't rebuilt from the empty raw tables
+        """
+        dropped = []
+        with connection.cursor() as cursor:
+            # deferred foreign key checks of rows inserted in this transaction would block DROP TABLE
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            for partition_month in self.get_months():
+                if partition_month >= month:
+                    continue
+                name = f"{self.table}_p{partition_month:%Y_%m}"
+                cursor.execute(f"ALTER TABLE {self.table} DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE {name}")
+                dropped.append(name)
+            cursor.execute(f"DELETE FROM {self.default} WHERE usage_date < %s", [f"{month} 00:00+00"])
+        self.record_retention(month - timedelta(days=1))
+        return dropped
+
+    def record_retention(self, last_day: date):
+        """Raw records up to last_day are removed, an earlier cutoff of a longer retention doesn't move it back"""
+        removal, created = RawUsageRemoval.objects.select_for_update().get_or_create(
+            type_of_usage=self.record_type,
+            reason=RawUsageRemoval.REASONS.retention,
+            defaults={"date_to": last_day, "removed_at": timezone.now()},
+        )
+        if not created and removal.date_to < last_day:
+            removal.date_to = last_day
+            removal.removed_at = timezone.now()
+            removal.save(update_fields=["date_to", "removed_at"])
+
+
+def get_raw_usage_partitions() -> List[RawUsagePartitions]:
+    return [RawUsagePartitions(model) for model in UsageRecord.RAW_MODELS.values()]
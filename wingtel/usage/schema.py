@@ -0,0 +1,232 @@
+from typing import List, Tuple
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from wingtel.usage.backends import (
+    MATERIALIZED_VIEW,
+    SKIP_AGGREGATION_SETTING,
+    TRIGGERS,
+    get_aggregation_backend,
+)
+from wingtel.usage.models import (
+    UsageRecord,
+    UsageRecordMaterializedView,
+    UsageRecordView,
+    UsageViewRefresh,
+)
+from wingtel.usage.services import ApplyUsageRecordDeltasService
+
+
+class UsageAggregationTriggers:
+    """
+    Statement level triggers of the triggers backend on a raw usage table. Changed rows come from
+    transition tables and are folded in with the same upsert as ApplyUsageRecordDeltasService,
+    one statement per INSERT/UPDATE/DELETE however many rows it touches. Type of usage is a trigger argument
+    """
+
+    FUNCTION_SQL = """
+        CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $function$
+        DECLARE
+            written bigint;
+        BEGIN
+            IF current_setting('{skip_setting}', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'INSERT' THEN
+                {insert_sql};
+            ELSIF TG_OP = 'UPDATE' THEN
+                {update_sql};
+            ELSE
+                {delete_sql};
+            END IF;
+            RETURN NULL;
+        END
+        $function$
+    """
+    CHANGES_SQL = "SELECT {subscription_column}, usage_date, {sign}price, {sign}{used_column} FROM {records}"
+    SOURCE_SQL = """
+        SELECT TG_ARGV[0]::smallint, subscription_id, usage_date::date, sum(price), sum(used)
+        FROM ({changes}) AS changes (subscription_id, usage_date, price, used)
+        GROUP BY subscription_id, usage_date::date
+    """
+    TRIGGER_SQL = """
+        CREATE TRIGGER {name} AFTER {event} ON {table} REFERENCING {transition_tables}
+        FOR EACH STATEMENT EXECUTE PROCEDURE {function}(%s)
+    """
+    EVENTS = {
+        "INSERT": "NEW TABLE AS new_records",
+        "UPDATE": "OLD TABLE AS old_records NEW TABLE AS new_records",
+        "DELETE": "OLD TABLE AS old_records",
+    }
+
+    def __init__(self, record_type: int) -> None:
+        self.record_type = record_type
+        self.model = UsageRecord.RAW_MODELS[record_type]
+        self.table = self.model._meta.db_table
+        self.function = f"{self.table}_aggregate"
+
+    def get_trigger_name(self, event: str) -> str:
+        return f"{self.table}_aggregate_{event.lower()}"
+
+    def get_upsert_sql(self, *records: str) -> str:
+        changes = [
+            self.CHANGES_SQL.format(
+                subscription_column=self.model._meta.get_field("subscription_id").column,
+                used_column=self.model.USED_FIELD,
+                sign="-" if name == "old_records" else "",
+                records=name,
+            )
+            for name in records
+        ]
+        return ApplyUsageRecordDeltasService.get_upsert_sql(
+            ApplyUsageRecordDeltasService.UPSERT_SQL,
+            "",
+            self.SOURCE_SQL.format(changes=" UNION ALL ".join(changes)),
+            into="INTO written ",
+        )
+
+    def install_function(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.FUNCTION_SQL.format(
+                    function=self.function,
+                    skip_setting=SKIP_AGGREGATION_SETTING,
+                    insert_sql=self.get_upsert_sql("new_records"),
+                    update_sql=self.get_upsert_sql("new_records", "old_records"),
+                    delete_sql=self.get_upsert_sql("old_records"),
+                )
+            )
+
+    @transaction.atomic
+    def create(self):
+        self.install_function()
+        with connection.cursor() as cursor:
+            for event, transition_tables in self.EVENTS.items():
+                cursor.execute(
+                    self.TRIGGER_SQL.format(
+                        name=self.get_trigger_name(event),
+                        event=event,
+                        table=self.table,
+                        transition_tables=transition_tables,
+                        function=self.function,
+                    ),
+                    [self.record_type],
+                )
+
+    @transaction.atomic
+    def drop(self, function: bool = False):
+        with connection.cursor() as cursor:
+            for event in self.EVENTS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {self.get_trigger_name(event)} ON {self.table}")
+            if function:
+                cursor.execute(f"DROP FUNCTION IF EXISTS {self.function}()")
+
+
+class UsageRecordViewSchema:
+    """View of the view backend, raw records grouped by type of usage, subscription and day"""
+
+    VIEW_SQL = """
+        SELECT concat_ws(':', %s, {subscription_column}, usage_date::date) AS id,
+            %s::smallint AS type_of_usage,
+            {subscription_column} AS subscription_id,
+            usage_date::date AS usage_date,
+            sum(price) AS price,
+            sum({used_column})::bigint AS used
+        FROM {table}
+        GROUP BY {subscription_column}, usage_date::date
+    """
+
+    def __init__(self) -> None:
+        self.view = UsageRecordView._meta.db_table
+
+    def get_sql(self) -> Tuple[str, List[str]]:
+        sources, params = [], []
+        for record_type, model in UsageRecord.RAW_MODELS.items():
+            sources.append(
+                self.VIEW_SQL.format(
+                    table=model._meta.db_table,
+                    subscription_column=model._meta.get_field("subscription_id").column,
+                    used_column=model.USED_FIELD,
+                )
+            )
+            params += [record_type, record_type]
+        return " UNION ALL ".join(sources), params
+
+    def create(self):
+        sql, params = self.get_sql()
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE OR REPLACE VIEW {self.view} AS {sql}", params)
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP VIEW IF EXISTS {self.view}")
+
+
+class UsageRecordMaterializedViewSchema(UsageRecordViewSchema):
+    """
+    Materialized view of the materialized_view backend, the same query as the view.
+    The unique index on id is required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+    """
+
+    def __init__(self) -> None:
+        self.view = UsageRecordMaterializedView._meta.db_table
+
+    def exists(self) -> bool:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_matviews WHERE schemaname = current_schema() AND matviewname = %s", [self.view]
+            )
+            return cursor.fetchone() is not None
+
+    @transaction.atomic
+    def create(self):
+        """Create and populate the materialized view unless it exists, a changed query needs drop first"""
+        if self.exists():
+            return
+        sql, params = self.get_sql()
+        refreshed_at = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE MATERIALIZED VIEW {self.view} AS {sql} WITH DATA", params)
+            cursor.execute(f"CREATE UNIQUE INDEX {self.view}_id ON {self.view} (id)")
+            cursor.execute(f"CREATE INDEX {self.view}_subscription_date ON {self.view} (subscription_id, usage_date)")
+        UsageViewRefresh.objects.update_or_create(view=self.view, defaults={"refreshed_at": refreshed_at})
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {self.view}")
+
+
+def get_usage_aggregation_triggers() -> List[UsageAggregationTriggers]:
+    return [UsageAggregationTriggers(record_type) for record_type in UsageRecord.RAW_MODELS]
+
+
+@transaction.atomic
+def sync_aggregation_backend():
+    """
+    Install the view and the trigger functions, create triggers only for the triggers backend
+    and the materialized view only for the materialized_view backend.
+    Switching from the view backends needs rebuild_usage_aggregates, nothing was stored meanwhile
+    """
+    UsageRecordViewSchema().create()
+    backend = get_aggregation_backend()
+    materialized_view = UsageRecordMaterializedViewSchema()
+    if backend == MATERIALIZED_VIEW:
+        materialized_view.create()
+    else:
+        materialized_view.drop()
+    for triggers in get_usage_aggregation_triggers():
+        triggers.drop()
+        if backend == TRIGGERS:
+            triggers.create()
+        else:
+            triggers.install_function()
+
+
+@transaction.atomic
+def remove_aggregation_backend():
+    """Drop all database objects of the triggers and view backends"""
+    for triggers in get_usage_aggregation_triggers():
+        triggers.drop(function=True)
+    UsageRecordMaterializedViewSchema().drop()
+    UsageRecordViewSchema().drop()
@@ -1,18 +1,154 @@
-from django.db.models import CharField, Sum, Value
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
-from wingtel.usage.models import DataUsageRecord, UsageRecord, VoiceUsageRecord
+from django.conf import settings
+from django.db import connections
+from django.db.models import (
+    Case,
+    CharField,
+    DecimalField,
+    F,
+    Max,
+    Min,
+    OuterRef,
+    PositiveSmallIntegerField,
+    Q,
+    QuerySet,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, TruncDate
 
+from wingtel.replicas.routers import replica_selector
+from wingtel.usage.backends import MATERIALIZED_VIEW, VIEW, get_aggregation_backend
+from wingtel.usage.models import (
+    DataUsageRecord,
+    MonthlyUsageRecord,
+    PriceThresholdEvent,
+    RawUsageRemoval,
+    UsageRecord,
+    UsageRecordMaterializedView,
+    UsageRecordShard,
+    UsageRecordTotal,
+    UsageRecordView,
+    UsageViewRefresh,
+    VoiceUsageRecord,
+)
+from wingtel.usage.utils import add_months
 
+# bucket sizes of usage time series, names are date_trunc() fields
+TIME_SERIES_BUCKETS = {"day": "1 day", "week": "1 week", "month": "1 month"}
+# every bucket of the range, empty ones too, with the price and used of every type of usage side by side.
+# Weeks start on Monday, the first and the last bucket count only the days inside the range
+TIME_SERIES_SQL = """
+    WITH usage AS (
+        {usage_sql}
+    )
+    SELECT buckets.bucket::date AS bucket, {columns}
+    FROM generate_series(
+        date_trunc(%(bucket)s, %(date_from)s::timestamp), %(date_to)s::timestamp, %(step)s::interval
+    ) AS buckets (bucket)
+    LEFT JOIN usage ON usage.bucket = buckets.bucket::date
+    GROUP BY buckets.bucket
+    ORDER BY buckets.bucket
+"""
+TIME_SERIES_USAGE_SQL = """
+        SELECT date_trunc(%(bucket)s, usage_date::timestamp)::date AS bucket, type_of_usage, price, used
+        FROM {table}
+        WHERE subscription_id = %(subscription_id)s AND usage_date BETWEEN %(date_from)s AND %(date_to)s
+"""
+TIME_SERIES_COLUMNS_SQL = (
+    "COALESCE(sum(usage.price) FILTER (WHERE usage.type_of_usage = {code}), 0) AS {name}_price, "
+    "COALESCE(sum(usage.used) FILTER (WHERE usage.type_of_usage = {code}), 0) AS {name}_used"
+)
+TOP_USAGE_SQL = """
+    SELECT subscription_id, sum(price) AS total_price, sum(used) AS total_used
+    FROM ({usage_sql}) AS usage
+    GROUP BY subscription_id
+    ORDER BY {value} DESC, subscription_id
+    LIMIT %(limit)s
+"""
+TOP_USAGE_USAGE_SQL = """
+        SELECT subscription_id, price, used
+        FROM {table}
+        {where}
+"""
+TOP_USAGE_FILTERS_SQL = {
+    "type_of_usage": "type_of_usage = %(type_of_usage)s",
+    "date_from": "usage_date >= %(date_from)s",
+    "date_to": "usage_date <= %(date_to)s",
+}
+
+
+@replica_selector
+def get_daily_usage_records() -> QuerySet:
+    """Daily aggregates of the active aggregation backend, UsageRecord or a view over the raw tables"""
+    backend = get_aggregation_backend()
+    if backend == VIEW:
+        return UsageRecordView.objects.all()
+    if backend == MATERIALIZED_VIEW:
+        return UsageRecordMaterializedView.objects.all()
+    return UsageRecord.objects.all()
+
+
+@replica_selector
+def get_usage_refreshed_at() -> Optional[datetime]:
+    """Last refresh of the materialized_view backend, None for the other backends, they are always up to date"""
+    if get_aggregation_backend() != MATERIALIZED_VIEW:
+        return None
+    refresh = UsageViewRefresh.objects.filter(view=UsageRecordMaterializedView._meta.db_table).first()
+    return refresh.refreshed_at if refresh else None
+
+
+@replica_selector
+def get_usage_records_for_export(
+    date_from: Optional[date] = None, date_to: Optional[date] = None, type_of_usage: Optional[int] = None
+) -> QuerySet:
+    """
+    Daily aggregates of the date range as tuples of wingtel.usage.exports.EXPORT_FIELDS in the order
+    of the unique index, types of usage are named. Pending shards of the sharded mode aren't included,
+    compact them before
+    """
+    records = get_daily_usage_records()
+    if type_of_usage:
+        records = records.filter(type_of_usage=type_of_usage)
+    if date_from:
+        records = records.filter(usage_date__gte=date_from)
+    if date_to:
+        records = records.filter(usage_date__lte=date_to)
+    type_name = Case(
+        *[When(type_of_usage=code, then=Value(name)) for code, name in UsageRecord.USAGE_TYPE_NAMES.items()],
+        output_field=CharField(),
+    )
+    return (
+        records.order_by("subscription_id", "type_of_usage", "usage_date")
+        .annotate(type_name=type_name)
+        .values_list("type_name", "subscription_id", "usage_date", "price", "used")
+    )
+
+
+@replica_selector
 def get_usage_records_with_exceeded_price(price_limit: int):
     """
     Return usage records fields(type_of_usage, subscription_id, price_exceeded)
-    group by type_of_usage and subscription_id
+    of subscription totals above price_limit, it's an index range scan over UsageRecordTotal.
+    In sharded mode pending shards are added to the totals, the view backends sum the daily view
     """
+    records = UsageRecordTotal.objects.annotate(current_price=F("total_price"))
+    if get_aggregation_backend() in (VIEW, MATERIALIZED_VIEW):
+        records = (
+            get_daily_usage_records().values("type_of_usage", "subscription_id").annotate(current_price=Sum("price"))
+        )
+    elif settings.USAGE_AGGREGATION_SHARDS:
+        records = UsageRecordTotal.objects.filter(total_price__gt=price_limit - get_max_pending_price()).annotate(
+            current_price=F("total_price") + get_pending_price()
+        )
     return (
-        UsageRecord.objects.filter()
-        .values("type_of_usage", "subscription_id")
-        .annotate(total_price=Sum("price"), price_exceeded=Sum("price") - price_limit)
-        .filter(total_price__gt=price_limit)
+        records.filter(current_price__gt=price_limit)
+        .annotate(price_exceeded=F("current_price") - price_limit)
         .values(
             "type_of_usage",
             "subscription_id",
@@ -21,18 +157,298 @@ def get_usage_records_with_exceeded_price(price_limit: int):
     )
 
 
-def get_usage_records_group_by_subscription_id(subscription_id):
-    """Return usage records(subscription_id, price, used) group by subscription_id"""
+def get_max_pending_price() -> Coalesce:
+    """
+    The greatest pending price of a key, the shards are grouped once. Totals above price_limit with their
+    pending shards are above price_limit minus it, that's still a range of the total_price index
+    """
+    pending_prices = (
+        UsageRecordShard.objects.values("type_of_usage", "subscription_id")
+        .annotate(price=Sum("price"))
+        .order_by("-price")
+        .values("price")[:1]
+    )
+    return Coalesce(Subquery(pending_prices), Value(0), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def get_pending_price() -> Coalesce:
+    """
+    Pending price of the key of an outer UsageRecordTotal row. Records without a subscription are matched with
+    IS NULL, equality never matches NULL and IS NOT DISTINCT FROM can't use the unique index of the shards
+    """
+    shards = UsageRecordShard.objects.filter(type_of_usage=OuterRef("type_of_usage"))
+    pending_prices = [
+        shards.filter(**subscription_filter)
+        .values("type_of_usage", "subscription_id")
+        .annotate(price=Sum("price"))
+        .values("price")
+        for subscription_filter in ({"subscription_id": OuterRef("subscription_id")}, {"subscription_id__isnull": True})
+    ]
+    output_field = DecimalField(max_digits=14, decimal_places=2)
+    pending_price = Case(
+        When(subscription_id__isnull=True, then=Subquery(pending_prices[1])),
+        default=Subquery(pending_prices[0]),
+        output_field=output_field,
+    )
+    return Coalesce(pending_price, Value(0), output_field=output_field)
+
+
+@replica_selector
+def get_price_threshold_events() -> QuerySet:
+    """
+    Threshold events in the order of (transaction_id, id), only of transactions older than every running one.
+    Events of running transactions get greater keys than the returned ones, so a cursor never passes them
+    """
     return (
-        UsageRecord.objects.filter(
-            subscription_id=subscription_id,
+        PriceThresholdEvent.objects.select_related("threshold")
+        .filter(transaction_id__lt=RawSQL("txid_snapshot_xmin(txid_current_snapshot())", []))
+        .order_by("transaction_id", "id")
+    )
+
+
+def get_usage_date_range() -> Tuple[Optional[date], Optional[date]]:
+    """First and last day of the raw records and the daily aggregates, (None, None) without usage"""
+    bounds = [UsageRecord.objects.aggregate(first=Min("usage_date"), last=Max("usage_date"))]
+    for model in UsageRecord.RAW_MODELS.values():
+        bounds.append(model.objects.annotate(day=TruncDate("usage_date")).aggregate(first=Min("day"), last=Max("day")))
+    firsts = [bound["first"] for bound in bounds if bound["first"]]
+    lasts = [bound["last"] for bound in bounds if bound["last"]]
+    if not firsts:
+        return None, None
+    return min(firsts), max(lasts)
+
+
+def get_raw_usage_types(date_from: date, date_to: date) -> Dict[date, List[int]]:
+    """
+    Types of usage of every day in the range whose raw records are still in the database. Raw records of
+    the other ones were dropped or archived (RawUsageRemoval), only their aggregates are left
+    """
+    days = {
+        date_from + timedelta(days=day): list(UsageRecord.RAW_MODELS) for day in range((date_to - date_from).days + 1)
+    }
+    removals = RawUsageRemoval.objects.filter(
+        Q(date_from__isnull=True) | Q(date_from__lte=date_to), date_to__gte=date_from
+    ).values_list("type_of_usage", "date_from", "date_to")
+    for type_of_usage, removed_from, removed_to in removals:
+        first, last = max(removed_from or date_from, date_from), min(removed_to, date_to)
+        for day in range((last - first).days + 1):
+            types = days[first + timedelta(days=day)]
+            if type_of_usage in types:
+                types.remove(type_of_usage)
+    return days
+
+
+def get_whole_months(date_from: Optional[date], date_to: Optional[date]) -> Tuple[Optional[date], Optional[date]]:
+    """
+    Return first days of the first and the last month lying entirely inside [date_from, date_to].
+    None bound means the range is open on that side
+    """
+    first_month = date_from
+    if date_from and date_from.day != 1:
+        first_month = add_months(date_from, 1)
+    last_month = date_to
+    if date_to:
+        last_month = date_to.replace(day=1) if (date_to + timedelta(days=1)).day == 1 else add_months(date_to, -1)
+    return first_month, last_month
+
+
+@replica_selector
+def get_usage_records_group_by_subscription_id(
+    subscription_id,
+    type_of_usage: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+) -> List[Dict]:
+    """
+    Return usage records(subscription_id, total_price, total_used) group by subscription_id.
+    Whole months of the date range are read from MonthlyUsageRecord, partial months at the edges from UsageRecord
+    """
+    return get_usage_records_group_by_subscription_ids([subscription_id], type_of_usage, date_from, date_to)
+
+
+@replica_selector
+def get_usage_records_group_by_subscription_ids(
+    subscription_ids: Union[Iterable[int], QuerySet],
+    type_of_usage: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+) -> List[Dict]:
+    """
+    The same as get_usage_records_group_by_subscription_id for many subscriptions in one grouped query.
+    subscription_ids can be a queryset of subscription ids, it's used as a subquery.
+    In sharded mode pending shards of the date range are added, the view backends sum the daily view
+    """
+    if get_aggregation_backend() in (VIEW, MATERIALIZED_VIEW):
+        view_records = get_daily_usage_records().filter(subscription_id__in=subscription_ids)
+        if type_of_usage:
+            view_records = view_records.filter(type_of_usage=type_of_usage)
+        if date_from:
+            view_records = view_records.filter(usage_date__gte=date_from)
+        if date_to:
+            view_records = view_records.filter(usage_date__lte=date_to)
+        return list(
+            view_records.values("subscription_id")
+            .annotate(total_price=Sum("price"), total_used=Sum("used"))
+            .order_by("subscription_id")
         )
-        .values("subscription_id")
-        .annotate(
-            total_price=Sum("price"),
-            total_used=Sum("used"),
+
+    daily_records = UsageRecord.objects.filter(subscription_id__in=subscription_ids)
+    monthly_records = MonthlyUsageRecord.objects.filter(subscription_id__in=subscription_ids)
+    shard_records = UsageRecordShard.objects.filter(subscription_id__in=subscription_ids)
+    if type_of_usage:
+        daily_records = daily_records.filter(type_of_usage=type_of_usage)
+        monthly_records = monthly_records.filter(type_of_usage=type_of_usage)
+        shard_records = shard_records.filter(type_of_usage=type_of_usage)
+    if date_from:
+        daily_records = daily_records.filter(usage_date__gte=date_from)
+        shard_records = shard_records.filter(usage_date__gte=date_from)
+    if date_to:
+        daily_records = daily_records.filter(usage_date__lte=date_to)
+        shard_records = shard_records.filter(usage_date__lte=date_to)
+
+    first_month, last_month = get_whole_months(date_from, date_to)
+    if first_month and last_month and first_month > last_month:
+        # no whole month inside the range, it's read from daily records only
+        monthly_records = monthly_records.none()
+    else:
+        edges = Q(pk__in=[])
+        if first_month:
+            monthly_records = monthly_records.filter(usage_month__gte=first_month)
+            edges |= Q(usage_date__lt=first_month)
+        if last_month:
+            monthly_records = monthly_records.filter(usage_month__lte=last_month)
+            edges |= Q(usage_date__gte=add_months(last_month, 1))
+        daily_records = daily_records.filter(edges)
+
+    parts = [monthly_records]
+    if settings.USAGE_AGGREGATION_SHARDS:
+        parts.append(shard_records)
+    records = (
+        daily_records.values("subscription_id")
+        .annotate(total_price=Sum("price"), total_used=Sum("used"))
+        .union(
+            *[
+                part.values("subscription_id").annotate(total_price=Sum("price"), total_used=Sum("used"))
+                for part in parts
+            ],
+            all=True,
         )
     )
+    totals: Dict[int, Dict] = {}
+    for record in records:
+        total = totals.setdefault(
+            record["subscription_id"], {"subscription_id": record["subscription_id"], "total_price": 0, "total_used": 0}
+        )
+        total["total_price"] += record["total_price"]
+        total["total_used"] += record["total_used"]
+    return [totals[subscription_id] for subscription_id in sorted(totals)]
+
+
+@replica_selector
+def get_top_usage_subscriptions(
+    metric: str,
+    limit: int,
+    type_of_usage: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    approximate: bool = False,
+) -> List[Dict]:
+    """
+    Return the limit subscriptions(rank, subscription_id, total_price, total_used) with the greatest total_<metric>
+    ("price" or "used") of the date range. Ties are ordered by subscription_id and share a rank.
+    It's one grouped query over a covering index range scan of the daily records, pending shards are added
+    in sharded mode. The approximate mode needs a type_of_usage, it rounds the range out to whole months of
+    MonthlyUsageRecord, an open range reads UsageRecordTotal in the order of the metric index. Rollups don't
+    include pending shards. The view backends have no rollups, they are always exact
+    """
+    value = f"total_{metric}"
+    if not approximate or get_aggregation_backend() in (VIEW, MATERIALIZED_VIEW):
+        top = get_exact_top_usage_subscriptions(value, limit, type_of_usage, date_from, date_to)
+    else:
+        if not type_of_usage:
+            raise ValueError("The approximate mode needs a type_of_usage")
+        if date_from is None and date_to is None:
+            # one row per subscription, it's read in the order of the metric index
+            records = UsageRecordTotal.objects.filter(type_of_usage=type_of_usage).values(
+                "subscription_id", "total_price", "total_used"
+            )
+        else:
+            records = MonthlyUsageRecord.objects.filter(type_of_usage=type_of_usage)
+            if date_from:
+                records = records.filter(usage_month__gte=date_from.replace(day=1))
+            if date_to:
+                records = records.filter(usage_month__lte=date_to.replace(day=1))
+            records = records.values("subscription_id").annotate(total_price=Sum("price"), total_used=Sum("used"))
+        top = list(records.order_by(f"-{value}", "subscription_id")[:limit])
+
+    for position, record in enumerate(top, start=1):
+        tied = position > 1 and record[value] == top[position - 2][value]
+        record["rank"] = top[position - 2]["rank"] if tied else position
+    return top
+
+
+def get_exact_top_usage_subscriptions(
+    value: str, limit: int, type_of_usage: Optional[int], date_from: Optional[date], date_to: Optional[date]
+) -> List[Dict]:
+    """
+    The limit subscriptions with the greatest value ("total_price" or "total_used") of the daily records and,
+    in sharded mode, their pending shards. A subscription can have pending shards only, so both tables are
+    grouped together
+    """
+    tables = [get_daily_usage_records().model._meta.db_table]
+    if settings.USAGE_AGGREGATION_SHARDS and get_aggregation_backend() not in (VIEW, MATERIALIZED_VIEW):
+        tables.append(UsageRecordShard._meta.db_table)
+    filters = {"type_of_usage": type_of_usage, "date_from": date_from, "date_to": date_to}
+    where = " AND ".join(TOP_USAGE_FILTERS_SQL[name] for name, param in filters.items() if param)
+    sql = TOP_USAGE_SQL.format(
+        usage_sql="UNION ALL".join(
+            TOP_USAGE_USAGE_SQL.format(table=table, where=f"WHERE {where}" if where else "") for table in tables
+        ),
+        value=value,
+    )
+    with connections[UsageRecord.objects.db].cursor() as cursor:
+        cursor.execute(sql, {**filters, "limit": limit})
+        columns = [column.name for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def count_time_series_buckets(bucket: str, date_from: date, date_to: date) -> int:
+    """Number of rows get_usage_time_series returns for the date range"""
+    if bucket == "month":
+        return (date_to.year - date_from.year) * 12 + date_to.month - date_from.month + 1
+    if bucket == "week":
+        first_monday, last_monday = (day - timedelta(days=day.weekday()) for day in (date_from, date_to))
+        return (last_monday - first_monday).days // 7 + 1
+    return (date_to - date_from).days + 1
+
+
+@replica_selector
+def get_usage_time_series(subscription_id: int, bucket: str, date_from: date, date_to: date) -> List[Dict]:
+    """
+    Return every day, week or month (bucket) of the date range with <type>_price and <type>_used of every type
+    of usage, zero for empty buckets, in one query. Buckets are named by their first day.
+    It's an index-only range scan of the subscription's daily records, pending shards are added in sharded mode
+    """
+    tables = [get_daily_usage_records().model._meta.db_table]
+    if settings.USAGE_AGGREGATION_SHARDS and get_aggregation_backend() not in (VIEW, MATERIALIZED_VIEW):
+        tables.append(UsageRecordShard._meta.db_table)
+    sql = TIME_SERIES_SQL.format(
+        usage_sql="UNION ALL".join(TIME_SERIES_USAGE_SQL.format(table=table) for table in tables),
+        columns=", ".join(
+            TIME_SERIES_COLUMNS_SQL.format(code=code, name=name) for code, name in UsageRecord.USAGE_TYPE_NAMES.items()
+        ),
+    )
+    params = {
+        "subscription_id": subscription_id,
+        "bucket": bucket,
+        "step": TIME_SERIES_BUCKETS[bucket],
+        "date_from": date_from,
+        "date_to": date_to,
+    }
+    with connections[UsageRecord.objects.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column.name for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
 
 def get_data_usage_records_group_by():
@@ -41,7 +457,7 @@ def get_data_usage_records_group_by():
         DataUsageRecord.objects.all()
         .values("usage_date__date", "subscription_id")
         .annotate(
-            type_of_usage=Value(UsageRecord.USAGE_TYPES.data, output_field=CharField(max_length=5)),
+            type_of_usage=Value(UsageRecord.USAGE_TYPES.data, output_field=PositiveSmallIntegerField()),
             total_price=Sum("price"),
             total_used=Sum("kilobytes_used"),
         )
@@ -56,7 +472,7 @@ def get_voice_usage_records_group_by():
         VoiceUsageRecord.objects.all()
         .values("usage_date__date", "subscription_id")
         .annotate(
-            type_of_usage=Value(UsageRecord.USAGE_TYPES.voice, output_field=CharField(max_length=5)),
+            type_of_usage=Value(UsageRecord.USAGE_TYPES.voice, output_field=PositiveSmallIntegerField()),
             total_price=Sum("price"),
             total_used=Sum("seconds_used"),
         )
@@ -1,19 +1,152 @@
+from django.conf import settings
 from rest_framework import serializers
 
-from wingtel.usage.models import UsageRecord
+from wingtel.subscriptions.models import Subscription
+from wingtel.usage.exports import EXPORT_FORMATS
+from wingtel.usage.models import PriceThreshold, PriceThresholdEvent, UsageRecord
+from wingtel.usage.selectors import TIME_SERIES_BUCKETS, count_time_series_buckets
+
+
+class UsageTypeField(serializers.ChoiceField):
+    """Type of usage by name ("data", "voice"), it's stored as a small integer code"""
+
+    def __init__(self, **kwargs):
+        super().__init__(choices=list(UsageRecord.USAGE_TYPE_CODES), **kwargs)
+
+    def to_internal_value(self, data):
+        return UsageRecord.USAGE_TYPE_CODES[super().to_internal_value(data)]
+
+    def to_representation(self, value):
+        return UsageRecord.USAGE_TYPE_NAMES[value]
 
 
 class UsageRecordExceedingPriceSerializer(serializers.Serializer):
     subscription_id = serializers.IntegerField()
     price_exceeded = serializers.IntegerField()
-    type_of_usage = serializers.ChoiceField(choices=UsageRecord.USAGE_TYPES)
+    type_of_usage = UsageTypeField()
 
 
 class PriceLimitDeserializer(serializers.Serializer):
     price_limit = serializers.IntegerField(min_value=1)
+    type_of_usage = UsageTypeField(required=False)
+    stream = serializers.BooleanField(default=False)
+
+
+class UsageMetricsDeserializer(serializers.Serializer):
+    type_of_usage = UsageTypeField(required=False)
+    usage_date__gte = serializers.DateField(required=False)
+    usage_date__lte = serializers.DateField(required=False)
+
+
+class UsageExportDeserializer(UsageMetricsDeserializer):
+    # "format" is taken by the format suffix of DRF content negotiation
+    file_format = serializers.ChoiceField(choices=EXPORT_FORMATS, default=EXPORT_FORMATS[0])
+
+
+class TopUsageDeserializer(UsageMetricsDeserializer):
+    metric = serializers.ChoiceField(choices=["price", "used"], default="price")
+    limit = serializers.IntegerField(min_value=1, max_value=settings.USAGE_TOP_MAX_LIMIT, default=100)
+    approximate = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if attrs["approximate"] and "type_of_usage" not in attrs:
+            raise serializers.ValidationError("approximate needs a type_of_usage.")
+        return attrs
+
+
+class UsageTimeSeriesDeserializer(serializers.Serializer):
+    usage_date__gte = serializers.DateField()
+    usage_date__lte = serializers.DateField()
+    bucket = serializers.ChoiceField(choices=list(TIME_SERIES_BUCKETS), default="day")
+
+    def validate(self, attrs):
+        if attrs["usage_date__gte"] > attrs["usage_date__lte"]:
+            raise serializers.ValidationError("usage_date__gte is after usage_date__lte.")
+        max_buckets = settings.USAGE_TIME_SERIES_MAX_BUCKETS
+        if count_time_series_buckets(attrs["bucket"], attrs["usage_date__gte"], attrs["usage_date__lte"]) > max_buckets:
+            raise serializers.ValidationError(f"Ensure the date range has at most {max_buckets} buckets.")
+        return attrs
+
+
+class UsageMetricsBatchDeserializer(UsageMetricsDeserializer):
+    """Subscriptions are given by subscription_ids or selected by type_of_subscription and status"""
+
+    subscription_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False)
+    type_of_subscription = serializers.ChoiceField(choices=Subscription.SUBSCRIPTION_TYPE, required=False)
+    status = serializers.ChoiceField(choices=Subscription.STATUS, required=False)
+
+    def validate(self, attrs):
+        max_size = settings.USAGE_METRICS_BATCH_MAX_SIZE
+        filters = {field: attrs[field] for field in ("type_of_subscription", "status") if field in attrs}
+        if "subscription_ids" in attrs:
+            if filters:
+                raise serializers.ValidationError("Give either subscription_ids or a subscription filter, not both.")
+            subscription_ids = attrs["subscription_ids"]
+        else:
+            if not filters:
+                raise serializers.ValidationError("Either subscription_ids or a subscription filter is required.")
+            # one more id than allowed tells a too broad filter apart in the same query
+            subscription_ids = list(Subscription.objects.filter(**filters).values_list("id", flat=True)[: max_size + 1])
+            if len(subscription_ids) > max_size:
+                raise serializers.ValidationError(
+                    f"More than {max_size} subscriptions match the filter, narrow it or use subscription_ids."
+                )
+        if len(subscription_ids) > max_size:
+            raise serializers.ValidationError({"subscription_ids": f"Ensure there are at most {max_size} ids."})
+        attrs["subscription_ids"] = subscription_ids
+        return attrs
 
 
 class UsageRecordTotalMetricsSerializer(serializers.Serializer):
     subscription_id = serializers.IntegerField()
     total_price = serializers.IntegerField()
     total_used = serializers.IntegerField()
+
+
+class UsageTimeSeriesSerializer(serializers.Serializer):
+    bucket = serializers.DateField()
+    data_price = serializers.DecimalField(max_digits=14, decimal_places=2)
+    data_used = serializers.IntegerField()
+    voice_price = serializers.DecimalField(max_digits=14, decimal_places=2)
+    voice_used = serializers.IntegerField()
+
+
+class TopUsageSerializer(UsageRecordTotalMetricsSerializer):
+    rank = serializers.IntegerField()
+
+
+class PriceThresholdSerializer(serializers.ModelSerializer):
+    type_of_usage = UsageTypeField(required=False, allow_null=True)
+
+    class Meta:
+        model = PriceThreshold
+        fields = [
+            "id",
+            "name",
+            "price_limit",
+            "period",
+            "type_of_usage",
+            "subscription",
+            "plan",
+            "is_active",
+            "created_at",
+        ]
+        extra_kwargs = {"price_limit": {"min_value": 0}}
+
+    def validate(self, attrs):
+        scope = [
+            attrs.get(field, getattr(self.instance, field, None) if self.instance else None)
+            for field in ("subscription", "plan")
+        ]
+        if all(scope):
+            raise serializers.ValidationError("A threshold is limited to a subscription or to a plan, not both.")
+        return attrs
+
+
+class PriceThresholdEventSerializer(serializers.ModelSerializer):
+    type_of_usage = UsageTypeField()
+    period = serializers.CharField(source="threshold.period")
+
+    class Meta:
+        model = PriceThresholdEvent
+        fields = ["id", "threshold", "period", "period_start", "subscription", "type_of_usage", "price", "created_at"]
@@ -1,13 +1,348 @@
-from typing import Dict, Union
+import csv
+import io
+import json
+import os
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import (
+    DefaultDict,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+    Union,
+)
 
-from django.db import transaction
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
 
-from wingtel.usage.models import DataUsageRecord, UsageRecord, VoiceUsageRecord
+from wingtel.monitoring.metrics import AGGREGATION_DURATION
+from wingtel.subscriptions.models import Subscription
+from wingtel.usage.backends import MATERIALIZED_VIEW, SIGNALS, get_aggregation_backend
+from wingtel.usage.cache import UsageRecordKey, invalidate_usage_records
+from wingtel.usage.models import (
+    DataUsageRecord,
+    MonthlyUsageRecord,
+    PriceThreshold,
+    PriceThresholdEvent,
+    UsageRecord,
+    UsageRecordMaterializedView,
+    UsageRecordShard,
+    UsageRecordTotal,
+    UsageViewRefresh,
+    VoiceUsageRecord,
+)
+from wingtel.usage.selectors import get_raw_usage_types
 from wingtel.usage.utils import get_object_or_none
 
+RawUsageRecord = Union[DataUsageRecord, VoiceUsageRecord]
+# subscription range of the records without a subscription in rebuilds, subscription ids are positive
+NULL_SUBSCRIPTION_RANGE = (-1, -1)
+# (type_of_usage, subscription_id, usage_date) -> [price, used]
+UsageRecordDeltas = DefaultDict[UsageRecordKey, List]
+
+
+def new_usage_record_deltas() -> UsageRecordDeltas:
+    return defaultdict(lambda: [Decimal(0), 0])
+
+
+def add_usage_record_delta(deltas: UsageRecordDeltas, record_type: int, instance: RawUsageRecord, sign: int = 1):
+    """Add price and used of a raw record to the delta of its (type, subscription, day) key"""
+    delta = deltas[(record_type, instance.subscription_id_id, instance.usage_date.date())]
+    delta[0] += sign * Decimal(instance.price)
+    delta[1] += sign * getattr(instance, UsageRecord.RAW_MODELS[record_type].USED_FIELD)
+
+
+def get_usage_record_shard(shards: int) -> int:
+    """
+    Shard of the current writer, it's stable for a process and thread,
+    so a transaction writing a hot key many times holds a lock on one shard row only
+    """
+    return hash((os.getpid(), threading.get_ident())) % shards
+
+
+class ApplyUsageRecordDeltasService:
+    """
+    Fold grouped deltas into UsageRecord and its rollups (MonthlyUsageRecord, UsageRecordTotal)
+    with one statement of INSERT ... ON CONFLICT DO UPDATE per table.
+    The increment happens inside the database, so concurrent writers can't lose updates,
+    rows are upserted in the order of the unique indexes to keep lock order the same for all writers.
+    source_sql selects (type_of_usage, subscription_id, usage_date, price, used) with unique keys,
+    prelude_sql adds CTEs before it (data-modifying statements are allowed only at the top level).
+    The same statement records PriceThresholdEvent of the new prices above a PriceThreshold, a crossing is recorded
+    once per threshold and period. In sharded mode deltas are added to one of UsageRecordShard rows of the key
+    instead, thresholds are evaluated when the shards are compacted
+    """
+
+    UPSERT_SQL = """
+        WITH {prelude}delta (type_of_usage, subscription_id, usage_date, price, used) AS (
+            {source}
+        ),
+        daily AS (
+            INSERT INTO {daily_table} AS aggregated (type_of_usage, subscription_id, usage_date, price, used)
+            SELECT * FROM delta
+            ORDER BY subscription_id, type_of_usage, usage_date
+            ON CONFLICT (type_of_usage, subscription_id, usage_date) DO UPDATE
+            SET price = aggregated.price + EXCLUDED.price, used = aggregated.used + EXCLUDED.used
+            RETURNING type_of_usage, subscription_id, usage_date, price
+        ),
+        monthly AS (
+            INSERT INTO {monthly_table} AS aggregated (type_of_usage, subscription_id, usage_month, price, used)
+            SELECT type_of_usage, subscription_id, date_trunc('month', usage_date)::date, sum(price), sum(used)
+            FROM delta
+            GROUP BY type_of_usage, subscription_id, date_trunc('month', usage_date)::date
+            ORDER BY subscription_id, type_of_usage, date_trunc('month', usage_date)::date
+            ON CONFLICT (type_of_usage, subscription_id, usage_month) DO UPDATE
+            SET price = aggregated.price + EXCLUDED.price, used = aggregated.used + EXCLUDED.used
+            RETURNING type_of_usage, subscription_id, usage_month, price
+        ),
+        total AS (
+            INSERT INTO {total_table} AS aggregated (type_of_usage, subscription_id, total_price, total_used)
+            SELECT type_of_usage, subscription_id, sum(price), sum(used)
+            FROM delta
+            GROUP BY type_of_usage, subscription_id
+            ORDER BY subscription_id, type_of_usage
+            ON CONFLICT (type_of_usage, subscription_id) DO UPDATE
+            SET total_price = aggregated.total_price + EXCLUDED.total_price,
+                total_used = aggregated.total_used + EXCLUDED.total_used
+            RETURNING type_of_usage, subscription_id, total_price
+        ),
+        threshold_event AS (
+            INSERT INTO {event_table}
+                (threshold_id, type_of_usage, subscription_id, period_start, price, transaction_id, created_at)
+            SELECT threshold.id, aggregated.type_of_usage, aggregated.subscription_id, aggregated.period_start,
+                aggregated.price, txid_current(), now()
+            FROM (
+                SELECT 'day' AS period, type_of_usage, subscription_id, usage_date AS period_start, price FROM daily
+                UNION ALL
+                SELECT 'month', type_of_usage, subscription_id, usage_month, price FROM monthly
+                UNION ALL
+                SELECT 'total', type_of_usage, subscription_id, NULL::date, total_price FROM total
+            ) AS aggregated
+            JOIN {threshold_table} AS threshold
+                ON threshold.period = aggregated.period AND aggregated.price > threshold.price_limit
+            JOIN {subscription_table} AS subscription ON subscription.id = aggregated.subscription_id
+            WHERE threshold.is_active
+                AND (threshold.type_of_usage IS NULL OR threshold.type_of_usage = aggregated.type_of_usage)
+                AND (threshold.subscription_id IS NULL OR threshold.subscription_id = aggregated.subscription_id)
+                AND (threshold.plan_id IS NULL OR threshold.plan_id = subscription.plan_id)
+            ORDER BY threshold.id, aggregated.subscription_id, aggregated.type_of_usage, aggregated.period_start
+            ON CONFLICT DO NOTHING
+        )
+        SELECT count(*) {into}FROM total
+    """
+    # the totals row of a key is created without locking an existing one, so the price limit API
+    # can add pending shards to it before the first compaction
+    SHARD_UPSERT_SQL = """
+        WITH {prelude}delta (type_of_usage, subscription_id, usage_date, price, used) AS (
+            {source}
+        ),
+        total AS (
+            INSERT INTO {total_table} (type_of_usage, subscription_id, total_price, total_used)
+            SELECT DISTINCT type_of_usage, subscription_id, 0, 0
+            FROM delta
+            ORDER BY subscription_id, type_of_usage
+            ON CONFLICT (type_of_usage, subscription_id) DO NOTHING
+        )
+        INSERT INTO {shard_table} AS aggregated (type_of_usage, subscription_id, usage_date, shard, price, used)
+        SELECT type_of_usage, subscription_id, usage_date, %s, price, used
+        FROM delta
+        ORDER BY subscription_id, type_of_usage, usage_date
+        ON CONFLICT (type_of_usage, subscription_id, usage_date, shard) DO UPDATE
+        SET price = aggregated.price + EXCLUDED.price, used = aggregated.used + EXCLUDED.used
+    """
+    DELTAS_SOURCE_SQL = "SELECT * FROM unnest(%s::smallint[], %s::integer[], %s::date[], %s::numeric[], %s::bigint[])"
+
+    def __init__(
+        self,
+        source_sql: str,
+        params: Sequence = (),
+        keys: Optional[List[UsageRecordKey]] = None,
+        prelude_sql: str = "",
+        shards: Optional[int] = None,
+    ) -> None:
+        self.source_sql = source_sql
+        self.params = params
+        # changed (type_of_usage, subscription_id, usage_date), None when the source is a query
+        self.keys = keys
+        self.prelude_sql = prelude_sql
+        # None is USAGE_AGGREGATION_SHARDS, 0 writes UsageRecord directly
+        self.shards = settings.USAGE_AGGREGATION_SHARDS if shards is None else shards
+
+    @staticmethod
+    def get_upsert_sql(sql: str, prelude_sql: str, source_sql: str, into: str = "") -> str:
+        """into is INTO <variable> of the total count of upserted rows in PL/pgSQL"""
+        return sql.format(
+            daily_table=UsageRecord._meta.db_table,
+            monthly_table=MonthlyUsageRecord._meta.db_table,
+            total_table=UsageRecordTotal._meta.db_table,
+            shard_table=UsageRecordShard._meta.db_table,
+            threshold_table=PriceThreshold._meta.db_table,
+            event_table=PriceThresholdEvent._meta.db_table,
+            subscription_table=Subscription._meta.db_table,
+            prelude=prelude_sql,
+            source=source_sql,
+            into=into,
+        )
+
+    @classmethod
+    def from_deltas(cls, deltas: UsageRecordDeltas) -> "ApplyUsageRecordDeltasService":
+        """Build the source from deltas collected in python, nothing is applied for empty deltas"""
+        if not deltas:
+            return cls("")
+        keys = list(deltas)
+        params = [
+            [type_of_usage for type_of_usage, _, _ in keys],
+            [subscription_id for _, subscription_id, _ in keys],
+            [usage_date for _, _, usage_date in keys],
+            [deltas[key][0] for key in keys],
+            [deltas[key][1] for key in keys],
+        ]
+        return cls(cls.DELTAS_SOURCE_SQL, params, keys)
+
+    def apply(self) -> int:
+        """Upsert all deltas in a single statement, return the number of totals or shards written by it"""
+        if not self.source_sql:
+            return 0
+        params = list(self.params)
+        with connection.cursor() as cursor:
+            if self.shards:
+                params.append(get_usage_record_shard(self.shards))
+                cursor.execute(self.get_upsert_sql(self.SHARD_UPSERT_SQL, self.prelude_sql, self.source_sql), params)
+                rowcount = cursor.rowcount
+            else:
+                cursor.execute(self.get_upsert_sql(self.UPSERT_SQL, self.prelude_sql, self.source_sql), params)
+                rowcount = cursor.fetchone()[0]
+        invalidate_usage_records(self.keys)
+        return rowcount
+
+    def apply_raw_changes(self) -> int:
+        """
+        Apply deltas of raw records written by the application. With the triggers backend the database
+        has applied them already and the view backend doesn't store aggregates, so only the cache is invalidated.
+        Reads of the materialized_view backend change with a refresh only
+        """
+        backend = get_aggregation_backend()
+        if backend == SIGNALS:
+            return self.apply()
+        if self.source_sql and backend != MATERIALIZED_VIEW:
+            invalidate_usage_records(self.keys)
+        return 0
+
+
+_deferred = threading.local()
+
+
+def get_savepoint_depth() -> int:
+    """Savepoints of the open atomic blocks, blocks with savepoint=False have None ids"""
+    return sum(1 for savepoint_id in connection.savepoint_ids if savepoint_id)
+
+
+@contextmanager
+def deferred_usage_aggregation():
+    """
+    Collect deltas of raw records saved and deleted inside the block by (type, subscription, day)
+    and apply them with one upsert at its exit, just before commit.
+    The block is atomic, raw records and their aggregates are committed together.
+    Aggregates read inside the block don't include its records yet, nested blocks are flushed by the outermost one.
+    Deltas of nested atomic blocks with a savepoint are applied right away, a rollback to the savepoint
+    must take them back with its raw records
+    """
+    if getattr(_deferred, "deltas", None) is not None:
+        yield
+        return
+    _deferred.deltas = new_usage_record_deltas()
+    try:
+        with transaction.atomic():
+            _deferred.savepoints = get_savepoint_depth()
+            yield
+            deltas, _deferred.deltas = _deferred.deltas, None
+            with AGGREGATION_DURATION.time(service="deferred_usage_aggregation"):
+                ApplyUsageRecordDeltasService.from_deltas(deltas).apply_raw_changes()
+    finally:
+        _deferred.deltas = None
+
+
+def apply_usage_record_deltas(deltas: UsageRecordDeltas):
+    """Apply deltas now or add them to the deferred ones inside deferred_usage_aggregation()"""
+    deferred = getattr(_deferred, "deltas", None)
+    if deferred is None or get_savepoint_depth() > _deferred.savepoints:
+        ApplyUsageRecordDeltasService.from_deltas(deltas).apply_raw_changes()
+        return
+    for key, (price, used) in deltas.items():
+        deferred[key][0] += price
+        deferred[key][1] += used
+
+
+class CompactUsageRecordShardsService:
+    """
+    Fold pending UsageRecordShard rows into UsageRecord and its rollups, batch_size shards per statement.
+    Shards are deleted and applied in the same statement, readers never see them twice or miss them.
+    Shards locked by writers are skipped, the next run folds them
+    """
+
+    PRELUDE_SQL = """
+        compacted AS (
+            DELETE FROM {shard_table}
+            WHERE id IN (SELECT id FROM {shard_table} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+            RETURNING type_of_usage, subscription_id, usage_date, price, used
+        ),
+    """
+    SOURCE_SQL = """
+        SELECT type_of_usage, subscription_id, usage_date, sum(price), sum(used)
+        FROM compacted
+        GROUP BY type_of_usage, subscription_id, usage_date
+    """
+
+    def __init__(self, batch_size: int = 10000) -> None:
+        self.batch_size = batch_size
+
+    def compact(self) -> int:
+        """Compact until no unlocked shards are left, return the number of batches"""
+        prelude_sql = self.PRELUDE_SQL.format(shard_table=UsageRecordShard._meta.db_table)
+        batches = 0
+        while True:
+            with transaction.atomic():
+                # read results don't change, so nothing is evicted from the cache
+                service = ApplyUsageRecordDeltasService(
+                    self.SOURCE_SQL, [self.batch_size], keys=[], prelude_sql=prelude_sql, shards=0
+                )
+                if not service.apply():
+                    return batches
+            batches += 1
+
+
+class RefreshUsageRecordMaterializedViewService:
+    """
+    Refresh the materialized view of the materialized_view backend. Concurrent refresh doesn't block readers,
+    it diffs the new result against the view. The refresh time is recorded in the same transaction,
+    the view includes raw records committed before it
+    """
+
+    def __init__(self, concurrently: bool = True) -> None:
+        self.concurrently = concurrently
+        self.view = UsageRecordMaterializedView._meta.db_table
+
+    def refresh(self) -> datetime:
+        with transaction.atomic(), AGGREGATION_DURATION.time(service=self.__class__.__name__):
+            refreshed_at = timezone.now()
+            with connection.cursor() as cursor:
+                cursor.execute(f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if self.concurrently else ''}{self.view}")
+            UsageViewRefresh.objects.update_or_create(view=self.view, defaults={"refreshed_at": refreshed_at})
+        invalidate_usage_records(None)
+        return refreshed_at
+
 
 class CreateUpdateUsageRecordService:
-    def __init__(self, new_instance: Union[DataUsageRecord, VoiceUsageRecord], record_type: str) -> None:
+    def __init__(self, new_instance: RawUsageRecord, record_type: int) -> None:
         self.new_instance = new_instance
         self.record_type = record_type
         self.old_instance = None
@@ -15,76 +350,350 @@ class CreateUpdateUsageRecordService:
             # old instance exist only in update process
             self.old_instance = get_object_or_none(new_instance.__class__, id=new_instance.id)
 
-    @transaction.atomic
     def aggregate_object(self):
         """Create/Update an aggregate object using new instance"""
-        fields = {
-            "type_of_usage": self.record_type,
-            "subscription": self.new_instance.subscription_id,
-            "usage_date": self.new_instance.usage_date.date(),
-        }
-
-        aggregated_instance = get_object_or_none(UsageRecord, **fields)
-        if aggregated_instance:
-            self.__update_aggregated_object(aggregated_instance)
-        else:
-            self.__create_aggregated_object(fields)
-
-    def __create_aggregated_object(self, fields: Dict):
-        """Create new UsageRecord object"""
-        used_field = self.__get_used_field()
-        UsageRecord.objects.create(price=self.new_instance.price, used=used_field, **fields)
-
-    def __update_aggregated_object(self, aggregated_instance: UsageRecord):
-        """Update existing UsageRecord object"""
+        with AGGREGATION_DURATION.time(service=self.__class__.__name__):
+            apply_usage_record_deltas(self.get_deltas())
+
+    def get_deltas(self) -> UsageRecordDeltas:
+        """
+        Add new instance to its aggregate and take old instance from its own aggregate,
+        so updates that move a record to another day or subscription stay correct
+        """
+        deltas = new_usage_record_deltas()
         if self.old_instance:
-            self.__reduce_old_object_fields(aggregated_instance)
-        aggregated_instance.price += self.new_instance.price
-        aggregated_instance.used += self.__get_used_field()
-        aggregated_instance.save(update_fields=["price", "used"])
-
-    def __get_used_field(self, instance=None):
-        """Choose used field based on type"""
-        if not instance:
-            instance = self.new_instance
-        if self.record_type == UsageRecord.USAGE_TYPES.data:
-            used_field = instance.kilobytes_used
-        else:
-            used_field = instance.seconds_used
-        return used_field
-
-    def __reduce_old_object_fields(self, aggregated_instance: UsageRecord):
-        """Delete self.old_instance fields from aggregated"""
-        aggregated_instance.price -= self.old_instance.price
-        aggregated_instance.used -= self.__get_used_field(self.old_instance)
+            add_usage_record_delta(deltas, self.record_type, self.old_instance, sign=-1)
+        add_usage_record_delta(deltas, self.record_type, self.new_instance)
+        return deltas
 
 
 class DeleteUsageRecordService:
-    def __init__(self, instance: Union[DataUsageRecord, VoiceUsageRecord], record_type: str) -> None:
+    def __init__(self, instance: RawUsageRecord, record_type: int) -> None:
         self.instance = instance
         self.record_type = record_type
 
     def modify_aggregated_object(self):
         """Delete from aggregated object"""
-        fields = {
-            "type_of_usage": self.record_type,
-            "subscription": self.instance.subscription_id,
-            "usage_date": self.instance.usage_date.date(),
-        }
-        aggregated_instance = get_object_or_none(UsageRecord, **fields)
-        if aggregated_instance:
-            self.__reduce_values(aggregated_instance)
-            aggregated_instance.save(update_fields=["price", "used"])
-
-    def __reduce_values(self, aggregated_instance: UsageRecord):
-        """Delete self.old_instance fields from aggregated"""
-        aggregated_instance.price -= self.instance.price
-        aggregated_instance.used -= self.__get_used_field()
-
-    def __get_used_field(self):
-        """Choose used field based on type"""
-        if self.record_type == UsageRecord.USAGE_TYPES.data:
-            used_field = self.instance.kilobytes_used
-        else:
-            used_field = self.instance.seconds_used
-        return used_field
+        with AGGREGATION_DURATION.time(service=self.__class__.__name__):
+            apply_usage_record_deltas(self.get_deltas())
+
+    def get_deltas(self) -> UsageRecordDeltas:
+        """Take instance fields from its aggregate"""
+        deltas = new_usage_record_deltas()
+        add_usage_record_delta(deltas, self.record_type, self.instance, sign=-1)
+        return deltas
+
+
+class BulkCreateUsageRecordService:
+    """
+    Insert a batch of raw usage records and fold them into UsageRecord.
+    bulk_create skips the pre_save signals, so the grouped deltas are applied here
+    with one statement per batch instead of 2-3 queries per row
+    """
+
+    def __init__(self, instances: Sequence[RawUsageRecord], record_type: int, batch_size: Optional[int] = 1000) -> None:
+        self.instances = instances
+        self.record_type = record_type
+        self.batch_size = batch_size
+
+    @transaction.atomic
+    def create(self) -> List[RawUsageRecord]:
+        """Insert raw records and update UsageRecord with their grouped deltas"""
+        model = UsageRecord.RAW_MODELS[self.record_type]
+        records = model.objects.bulk_create(self.instances, batch_size=self.batch_size)
+        deltas = new_usage_record_deltas()
+        for record in records:
+            add_usage_record_delta(deltas, self.record_type, record)
+        ApplyUsageRecordDeltasService.from_deltas(deltas).apply_raw_changes()
+        return records
+
+
+class NdjsonCsvStream:
+    """File-like object for copy_expert that converts NDJSON lines to CSV rows lazily"""
+
+    def __init__(self, lines: Iterable[str], keys: Sequence[str]) -> None:
+        self.rows = (json.loads(line) for line in lines if line.strip())
+        self.keys = keys
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.pending) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow([row.get(key) for key in self.keys])
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        if size < 0:
+            size = len(self.pending)
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        return chunk
+
+
+class ImportUsageRecordService:
+    """
+    Stream a CSV/NDJSON file of raw usage records through COPY into an unlogged staging table,
+    then merge it into the raw table and fold it into UsageRecord with set-based SQL.
+    Files carry subscription_id, price, usage_date and kilobytes_used/seconds_used (or used) columns
+    """
+
+    FORMATS = ("csv", "ndjson")
+    STAGING_COLUMNS = ("subscription_id", "price", "usage_date", "used")
+
+    CREATE_STAGING_SQL = """
+        CREATE UNLOGGED TABLE {staging} (
+            subscription_id integer,
+            price numeric(5, 2) NOT NULL DEFAULT 0,
+            usage_date timestamp with time zone NOT NULL,
+            used integer NOT NULL
+        )
+    """
+    COPY_SQL = "COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    MERGE_RAW_SQL = """
+        INSERT INTO {table} ({subscription_column}, price, usage_date, {used_column})
+        SELECT subscription_id, price, usage_date, used FROM {staging}
+    """
+    AGGREGATE_SOURCE_SQL = """
+        SELECT %s::smallint, subscription_id, usage_date::date, sum(price), sum(used)
+        FROM {staging}
+        GROUP BY subscription_id, usage_date::date
+    """
+
+    def __init__(self, file: TextIO, record_type: int, file_format: str = "csv") -> None:
+        self.file = file
+        self.record_type = record_type
+        self.file_format = file_format
+        self.model = UsageRecord.RAW_MODELS[record_type]
+
+    @transaction.atomic
+    def import_records(self) -> int:
+        """Load the file and return the number of imported raw records"""
+        staging = connection.ops.quote_name(f"usage_import_staging_{uuid.uuid4().hex}")
+        columns, stream = self.__get_stream()
+        with connection.cursor() as cursor:
+            cursor.execute(self.CREATE_STAGING_SQL.format(staging=staging))
+            # copy_expert isn't wrapped by Django, raise its errors as django.db errors too
+            with connection.wrap_database_errors:
+                cursor.copy_expert(self.COPY_SQL.format(staging=staging, columns=", ".join(columns)), stream)
+            cursor.execute(
+                self.MERGE_RAW_SQL.format(
+                    table=self.model._meta.db_table,
+                    subscription_column=self.model._meta.get_field("subscription_id").column,
+                    used_column=self.model.USED_FIELD,
+                    staging=staging,
+                )
+            )
+            imported = cursor.rowcount
+            service = ApplyUsageRecordDeltasService(
+                self.AGGREGATE_SOURCE_SQL.format(staging=staging), [self.record_type]
+            )
+            service.apply_raw_changes()
+            cursor.execute(f"DROP TABLE {staging}")
+        return imported
+
+    def __get_stream(self) -> Tuple[List[str], Union[TextIO, NdjsonCsvStream]]:
+        """Return staging columns in file order and a stream of CSV rows without header"""
+        if self.file_format == "ndjson":
+            keys = ["subscription_id", "price", "usage_date", self.model.USED_FIELD]
+            return list(self.STAGING_COLUMNS), NdjsonCsvStream(self.file, keys)
+        header = next(csv.reader([self.file.readline()]), [])
+        return [self.__get_staging_column(name.strip()) for name in header], self.file
+
+    def __get_staging_column(self, name: str) -> str:
+        if name == self.model.USED_FIELD:
+            return "used"
+        if name not in self.STAGING_COLUMNS:
+            raise ValueError(f"Unknown column {name!r}")
+        return name
+
+
+class RebuildUsageRecordService:
+    """
+    Recompute UsageRecord rows of one day, optionally limited to a subscription id range, from the raw tables.
+    The difference between the raw sums and the stored aggregates is folded in as a delta,
+    so a chunk can be rebuilt any number of times. Types of usage whose raw records of the day were dropped
+    or archived are left as they are, their aggregates are the only copy
+    """
+
+    RAW_SOURCE_SQL = """
+        SELECT %s::smallint, {subscription_column}, usage_date::date, price, {used_column}
+        FROM {table}
+        WHERE usage_date >= %s::date AND usage_date < %s::date + 1 {subscription_filter}
+    """
+    # pending shards are a part of the stored aggregates
+    AGGREGATED_SOURCE_SQL = """
+        SELECT type_of_usage, subscription_id, usage_date, -price, -used
+        FROM {table}
+        WHERE usage_date = %s::date AND type_of_usage = ANY(%s::smallint[]) {subscription_filter}
+    """
+    DELTA_SOURCE_SQL = """
+        SELECT type_of_usage, subscription_id, usage_date, sum(price), sum(used)
+        FROM ({sources}) AS chunk (type_of_usage, subscription_id, usage_date, price, used)
+        GROUP BY type_of_usage, subscription_id, usage_date
+        HAVING sum(price) <> 0 OR sum(used) <> 0
+    """
+    DRIFT_SQL = "SELECT count(*), sum(abs(price)), sum(abs(used)) FROM ({source_sql}) AS delta (t, s, d, price, used)"
+
+    def __init__(
+        self,
+        usage_date: date,
+        subscription_range: Optional[Tuple[int, int]] = None,
+        record_types: Optional[List[int]] = None,
+    ) -> None:
+        self.usage_date = usage_date
+        # NULL_SUBSCRIPTION_RANGE is the records without a subscription
+        self.subscription_range = subscription_range
+        # None is every type of usage that still has raw records of the day
+        self.record_types = (
+            get_raw_usage_types(usage_date, usage_date)[usage_date] if record_types is None else record_types
+        )
+
+    @transaction.atomic
+    def rebuild(self):
+        source_sql, params = self.__get_delta_source()
+        ApplyUsageRecordDeltasService(source_sql, params, shards=0).apply()
+
+    def get_drift(self) -> Dict[str, Union[int, Decimal]]:
+        """Keys whose stored aggregates differ from the raw sums and the absolute differences, without repairing"""
+        source_sql, params = self.__get_delta_source()
+        with connection.cursor() as cursor:
+            cursor.execute(self.DRIFT_SQL.format(source_sql=source_sql), params)
+            keys, price, used = cursor.fetchone()
+        return {"keys": keys, "price": price or Decimal(0), "used": used or 0}
+
+    def __get_delta_source(self) -> Tuple[str, List]:
+        sources, params = [], []
+        for record_type in self.record_types:
+            model = UsageRecord.RAW_MODELS[record_type]
+            subscription_column = model._meta.get_field("subscription_id").column
+            sources.append(
+                self.RAW_SOURCE_SQL.format(
+                    table=model._meta.db_table,
+                    subscription_column=subscription_column,
+                    used_column=model.USED_FIELD,
+                    subscription_filter=self.__get_subscription_filter(subscription_column),
+                )
+            )
+            params += [record_type, self.usage_date, self.usage_date] + self.__get_subscription_params()
+        for model in (UsageRecord, UsageRecordShard):
+            sources.append(
+                self.AGGREGATED_SOURCE_SQL.format(
+                    table=model._meta.db_table,
+                    subscription_filter=self.__get_subscription_filter("subscription_id"),
+                )
+            )
+            params += [self.usage_date, self.record_types] + self.__get_subscription_params()
+        return self.DELTA_SOURCE_SQL.format(sources=" UNION ALL ".join(sources)), params
+
+    def __get_subscription_filter(self, column: str) -> str:
+        if self.subscription_range == NULL_SUBSCRIPTION_RANGE:
+            return f"AND {column} IS NULL"
+        return f"AND {column} BETWEEN %s AND %s" if self.subscription_range else ""
+
+    def __get_subscription_params(self) -> List[int]:
+        if self.subscription_range == NULL_SUBSCRIPTION_RANGE:
+            return []
+        return list(self.subscription_range) if self.subscription_range else []
+
+
+class ReconcileUsageRecordService:
+    """
+    Compare UsageRecord of one day with the grouped sums of the raw tables, subscription id range by range,
+    and rebuild only the ranges that differ. Both sides are reduced to a count and an order independent
+    checksum of their (type, subscription, price, used) rows per range in one query, so matching ranges
+    cost one scan of the day and write nothing. Types of usage whose raw records of the day were dropped
+    or archived aren't compared, their aggregates are the only copy
+    """
+
+    GROUPED_RAW_SQL = """
+        SELECT %(type_{type_of_usage})s::smallint, {subscription_column}, sum(price), sum({used_column})
+        FROM {table}
+        WHERE usage_date >= %(usage_date)s::date AND usage_date < %(usage_date)s::date + 1
+        GROUP BY {subscription_column}
+    """
+    # pending shards are a part of the stored aggregates
+    GROUPED_STORED_SQL = """
+        SELECT type_of_usage, subscription_id, sum(price), sum(used)
+        FROM (
+            SELECT type_of_usage, subscription_id, price, used FROM {table} WHERE usage_date = %(usage_date)s
+            UNION ALL
+            SELECT type_of_usage, subscription_id, price, used FROM {shard_table} WHERE usage_date = %(usage_date)s
+        ) AS stored
+        WHERE type_of_usage = ANY(%(record_types)s::smallint[])
+        GROUP BY type_of_usage, subscription_id
+    """
+    # keys summing to zero are the same as missing ones, the rebuild doesn't write them either.
+    # Rows without a subscription are the chunk -1
+    CHUNK_CHECKSUMS_SQL = """
+        SELECT coalesce(subscription_id / %(chunk_size)s, -1), count(*),
+            sum(hashtextextended(concat_ws(':', type_of_usage, subscription_id, price, used), 0))
+        FROM ({rows}) AS side (type_of_usage, subscription_id, price, used)
+        WHERE price <> 0 OR used <> 0
+        GROUP BY 1
+    """
+    CHECKSUMS_SQL = """
+        SELECT coalesce(raw.chunk, stored.chunk),
+            raw.count IS NOT DISTINCT FROM stored.count AND raw.checksum IS NOT DISTINCT FROM stored.checksum
+        FROM ({raw}) AS raw (chunk, count, checksum)
+        FULL JOIN ({stored}) AS stored (chunk, count, checksum) ON raw.chunk = stored.chunk
+    """
+
+    def __init__(
+        self, usage_date: date, chunk_size: int, repair: bool = True, record_types: Optional[List[int]] = None
+    ) -> None:
+        self.usage_date = usage_date
+        self.chunk_size = chunk_size
+        self.repair = repair
+        # None is every type of usage that still has raw records of the day
+        self.record_types = (
+            get_raw_usage_types(usage_date, usage_date)[usage_date] if record_types is None else record_types
+        )
+
+    def reconcile(self) -> Dict[str, Union[int, Decimal]]:
+        """Return the checked and mismatched chunks and the drift of the mismatched ones, repaired if repair is set"""
+        stats = {"chunks": 0, "mismatched_chunks": 0, "keys": 0, "price": Decimal(0), "used": 0}
+        if not self.record_types:
+            return stats
+        for subscription_range in self.get_mismatched_ranges(stats):
+            service = RebuildUsageRecordService(self.usage_date, subscription_range, self.record_types)
+            with transaction.atomic():
+                drift = service.get_drift()
+                if self.repair:
+                    service.rebuild()
+            stats["mismatched_chunks"] += 1
+            for name, value in drift.items():
+                stats[name] += value
+        return stats
+
+    def get_mismatched_ranges(self, stats: Dict) -> List[Tuple[int, int]]:
+        """Subscription id ranges of the mismatched chunks, NULL_SUBSCRIPTION_RANGE for rows without a subscription"""
+        raw = " UNION ALL ".join(
+            self.GROUPED_RAW_SQL.format(
+                type_of_usage=record_type,
+                table=model._meta.db_table,
+                subscription_column=model._meta.get_field("subscription_id").column,
+                used_column=model.USED_FIELD,
+            )
+            for record_type, model in UsageRecord.RAW_MODELS.items()
+            if record_type in self.record_types
+        )
+        stored = self.GROUPED_STORED_SQL.format(
+            table=UsageRecord._meta.db_table, shard_table=UsageRecordShard._meta.db_table
+        )
+        sql = self.CHECKSUMS_SQL.format(
+            raw=self.CHUNK_CHECKSUMS_SQL.format(rows=raw), stored=self.CHUNK_CHECKSUMS_SQL.format(rows=stored)
+        )
+        params = {"usage_date": self.usage_date, "chunk_size": self.chunk_size, "record_types": self.record_types}
+        params.update({f"type_{record_type}": record_type for record_type in self.record_types})
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            chunks = cursor.fetchall()
+        stats["chunks"] += len(chunks)
+        return [
+            NULL_SUBSCRIPTION_RANGE if chunk == -1 else (chunk * self.chunk_size, (chunk + 1) * self.chunk_size - 1)
+            for chunk, matches in chunks
+            if not matches
+        ]
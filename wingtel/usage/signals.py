@@ -1,7 +1,11 @@
-from django.db.models.signals import pre_delete, pre_save
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models.signals import post_migrate, pre_delete, pre_save
 from django.dispatch import receiver
 
 from wingtel.usage.models import DataUsageRecord, UsageRecord, VoiceUsageRecord
+from wingtel.usage.partitions import get_raw_usage_partitions
+from wingtel.usage.schema import sync_aggregation_backend
 from wingtel.usage.services import (
     CreateUpdateUsageRecordService,
     DeleteUsageRecordService,
@@ -30,3 +34,28 @@ def date_usage_delete_handler(instance, **kwargs):
 def voice_usage_delete_handler(instance, **kwargs):
     service = DeleteUsageRecordService(instance, UsageRecord.USAGE_TYPES.voice)
     service.modify_aggregated_object()
+
+
+@receiver(post_migrate, dispatch_uid="usage_partitions_migrate_handler")
+def usage_partitions_handler(sender, **kwargs):
+    """Create raw usage partitions for the next months on every deploy"""
+    if sender.name != "wingtel.usage":
+        return
+    for partitions in get_raw_usage_partitions():
+        if partitions.is_partitioned():
+            partitions.ensure()
+
+
+@receiver(post_migrate, dispatch_uid="usage_aggregation_backend_migrate_handler")
+def usage_aggregation_backend_handler(sender, using, **kwargs):
+    """
+    Install the database objects of USAGE_AGGREGATION_BACKEND, triggers are removed for other backends.
+    They are built from the current models, so only at the latest migration of the app
+    """
+    if sender.name != "wingtel.usage":
+        return
+    executor = MigrationExecutor(connections[using])
+    leaves = [node for node in executor.loader.graph.leaf_nodes() if node[0] == sender.label]
+    if executor.migration_plan(leaves):
+        return
+    sync_aggregation_backend()
@@ -6,4 +6,16 @@ urlpatterns = [
     path("test/", views.TestView.as_view(), name="test"),
     path("price_limit/", views.UsageRecordPriceLimitView.as_view(), name="usage-price_limit"),
     path("usage_metrics/<int:subscription_id>/", views.UsageRecordTotalMetricsView.as_view(), name="usage-metrics"),
+    path(
+        "usage_metrics/<int:subscription_id>/series/",
+        views.UsageRecordTimeSeriesView.as_view(),
+        name="usage-metrics_series",
+    ),
+    path("usage_metrics/batch/", views.UsageRecordBatchMetricsView.as_view(), name="usage-metrics_batch"),
+    path("usage_top/", views.UsageRecordTopView.as_view(), name="usage-top"),
+    path("usage_export/", views.UsageRecordExportView.as_view(), name="usage-export"),
+    path("price_thresholds/", views.PriceThresholdListView.as_view(), name="usage-price_thresholds"),
+    path("price_thresholds/<int:pk>/", views.PriceThresholdDetailView.as_view(), name="usage-price_threshold"),
+    path("price_threshold_events/", views.PriceThresholdEventListView.as_view(), name="usage-price_threshold_events"),
+    path("cache_stats/", views.UsageCacheStatsView.as_view(), name="usage-cache_stats"),
 ]
@@ -1,5 +1,32 @@
+import json
+from datetime import date
+from typing import Iterable, Iterator
+
+from rest_framework.utils.encoders import JSONEncoder
+
+
 def get_object_or_none(klass, *args, **kwargs):
     try:
         return klass.objects.get(*args, **kwargs)
     except klass.DoesNotExist:
         return None
+
+
+def add_months(month: date, months: int) -> date:
+    """First day of the month shifted by the given number of months"""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def stream_json_list(records: Iterable, serializer_class, batch_size: int = 1000) -> Iterator[str]:
+    """Serialize records to a JSON list incrementally, batch_size records per chunk"""
+    yield "["
+    batch, separator = [], ""
+    for record in records:
+        batch.append(json.dumps(serializer_class(record).data, cls=JSONEncoder))
+        if len(batch) == batch_size:
+            yield separator + ",".join(batch)
+            batch, separator = [], ","
+    if batch:
+        yield separator + ",".join(batch)
+    yield "]"
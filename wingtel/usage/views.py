@@ -1,16 +1,48 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import StreamingHttpResponse
 from rest_framework import generics
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from wingtel.replicas.mixins import ReplicaReadsMixin
+from wingtel.usage.cache import (
+    get_cached_exceeded_price,
+    get_cached_usage_metrics,
+    stats,
+)
+from wingtel.usage.exports import CONTENT_TYPES, EXTENSIONS, UsageRecordExporter
+from wingtel.usage.models import PriceThreshold
+from wingtel.usage.pagination import (
+    PriceThresholdEventPagination,
+    UsageRecordKeysetPagination,
+)
 from wingtel.usage.selectors import (
+    get_price_threshold_events,
+    get_top_usage_subscriptions,
+    get_usage_records_for_export,
     get_usage_records_group_by_subscription_id,
+    get_usage_records_group_by_subscription_ids,
     get_usage_records_with_exceeded_price,
+    get_usage_refreshed_at,
+    get_usage_time_series,
 )
 from wingtel.usage.serializers import (
     PriceLimitDeserializer,
+    PriceThresholdEventSerializer,
+    PriceThresholdSerializer,
+    TopUsageDeserializer,
+    TopUsageSerializer,
+    UsageExportDeserializer,
+    UsageMetricsBatchDeserializer,
+    UsageMetricsDeserializer,
     UsageRecordExceedingPriceSerializer,
     UsageRecordTotalMetricsSerializer,
+    UsageTimeSeriesDeserializer,
+    UsageTimeSeriesSerializer,
 )
+from wingtel.usage.utils import stream_json_list
 
 
 class TestView(APIView):
@@ -18,23 +50,199 @@ class TestView(APIView):
         return Response("ok")
 
 
-class UsageRecordPriceLimitView(generics.ListAPIView):
+class UsageRefreshedAtMixin:
+    """Responses of the materialized_view backend tell clients when the data was refreshed"""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        refreshed_at = get_usage_refreshed_at()
+        if refreshed_at:
+            response["X-Usage-Refreshed-At"] = refreshed_at.isoformat()
+        return response
+
+
+class UsageRecordPriceLimitView(ReplicaReadsMixin, UsageRefreshedAtMixin, generics.ListAPIView):
     serializer_class = UsageRecordExceedingPriceSerializer
-    filterset_fields = ["subscription", "type_of_usage"]
+    # type_of_usage is a filter of PriceLimitDeserializer, it's given by name
+    filterset_fields = ["subscription"]
+    pagination_class = UsageRecordKeysetPagination
+    stream_chunk_size = 2000
+
+    def get_params(self) -> dict:
+        serializer = PriceLimitDeserializer(data=self.request.GET)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
 
     def get_queryset(self):
         """
         Group by type_of_usage and subscription_id. Calculate price exceeded from given price_limit
         """
-        serializer = PriceLimitDeserializer(data={"price_limit": self.request.GET.get("price_limit")})
+        params = self.get_params()
+        records = get_usage_records_with_exceeded_price(params["price_limit"])
+        if "type_of_usage" in params:
+            records = records.filter(type_of_usage=params["type_of_usage"])
+        return records
+
+    def list(self, request, *args, **kwargs):
+        """
+        Return all records, a page of them with page_size/cursor parameters,
+        or stream them from a server-side cursor with stream=true.
+        Whole lists are cached until a change of a matching subscription and type of usage
+        """
+        params = self.get_params()
+        queryset = self.filter_queryset(self.get_queryset())
+        if params["stream"]:
+            records = queryset.order_by("subscription_id", "type_of_usage").iterator(chunk_size=self.stream_chunk_size)
+            return StreamingHttpResponse(
+                stream_json_list(records, self.get_serializer_class(), self.stream_chunk_size),
+                content_type="application/json",
+            )
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+        subscription_id = request.GET.get("subscription")
+        records = get_cached_exceeded_price(
+            params["price_limit"],
+            int(subscription_id) if subscription_id else None,
+            params.get("type_of_usage"),
+            # a miss soon after a change is read from the primary, the queryset is built again there
+            lambda: list(self.filter_queryset(self.get_queryset())),
+        )
+        serializer = self.get_serializer(records, many=True)
+        return Response(serializer.data)
+
+
+class UsageRecordTotalMetricsView(ReplicaReadsMixin, UsageRefreshedAtMixin, generics.ListAPIView):
+    serializer_class = UsageRecordTotalMetricsSerializer
+
+    def get_queryset(self):
+        """
+        Filter by type_of_usage, usage_date__gte and usage_date__lte. Whole months are summed from the monthly rollup.
+        Results are cached until a change of the subscription and type of usage
+        """
+        serializer = UsageMetricsDeserializer(data=self.request.GET)
         serializer.is_valid(raise_exception=True)
-        price_limit: int = serializer.validated_data["price_limit"]
-        return get_usage_records_with_exceeded_price(price_limit)
+        filters = {
+            "type_of_usage": serializer.validated_data.get("type_of_usage"),
+            "date_from": serializer.validated_data.get("usage_date__gte"),
+            "date_to": serializer.validated_data.get("usage_date__lte"),
+        }
+        subscription_id = self.kwargs["subscription_id"]
+        return get_cached_usage_metrics(
+            subscription_id,
+            *filters.values(),
+            lambda: get_usage_records_group_by_subscription_id(subscription_id, **filters),
+        )
+
 
+class UsageRecordTimeSeriesView(ReplicaReadsMixin, UsageRefreshedAtMixin, generics.ListAPIView):
+    serializer_class = UsageTimeSeriesSerializer
 
-class UsageRecordTotalMetricsView(generics.ListAPIView):
+    def get_queryset(self):
+        """
+        Price and used of data and voice of every day, week or month (bucket) between usage_date__gte
+        and usage_date__lte, empty buckets are zeros. A whole chart in one query, results aren't cached
+        """
+        serializer = UsageTimeSeriesDeserializer(data=self.request.GET)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        return get_usage_time_series(
+            self.kwargs["subscription_id"], params["bucket"], params["usage_date__gte"], params["usage_date__lte"]
+        )
+
+
+class UsageRecordBatchMetricsView(ReplicaReadsMixin, UsageRefreshedAtMixin, generics.GenericAPIView):
     serializer_class = UsageRecordTotalMetricsSerializer
-    filterset_fields = {"type_of_usage": ["exact"], "usage_date": ["gte", "lte"]}
+    # it's a read with a body
+    replica_methods = ("POST",)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Metrics of many subscriptions in one grouped query. Takes subscription_ids or a subscription filter
+        and the filters of UsageRecordTotalMetricsView. Results aren't cached
+        """
+        serializer = UsageMetricsBatchDeserializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        records = get_usage_records_group_by_subscription_ids(
+            serializer.validated_data["subscription_ids"],
+            type_of_usage=serializer.validated_data.get("type_of_usage"),
+            date_from=serializer.validated_data.get("usage_date__gte"),
+            date_to=serializer.validated_data.get("usage_date__lte"),
+        )
+        return Response(self.get_serializer(records, many=True).data)
+
+
+class UsageRecordTopView(ReplicaReadsMixin, UsageRefreshedAtMixin, generics.ListAPIView):
+    serializer_class = TopUsageSerializer
+
+    def get_queryset(self):
+        """
+        The limit subscriptions with the greatest total price or used (metric) filtered like
+        UsageRecordTotalMetricsView. approximate=true sums whole months of the range or all-time totals
+        of the type_of_usage.
+        Results aren't cached
+        """
+        serializer = TopUsageDeserializer(data=self.request.GET)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        return get_top_usage_subscriptions(
+            params["metric"],
+            params["limit"],
+            type_of_usage=params.get("type_of_usage"),
+            date_from=params.get("usage_date__gte"),
+            date_to=params.get("usage_date__lte"),
+            approximate=params["approximate"],
+        )
+
+
+class UsageRecordExportView(ReplicaReadsMixin, UsageRefreshedAtMixin, APIView):
+    def get(self, request, *args, **kwargs):
+        """
+        Stream daily usage records filtered like UsageRecordTotalMetricsView as CSV, an Arrow IPC stream
+        or Parquet (file_format). Records are read from a server-side cursor USAGE_EXPORT_BATCH_SIZE rows at a time
+        """
+        serializer = UsageExportDeserializer(data=request.GET)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        try:
+            exporter = UsageRecordExporter(params["file_format"], settings.USAGE_EXPORT_BATCH_SIZE)
+        except ImproperlyConfigured as error:
+            raise ValidationError({"file_format": str(error)})
+        records = get_usage_records_for_export(
+            params.get("usage_date__gte"), params.get("usage_date__lte"), params.get("type_of_usage")
+        ).iterator(chunk_size=settings.USAGE_EXPORT_BATCH_SIZE)
+        response = StreamingHttpResponse(exporter.export(records), content_type=CONTENT_TYPES[params["file_format"]])
+        response["Content-Disposition"] = f'attachment; filename="usage.{EXTENSIONS[params["file_format"]]}"'
+        return response
+
+
+class PriceThresholdListView(ReplicaReadsMixin, generics.ListCreateAPIView):
+    queryset = PriceThreshold.objects.order_by("id")
+    serializer_class = PriceThresholdSerializer
+    filterset_fields = ["period", "subscription", "plan", "is_active"]
+
+
+class PriceThresholdDetailView(ReplicaReadsMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = PriceThreshold.objects.all()
+    serializer_class = PriceThresholdSerializer
+
+
+class PriceThresholdEventListView(ReplicaReadsMixin, generics.ListAPIView):
+    """
+    Price threshold crossings recorded by the aggregate writes. Poll with the cursor of the previous response
+    to get new events only, it's an index range scan however many events there are
+    """
+
+    serializer_class = PriceThresholdEventSerializer
+    pagination_class = PriceThresholdEventPagination
+    filterset_fields = ["threshold", "subscription"]
 
     def get_queryset(self):
-        return get_usage_records_group_by_subscription_id(self.kwargs["subscription_id"])
+        return get_price_threshold_events()
+
+
+class UsageCacheStatsView(APIView):
+    def get(self, request, *args, **kwargs):
+        """Hit/miss/eviction counters of the usage cache in this process"""
+        return Response(stats.as_dict())